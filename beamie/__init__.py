@@ -5,4 +5,11 @@ import flask
 
 app = flask.Flask(__name__)
 
-from beamie.routes import library, tokens, users
+from beamie import data
+
+@app.teardown_appcontext
+def end_db_session(exception=None):
+    """Ends the request's DB session, handing its connection back to the pool"""
+    data.end_request_session(exception)
+
+from beamie.routes import library, players, playlists, queries, tokens, users
@@ -5,13 +5,14 @@ A basic CRUD data layer for Beamie using SQLAlchemy
 """
 
 # Imports
+import flask
 import hashlib
 import logging as log
 import random
 
-from sqlalchemy import create_engine, Column, ForeignKey, Integer, String, Boolean, MetaData
+from sqlalchemy import create_engine, BigInteger, Column, ForeignKey, Index, Integer, String, Boolean, MetaData
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import backref, relationship, sessionmaker
+from sqlalchemy.orm import backref, relationship, scoped_session, sessionmaker
 from sqlalchemy.schema import PrimaryKeyConstraint
 
 from config import CONFIG
@@ -20,16 +21,106 @@ from config import CONFIG
 BaseMapping = declarative_base()
 
 
-def engine(db_string=CONFIG['db_string']):
-    return create_engine(db_string)
-
-def session(db_string=CONFIG['db_string']):
-    """Creates a DB session"""
-    eng = engine(db_string)
-    session = sessionmaker(bind=eng)()
-    return session
-
-def construct(db_string=CONFIG['db_string']):
+# Default connection pool settings, overridden by the 'db_pool' config block
+POOL_DEFAULTS = {
+    'size' : 5,
+    'max_overflow' : 10,
+    'recycle' : 3600,
+    'pre_ping' : True
+}
+
+# Keeps IN (...) lists under the bound parameter limits of every database
+CHUNK_SIZE = 500
+
+def chunks(items, size=CHUNK_SIZE):
+    """Splits a list into lists of at most size items"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+# One engine and one session factory per connection string, per process
+_engines = dict()
+_session_factories = dict()
+
+def pool_options(db_string):
+    """Builds the create_engine() pool arguments for a connection string"""
+    pool = dict(POOL_DEFAULTS)
+    pool.update(CONFIG.get('db_pool') or {})
+
+    options = {
+        'pool_recycle' : pool['recycle'],
+        'pool_pre_ping' : pool['pre_ping']
+    }
+
+    # SQLite engines don't use a QueuePool, so sizing options don't apply
+    if not db_string.startswith('sqlite'):
+        options['pool_size'] = pool['size']
+        options['max_overflow'] = pool['max_overflow']
+
+    return options
+
+def engine(db_string=None):
+    """Returns the process-wide engine for a DB, creating it on first use"""
+    if db_string is None:
+        db_string = CONFIG['db_string']
+
+    if db_string not in _engines:
+        log.debug("Creating DB engine for %s" % db_string)
+        _engines[db_string] = create_engine(db_string, **pool_options(db_string))
+
+    return _engines[db_string]
+
+def session_factory(db_string=None):
+    """Returns the cached, thread-local session registry for a DB"""
+    if db_string is None:
+        db_string = CONFIG['db_string']
+
+    if db_string not in _session_factories:
+        _session_factories[db_string] = scoped_session(
+            sessionmaker(bind=engine(db_string)))
+
+    return _session_factories[db_string]
+
+def session(db_string=None):
+    """Gets a DB session. During a Flask request, every call for the default DB
+    returns the one session kept in flask.g, which is opened on first use and
+    ended by end_request_session(). Outside of a request, the session comes
+    from the pooled, thread-local session factory."""
+    if db_string is None and flask.has_app_context():
+        request_session = getattr(flask.g, 'db_session', None)
+        if request_session is None:
+            request_session = session_factory().session_factory()
+            flask.g.db_session = request_session
+        return request_session
+
+    return session_factory(db_string)()
+
+def end_request_session(exception=None):
+    """Commits the request's session, or rolls it back if the request failed,
+    and closes it so its connection goes back to the pool"""
+    request_session = flask.g.pop('db_session', None)
+    if request_session is None:
+        return
+
+    try:
+        if exception is None:
+            request_session.commit()
+        else:
+            request_session.rollback()
+    except Exception, e:
+        log.error("Could not end the request's DB session: %s" % e)
+        request_session.rollback()
+    finally:
+        request_session.close()
+
+def remove_session(db_string=None):
+    """Closes the current thread's session, returning its connection to the pool"""
+    if db_string is None:
+        db_string = CONFIG['db_string']
+
+    if db_string in _session_factories:
+        _session_factories[db_string].remove()
+
+def construct(db_string=None):
     eng = engine(db_string)
     BaseMapping.metadata.drop_all(eng)
     BaseMapping.metadata.create_all(eng)
@@ -62,10 +153,10 @@ class ArtistTag(BaseMapping):
     __tablename__ = 'artist_tag'
 
     id = Column('id', Integer, primary_key=True)
-    artist_id = Column('artist', Integer, ForeignKey("artist.id"))
+    artist_id = Column('artist', Integer, ForeignKey("artist.id"), index=True)
     is_global = Column('global', Boolean)
-    tag = Column('tag', String(250))
-    user_id = Column('user', Integer, ForeignKey("user.id"))
+    tag = Column('tag', String(250), index=True)
+    user_id = Column('user', Integer, ForeignKey("user.id"), index=True)
 
     def __init__(self, artist_id, is_global, tag, user_id):
         self.artist_id, self.is_global, self.tag, self.user_id = \
@@ -79,8 +170,8 @@ class Album(BaseMapping):
     __tablename__ = 'album'
 
     id = Column('id', Integer, primary_key=True)
-    artist_id = Column('artist', Integer, ForeignKey("artist.id"))
-    name = Column('name', String(250))
+    artist_id = Column('artist', Integer, ForeignKey("artist.id"), index=True)
+    name = Column('name', String(250), index=True)
 
     tags = relationship("AlbumTag",
         backref=backref("album",
@@ -104,10 +195,10 @@ class AlbumTag(BaseMapping):
     __tablename__ = 'album_tag'
 
     id = Column('id', Integer, primary_key=True)
-    album_id = Column('album', Integer, ForeignKey("album.id"))
+    album_id = Column('album', Integer, ForeignKey("album.id"), index=True)
     is_global = Column('global', Boolean)
-    tag = Column('tag', String(250))
-    user_id = Column('user', Integer, ForeignKey("user.id"))
+    tag = Column('tag', String(250), index=True)
+    user_id = Column('user', Integer, ForeignKey("user.id"), index=True)
 
     def __init__(self, album_id, is_global, tag, user_id):
         self.album_id, self.is_global, self.tag, self.user_id = \
@@ -117,6 +208,20 @@ class AlbumTag(BaseMapping):
         return "AlbumTag<id=%i, album_id=%i, is_global=%s, tag='%s', user_id=%i>" % (
             self.id, self.album_id, self.is_global, self.tag, self.user_id)
 
+class LibraryVersion(BaseMapping):
+    """The version of the library, kept in a single row and bumped whenever the
+    catalog changes; see beamie.lib.version."""
+    __tablename__ = 'library_version'
+
+    id = Column('id', Integer, primary_key=True)
+    version = Column('version', Integer, nullable=False)
+
+    def __init__(self, id, version):
+        self.id, self.version = id, version
+
+    def __repr__(self):
+        return "LibraryVersion<id=%i, version=%i>" % (self.id, self.version)
+
 class Option(BaseMapping):
     __tablename__ = 'option'
 
@@ -173,7 +278,7 @@ class Playlist(BaseMapping):
 
     id = Column('id', Integer, primary_key=True)
     name = Column('name', String(250))
-    user_id = Column('user', Integer, ForeignKey("user.id"))
+    user_id = Column('user', Integer, ForeignKey("user.id"), index=True)
 
     tracks = relationship("PlaylistTrack",
         backref=backref("playlist",
@@ -198,6 +303,11 @@ class PlaylistTrack(BaseMapping):
 
     track = relationship("Track", uselist=False)
 
+    # Entries are loaded and placed in sequence order within their playlist
+    __table_args__ = (
+        Index('ix_playlist_track_playlist_sequence', 'playlist', 'sequence'),
+    )
+
     def __init__(self, playlist_id, sequence, track_id):
         self.playlist_id, self.sequence, self.track_id = \
             playlist_id, sequence, track_id
@@ -274,7 +384,8 @@ class RoleMembership(BaseMapping):
     __tablename__ = 'role_membership'
 
     role_id = Column('role', Integer, ForeignKey("role.id"), primary_key=True)
-    user_id = Column('user', Integer, ForeignKey("user.id"), primary_key=True)
+    user_id = Column('user', Integer, ForeignKey("user.id"), primary_key=True,
+        index=True)
 
     def __init__(self, role_id, user_id):
         self.role_id, self.user_id = role_id, user_id
@@ -283,29 +394,83 @@ class RoleMembership(BaseMapping):
         return "RoleMembership<role_id=%i, user_id=%i>" % (
             self.role_id, self.user_id)
 
+class SchemaVersion(BaseMapping):
+    __tablename__ = 'schema_version'
+
+    version = Column('version', Integer, primary_key=True)
+    applied = Column('applied', Integer)
+
+    def __init__(self, version, applied):
+        self.version, self.applied = version, applied
+
+    def __repr__(self):
+        return "SchemaVersion<version=%i, applied=%i>" % (
+            self.version, self.applied)
+
+class SearchTrigram(BaseMapping):
+    """One three-character slice of an artist, album or track name. This is
+    the portable search index, used where SQLite's FTS5 isn't available; see
+    beamie.lib.search."""
+    __tablename__ = 'search_trigram'
+
+    trigram = Column('trigram', String(3), primary_key=True)
+    kind = Column('kind', String(8), primary_key=True)
+    entity_id = Column('entity', Integer, primary_key=True)
+
+    __table_args__ = (
+        Index('ix_search_trigram_entity', 'kind', 'entity'),
+    )
+
+    def __init__(self, trigram, kind, entity_id):
+        self.trigram, self.kind, self.entity_id = trigram, kind, entity_id
+
+    def __repr__(self):
+        return "SearchTrigram<trigram='%s', kind='%s', entity_id=%i>" % (
+            self.trigram, self.kind, self.entity_id)
+
 class Token(BaseMapping):
     __tablename__ = 'token'
 
     id = Column('id', String(250), primary_key=True)
-    expiry = Column('expiry', Integer)
-    user_id = Column('user', Integer, ForeignKey("user.id")) 
+    expiry = Column('expiry', Integer, index=True)
+    user_id = Column('user', Integer, ForeignKey("user.id"), index=True)
 
-    def __init__(self, expiry, user_id):
-        self.expiry, self.user_id = expiry, user_id
+    def __init__(self, id, expiry, user_id):
+        self.id, self.expiry, self.user_id = id, expiry, user_id
 
     def __repr__(self):
         return "Token<id='%s', expiry=%i, user_id=%i>" % (
             self.id, self.expiry, self.user_id)
 
+class TokenRevocation(BaseMapping):
+    __tablename__ = 'token_revocation'
+
+    id = Column('id', String(250), primary_key=True)
+    revoked = Column('revoked', Integer)
+    expiry = Column('expiry', Integer, index=True)
+
+    def __init__(self, id, revoked, expiry):
+        self.id, self.revoked, self.expiry = id, revoked, expiry
+
+    def __repr__(self):
+        return "TokenRevocation<id='%s', revoked=%i, expiry=%i>" % (
+            self.id, self.revoked, self.expiry)
+
 class Track(BaseMapping):
     __tablename__ = 'track'
 
     id = Column('id', Integer, primary_key=True)
-    album_id = Column('album', Integer, ForeignKey("album.id"))
+    album_id = Column('album', Integer, ForeignKey("album.id"), index=True)
     filename = Column('filename', String(250), unique=True)
     name = Column('name', String(250))
     number = Column('number', Integer)
 
+    # The file's fingerprint when it was last scanned; see MediaScanner
+    size = Column('size', BigInteger)
+    mtime = Column('mtime', BigInteger)
+    inode = Column('inode', BigInteger)
+    device = Column('device', BigInteger)
+
     player_items = relationship("PlayerTrack",
         backref=backref("track",
             cascade="all, delete-orphan",
@@ -330,9 +495,9 @@ class TrackTag(BaseMapping):
 
     id = Column('id', Integer, primary_key=True)
     is_global = Column('global', Boolean)
-    tag = Column('tag', String(250))
-    track_id = Column('track', Integer, ForeignKey("track.id"))
-    user_id = Column('user', Integer, ForeignKey("user.id"))
+    tag = Column('tag', String(250), index=True)
+    track_id = Column('track', Integer, ForeignKey("track.id"), index=True)
+    user_id = Column('user', Integer, ForeignKey("user.id"), index=True)
 
     def __init__(self, is_global, tag, track_id, user_id):
         self.is_global, self.tag, self.track_id, self.user_id = \
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""In-process caches"""
+
+import threading
+
+from collections import OrderedDict
+from time import time
+
+from beamie.config import CONFIG
+
+class TTLCache(object):
+    """A bounded, thread-safe cache whose entries expire. Once the cache is
+    full, adding an entry evicts the least recently used one."""
+
+    def __init__(self, max_size=1024, ttl=60, config_key=None, sized=True):
+        """Constructor
+
+        :param max_size: The most entries to hold at once
+        :type max_size: int
+        :param ttl: The default number of seconds an entry lives for
+        :type ttl: int
+        :param config_key: A config block whose 'size' and 'ttl' override
+                           max_size and ttl. It's read when an entry is first
+                           stored rather than now, since caches are built at
+                           import, before a config file given with -c is parsed.
+        :type config_key: str
+        :param sized: False if the config block's 'size' doesn't apply, for
+                      caches with a fixed number of entries
+        :type sized: bool
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.config_key = config_key
+        self.sized = sized
+        self.configured = config_key is None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def configure(self):
+        """Reads the cache's size and TTL from its config block, once"""
+        if self.configured:
+            return
+
+        options = CONFIG.get(self.config_key) or {}
+        if self.sized:
+            self.max_size = options.get('size', self.max_size)
+        self.ttl = options.get('ttl', self.ttl)
+        self.configured = True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Gets the value stored under key, or default if there's no live entry"""
+        with self.lock:
+            try:
+                expires, value = self.entries.pop(key)
+            except KeyError:
+                return default
+
+            if expires <= time():
+                return default
+
+            # Re-inserting marks the entry as the most recently used
+            self.entries[key] = ( expires, value )
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Stores value under key for ttl seconds, or the cache's default TTL if
+        that's shorter or ttl isn't given"""
+        self.configure()
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+
+        if ttl <= 0:
+            self.pop(key)
+            return
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = ( time() + ttl, value )
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        """Removes an entry, returning its value if it had one"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+        if entry is None:
+            return None
+        return entry[1]
+
+    def pop_matching(self, predicate):
+        """Removes every entry whose value satisfies predicate. Returns how many
+        entries were removed."""
+        with self.lock:
+            keys = [ key for key, ( _expires, value ) in self.entries.items()
+                if predicate(value) ]
+            for key in keys:
+                del self.entries[key]
+
+        return len(keys)
+
+    def clear(self):
+        """Removes every entry"""
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Library scans and playlist renumbering that run in the background, outside
+of any request"""
+
+# Normal Python modules
+import logging as log
+import threading
+import uuid
+
+from time import time
+
+# Our private modules
+from beamie import data
+from beamie.lib import playlists
+from beamie.lib.cache import TTLCache
+from beamie.lib.mediascanner import MediaScanner
+from beamie.lib.reconciler import LibraryReconciler
+
+# Recent jobs, keyed by ID, so their status can be read after they finish
+SCAN_JOBS = TTLCache(100, 86400, config_key='scan_jobs')
+
+_running = None
+_running_lock = threading.Lock()
+
+# Playlists with a renumbering job queued or running
+_renumbering = set()
+_renumbering_lock = threading.Lock()
+
+class ScanJob(object):
+    """Scans the media paths and reconciles the database with them in a thread
+    of its own, keeping track of how far it has got"""
+
+    def __init__(self, paths):
+        """Constructor
+
+        :param paths: The media paths to scan
+        """
+        self.id = uuid.uuid4().hex
+        self.paths = paths
+        self.phase = 'queued'
+        self.scanner = None
+        self.started = None
+        self.finished = None
+        self.outcome = None
+        self.error = None
+
+    def start(self):
+        """Runs the job in a background thread"""
+        thread = threading.Thread(target=self.run, name="beamie-scan-%s" % self.id)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        """Runs the job in the current thread"""
+        self.started = time()
+        log.info("Scan job %s started" % self.id)
+        try:
+            reconciler = LibraryReconciler(data.session())
+
+            self.phase = 'walking'
+            self.scanner = MediaScanner(self.paths)
+            self.scanner.scan_files(reconciler.fingerprints())
+
+            self.phase = 'reconciling'
+            outcome = reconciler.reconcile(self.scanner.tags, self.scanner.unchanged)
+            outcome['errors'] = self.scanner.errors
+
+            self.outcome = outcome
+            self.phase = 'done'
+        except Exception, e:
+            log.exception("Scan job %s failed: %s" % (self.id, e))
+            self.error = str(e)
+            self.phase = 'failed'
+        finally:
+            data.remove_session()
+            self.finished = time()
+            # Keep the finished job around for the full TTL
+            SCAN_JOBS.set(self.id, self)
+            log.info("Scan job %s %s in %.1f seconds" % (
+                self.id, self.phase, self.finished - self.started))
+
+    def running(self):
+        """Returns True until the job has finished, one way or another"""
+        return self.phase not in [ 'done', 'failed' ]
+
+    def status(self):
+        """Describes the job's progress as a dict, which includes the outcome of
+        the scan once it's done"""
+        found = read = cached = unchanged = errors = 0
+        phase = self.phase
+        if self.scanner is not None:
+            found = self.scanner.files_found
+            read = self.scanner.files_read
+            cached = self.scanner.files_cached
+            unchanged = len(self.scanner.unchanged)
+            errors = len(self.scanner.errors)
+            # The scanner knows when it moves from walking to reading
+            if phase == 'walking' and self.scanner.phase is not None:
+                phase = self.scanner.phase
+
+        elapsed = None
+        throughput = None
+        if self.started is not None:
+            elapsed = (self.finished or time()) - self.started
+            if elapsed > 0:
+                throughput = round((read + cached + unchanged) / elapsed, 1)
+
+        return {
+            "id" : self.id,
+            "phase" : phase,
+            "started" : self.started,
+            "finished" : self.finished,
+            "elapsed" : elapsed,
+            "files" : {
+                "found" : found,
+                "unchanged" : unchanged,
+                "cached" : cached,
+                "read" : read,
+                "errors" : errors
+            },
+            "throughput" : throughput,
+            "outcome" : self.outcome,
+            "error" : self.error
+        }
+
+def start_scan(paths):
+    """Starts a scan job, unless one is already running, in which case that job
+    is returned instead of starting another"""
+    global _running
+    with _running_lock:
+        if _running is not None and _running.running():
+            log.debug("Attaching to running scan job %s" % _running.id)
+            return _running
+
+        job = ScanJob(paths)
+        SCAN_JOBS.set(job.id, job)
+        _running = job
+        job.start()
+        return job
+
+def get_scan(job_id):
+    """Gets a scan job by ID, or None if there's no such job (or it finished long
+    enough ago to be forgotten)"""
+    job = SCAN_JOBS.get(job_id)
+    if job is None and _running is not None and _running.id == job_id:
+        job = _running
+    return job
+
+
+class RenumberJob(object):
+    """Renumbers a playlist whose gaps are running low in a thread of its own,
+    so that the request that crowded it doesn't wait while every entry's row
+    is rewritten"""
+
+    def __init__(self, playlist_id):
+        """Constructor
+
+        :param playlist_id: The ID of the playlist to renumber
+        """
+        self.playlist_id = playlist_id
+
+    def start(self):
+        """Runs the job in a background thread"""
+        thread = threading.Thread(target=self.run,
+            name="beamie-renumber-%i" % self.playlist_id)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        """Runs the job in the current thread. If entries were added or removed
+        between reading the playlist and rewriting it, the job gives up rather
+        than misplace them, and the next crowded change queues it again. The
+        same goes for entries moved meanwhile, which renumber() notices."""
+        session = data.session()
+        try:
+            playlists.lock_playlist(session, self.playlist_id)
+            renumbered = playlists.renumber(session, self.playlist_id)
+
+            # The rewrite holds the write lock, so this sees every entry
+            # added since the entries were read
+            current = [ entry_id for ( entry_id, ) in session.query(
+                data.PlaylistTrack.id).filter_by(playlist_id=self.playlist_id).order_by(
+                data.PlaylistTrack.sequence, data.PlaylistTrack.id) ]
+            if current != renumbered:
+                raise playlists.PlaylistChanged("Playlist %i changed while being renumbered" %
+                    self.playlist_id)
+            session.commit()
+        except playlists.PlaylistChanged, e:
+            log.debug(str(e))
+            session.rollback()
+        except Exception, e:
+            log.exception("Could not renumber playlist %i: %s" % (self.playlist_id, e))
+            session.rollback()
+        finally:
+            data.remove_session()
+            with _renumbering_lock:
+                _renumbering.discard(self.playlist_id)
+
+def start_renumber(playlist_id):
+    """Starts a job renumbering a playlist, unless one is already queued or
+    running for it"""
+    with _renumbering_lock:
+        if playlist_id in _renumbering:
+            return
+        _renumbering.add(playlist_id)
+    RenumberJob(playlist_id).start()
+
+def renumber_crowded(session):
+    """Starts renumbering the playlists that a session's changes left crowded.
+    Call this once the session has committed, so the jobs see those changes."""
+    for playlist_id in session.info.pop(playlists.CROWDED, set()):
+        start_renumber(playlist_id)
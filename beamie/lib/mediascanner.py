@@ -2,59 +2,212 @@
 #-*-coding:utf-8-*-
 
 # Normal Python modules
+import fnmatch
+import itertools
+import multiprocessing
+import multiprocessing.dummy
 import os
 import logging as log
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
 # Our private modules
 import beamie.data
 
 from beamie.config import CONFIG
-from beamie.lib.tag import Tag
+from beamie.lib.metacache import open_metadata_cache
+from beamie.lib.reconciler import unicode_filename
+from beamie.lib.tag import read_track_info, TrackInfo
+
+def fingerprint(stat):
+    """Reduces a file's stat() result to the values that change when the file
+    does: ( size, mtime in microseconds, inode, device )"""
+    return ( stat.st_size, int(stat.st_mtime * 1000000), stat.st_ino, stat.st_dev )
+
+def is_excluded(path, patterns):
+    """Returns True if a path or its last component matches any pattern"""
+    name = os.path.basename(path)
+    for pattern in patterns:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(path, pattern):
+            return True
+    return False
 
 class MediaScanner(object):
     """Scans media and updates the database"""
       
     def __init__(self, paths):
-        """Constructor"""
-        self.files = self.find_files( [ os.path.abspath(p) for p in paths ] )
+        """Constructor. The media paths aren't walked until scan_files()."""
+        self.paths = [ unicode_filename(os.path.abspath(p)) for p in paths ]
         self.tags = list()
+        self.errors = list()
+        self.unchanged = list()
+        self.fingerprints = dict()
+
+        # Progress, which other threads may watch while a scan runs
+        self.phase = None
+        self.files_found = 0
+        self.files_read = 0
+        self.files_cached = 0
       
       
     def find_files(self, paths):
-        """Gets the list of files in a directory recursively"""
+        """Walks the given directories without recursion, lazily yielding the
+        path of every file with an allowed extension. Entry types come from the
+        directory listing itself, so files aren't stat()ed. Directories and files
+        matching a 'scan_exclude' pattern are skipped, and each directory is
+        visited once, even when symlinks form a loop. Paths that are files are
+        yielded as they are, if they're allowed."""
+        extensions = tuple([ '.' + ext.lower() for ext in CONFIG['allowed_extensions'] ])
+        exclude = CONFIG.get('scan_exclude') or []
+
+        visited = set()
+        to_visit = list()
+        for path in reversed(paths):
+            if os.path.isdir(path):
+                to_visit.append(path)
+            elif os.path.isfile(path) and path.lower().endswith(extensions) \
+                    and not is_excluded(path, exclude):
+                yield path
+
+        while len(to_visit) > 0:
+            loc = to_visit.pop()
+
+            try:
+                stat = os.stat(loc)
+                entries = scandir(loc)
+            except OSError, e:
+                log.warning("Could not read directory %s: %s" % (loc, e))
+                continue
+
+            # A directory we've seen through another path means a symlink loop
+            # or a duplicated media path
+            if ( stat.st_dev, stat.st_ino ) in visited:
+                log.debug("Already scanned %s" % loc)
+                continue
+            visited.add(( stat.st_dev, stat.st_ino ))
 
-        all_files = list()
-        files = list()
-        for loc in paths:
             log.debug("Looking for files in %s" % loc)
-            # Make sure loc ends in a /
-            if loc[-1] is not '/':
-                loc += '/'
+            subdirs = list()
+            for entry in entries:
+                if is_excluded(entry.path, exclude):
+                    log.debug("Excluding %s" % entry.path)
+                    continue
 
-            # Get lists of files and directories contained in the provided location
-            files = [ loc + f for f in os.listdir(loc) if os.path.isfile(loc  + f) ]
-            dirs = [ loc + f for f in os.listdir(loc) if os.path.isdir(loc + f) ]
+                try:
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    elif entry.is_file() and entry.name.lower().endswith(extensions):
+                        yield entry.path
+                except OSError, e:
+                    log.warning("Could not read %s: %s" % (entry.path, e))
 
-            if len(dirs) > 0:
-                all_files.extend(self.find_files(dirs))
+            # Visit subdirectories depth-first, in listing order
+            to_visit.extend(reversed(subdirs))
 
-            all_files.extend(files)
+    def scan_files(self, known=None):
+        """Reads the tags of every allowed file into self.tags, as TrackInfo
+        records. With 'scan_workers' set above 1, files are read by a pool of
+        worker processes (or threads, per 'scan_worker_type'). Files that can't
+        be read are listed in self.errors instead of stopping the scan. With a
+        'metadata_cache' configured, tags are taken from the cache when it has
+        them for a file as it is now, and tags that are read are added to it.
 
+        :param known: Optional dict mapping filenames to the fingerprints they
+                      had when last scanned. Files whose fingerprint hasn't
+                      changed aren't opened; they're listed in self.unchanged.
+        """
+        if known is None:
+            known = dict()
+
+        allowed_files = list()
+        self.tags = list()
+        self.errors = list()
+        self.unchanged = list()
+        self.fingerprints = dict()
+        self.files_found = 0
+        self.files_read = 0
+        self.files_cached = 0
+
+        self.phase = 'walking'
+        for f in self.find_files(self.paths):
+            self.files_found += 1
+            try:
+                filename = unicode_filename(f)
+                self.fingerprints[filename] = fingerprint(os.stat(f))
+            except (OSError, UnicodeDecodeError), e:
+                self.errors.append({ "filename" : f, "error" : str(e) })
+                continue
+
+            if known.get(filename) == self.fingerprints[filename]:
+                self.unchanged.append(filename)
+            else:
+                allowed_files.append(f)
+
+        log.debug("%i files unchanged, %i to read" % (
+            len(self.unchanged), len(allowed_files)))
+
+        cache = open_metadata_cache()
+        try:
+            if cache is not None:
+                allowed_files = self.read_cache(cache, allowed_files)
+
+            self.phase = 'reading'
+            self.read_files(allowed_files)
+
+            if cache is not None:
+                cache.store(self.tags[self.files_cached:])
+        finally:
+            if cache is not None:
+                cache.close()
+
+    def read_cache(self, cache, files):
+        """Adds the tags of files the metadata cache knows to self.tags.
+        Returns the files that still need to be read."""
+        uncached = list()
         for f in files:
-            log.debug("Found %s" % f)
-            
+            filename = unicode_filename(f)
+            row = cache.get(filename, self.fingerprints[filename])
+            if row is None:
+                uncached.append(f)
+            else:
+                artist, album, title, number = row
+                self.tags.append(TrackInfo(
+                    f, artist, album, title, number, self.fingerprints[filename]))
 
-        return list(set(all_files))
+        self.files_cached = len(self.tags)
+        log.debug("%i files found in the metadata cache" % self.files_cached)
+        return uncached
 
-    def scan_files(self):
-        allowed_files = list()
+    def read_files(self, allowed_files):
+        """Reads the tags of the given files, serially or with workers"""
+        workers = CONFIG.get('scan_workers', 0)
+        if workers > 1:
+            if CONFIG.get('scan_worker_type', 'process') == 'thread':
+                pool = multiprocessing.dummy.Pool(workers)
+            else:
+                pool = multiprocessing.Pool(workers)
 
-        for f in self.files:
-            allowed = False
-            for ext in CONFIG['allowed_extensions']:
-                if f.endswith(ext):
-                    allowed_files.append(f)
-                    break
+            log.debug("Reading tags with %i workers" % workers)
+            try:
+                results = pool.imap_unordered(read_track_info, allowed_files, 32)
+                self.collect(results)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            self.collect(itertools.imap(read_track_info, allowed_files))
 
-        self.tags = [ Tag(f) for f in allowed_files ]
+    def collect(self, results):
+        """Sorts tag reading results into self.tags and self.errors"""
+        for info, error in results:
+            self.files_read += 1
+            if error is None:
+                self.tags.append(info._replace(
+                    fingerprint=self.fingerprints[unicode_filename(info.filename)]))
+            else:
+                self.errors.append({ "filename" : info, "error" : error })
 
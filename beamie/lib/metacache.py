@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A persistent cache of the tags read from media files, kept in a small SQLite
+file of its own so that it outlives the library database. After the database is
+rebuilt, or on a new server sharing the same media, a scan can take tags from
+the cache instead of reading every file again."""
+
+# Normal Python modules
+import logging as log
+import os
+import sqlite3
+
+# Our private modules
+from beamie.config import CONFIG
+from beamie.lib.reconciler import unicode_filename
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS %smetadata (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    artist TEXT,
+    album TEXT,
+    title TEXT,
+    number INTEGER
+)"""
+
+COLUMNS = "filename, size, mtime, inode, artist, album, title, number"
+
+def open_metadata_cache():
+    """Opens the cache file named by the 'metadata_cache' setting, or returns
+    None if the setting isn't given"""
+    path = CONFIG.get('metadata_cache')
+    if not path:
+        return None
+    return MetadataCache(path)
+
+class MetadataCache(object):
+    """Tags keyed by filename, each valid only while the file keeps the size,
+    mtime and inode it had when it was read"""
+
+    def __init__(self, path):
+        """Constructor
+
+        :param path: The cache file, which is created if it doesn't exist
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(SCHEMA % '')
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, filename, fingerprint):
+        """Gets the cached tags of a file as a tuple of ( artist, album, title,
+        number ), or None if they aren't cached or the file has changed
+
+        :param fingerprint: The file's ( size, mtime, inode, device ), as made
+                            by beamie.lib.mediascanner.fingerprint()
+        """
+        size, mtime, inode, _device = fingerprint
+        return self.conn.execute(
+            "SELECT artist, album, title, number FROM metadata "
+            "WHERE filename = ? AND size = ? AND mtime = ? AND inode = ?",
+            ( filename, size, mtime, inode )).fetchone()
+
+    def store(self, tracks):
+        """Caches the tags of scanned tracks, in one transaction
+
+        :param tracks: TrackInfo records with their fingerprints set
+        """
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO metadata (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % COLUMNS,
+                [ ( unicode_filename(track.filename), track.fingerprint[0], track.fingerprint[1],
+                    track.fingerprint[2], track.artist, track.album, track.title, track.number )
+                  for track in tracks if track.fingerprint is not None ])
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+
+    def export_to(self, path):
+        """Copies every entry into another cache file, creating it if needed.
+        Returns the number of entries copied."""
+        return self.transfer("INSERT OR REPLACE INTO other.metadata SELECT %s FROM metadata" % COLUMNS, path)
+
+    def import_from(self, path):
+        """Merges the entries of another cache file into this one, replacing
+        entries for the same files. Returns the number of entries imported."""
+        if not os.path.exists(path):
+            raise Exception("No metadata cache at %s" % path)
+        return self.transfer("INSERT OR REPLACE INTO metadata SELECT %s FROM other.metadata" % COLUMNS, path)
+
+    def transfer(self, statement, path):
+        """Runs a statement with another cache file attached as 'other'"""
+        self.conn.execute("ATTACH DATABASE ? AS other", ( path, ))
+        try:
+            with self.conn:
+                self.conn.execute(SCHEMA % 'other.')
+                count = self.conn.execute(statement).rowcount
+        finally:
+            self.conn.execute("DETACH DATABASE other")
+
+        log.info("Copied %i cached tags" % count)
+        return count
@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Fast, read-only extraction of the few tags the library is built from. The
+file's format is recognized from its first bytes, and only tag headers and the
+frames we need are read; everything else, such as embedded pictures, is seeked
+past rather than loaded."""
+
+# Normal Python modules
+import logging as log
+import struct
+
+class MetadataError(Exception):
+    """Raised when a file's format isn't recognized or its tags are damaged"""
+    pass
+
+class Metadata(object):
+    """The tags read from one file. Slotted to keep the per-file cost of a scan
+    down to these few fields."""
+    __slots__ = ( 'format', 'artist', 'album', 'title', 'number' )
+
+    def __init__(self, format=None, artist=u'', album=u'', title=u'', number=0):
+        self.format = format
+        self.artist = artist
+        self.album = album
+        self.title = title
+        self.number = number
+
+    def __repr__(self):
+        return "<Metadata(format=%r, artist=%r, album=%r, title=%r, number=%i)>" % (
+            self.format, self.artist, self.album, self.title, self.number)
+
+    def missing(self):
+        """Returns True if any text field is empty"""
+        return not ( self.artist and self.album and self.title )
+
+def parse_number(text):
+    """Reads a track number, ignoring any total, as in '3/12'; 0 if unknown"""
+    try:
+        return int(text.split('/')[0])
+    except ValueError:
+        return 0
+
+def syncsafe(data):
+    """Decodes an ID3v2 syncsafe integer, which uses 7 bits of each byte"""
+    value = 0
+    for byte in data:
+        value = (value << 7) | (ord(byte) & 0x7f)
+    return value
+
+class FileStream(object):
+    """Sequential reads and skips over a file"""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def read(self, size):
+        data = self.fd.read(size)
+        if len(data) < size:
+            raise MetadataError("Unexpected end of file")
+        return data
+
+    def skip(self, size):
+        self.fd.seek(size, 1)
+
+class StringStream(object):
+    """Sequential reads and skips over a string"""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size):
+        data = self.data[self.offset:self.offset + size]
+        self.offset += size
+        if len(data) < size:
+            raise MetadataError("Unexpected end of tag")
+        return data
+
+    def skip(self, size):
+        self.offset += size
+
+class OggStream(object):
+    """Sequential reads and skips over the packet data of one logical Ogg
+    stream, across page boundaries. Pages that are only skipped over aren't
+    read, just seeked past."""
+
+    def __init__(self, fd, serial):
+        """Constructor
+
+        :param fd: A file positioned at the start of a page
+        :param serial: The serial number of the stream to read
+        """
+        self.fd = fd
+        self.serial = serial
+        self.buffer = ''
+        self.offset = 0
+
+    def next_page(self):
+        """Reads the next page header of our stream, returning the size of its
+        payload, which the file is now positioned at"""
+        while True:
+            header = self.fd.read(27)
+            if len(header) < 27 or not header.startswith('OggS'):
+                raise MetadataError("Damaged Ogg page")
+            serial = struct.unpack('<I', header[14:18])[0]
+            lacing = self.fd.read(ord(header[26]))
+            size = sum([ ord(byte) for byte in lacing ])
+            if serial == self.serial:
+                return size
+            self.fd.seek(size, 1)
+
+    def read(self, size):
+        chunks = list()
+        while size > 0:
+            if self.offset >= len(self.buffer):
+                self.buffer = self.fd.read(self.next_page())
+                self.offset = 0
+            chunk = self.buffer[self.offset:self.offset + size]
+            self.offset += len(chunk)
+            size -= len(chunk)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def skip(self, size):
+        buffered = min(size, len(self.buffer) - self.offset)
+        self.offset += buffered
+        size -= buffered
+        while size > 0:
+            page_size = self.next_page()
+            if page_size <= size:
+                self.fd.seek(page_size, 1)
+                size -= page_size
+            else:
+                self.buffer = self.fd.read(page_size)
+                self.offset = size
+                size = 0
+
+##### ID3 #####
+
+# Text frames by ID3v2 version; v2.2 uses three character IDs
+ID3_FRAMES = {
+    2 : { 'TP1' : 'artist', 'TAL' : 'album', 'TT2' : 'title', 'TRK' : 'number' },
+    3 : { 'TPE1' : 'artist', 'TALB' : 'album', 'TIT2' : 'title', 'TRCK' : 'number' },
+    4 : { 'TPE1' : 'artist', 'TALB' : 'album', 'TIT2' : 'title', 'TRCK' : 'number' }
+}
+
+ID3_ENCODINGS = [ 'latin-1', 'utf-16', 'utf-16-be', 'utf-8' ]
+
+def decode_id3_text(data):
+    """Decodes the body of an ID3v2 text frame, joining multiple values"""
+    if len(data) < 1 or ord(data[0]) >= len(ID3_ENCODINGS):
+        return u''
+    encoding = ord(data[0])
+    text = data[1:]
+
+    # Values are separated by null terminators, two bytes wide in UTF-16
+    if encoding in [ 1, 2 ]:
+        values = list()
+        start = 0
+        for i in range(0, len(text) - 1, 2):
+            if text[i:i + 2] == '\x00\x00':
+                values.append(text[start:i])
+                start = i + 2
+        values.append(text[start:len(text) - (len(text) - start) % 2])
+    else:
+        values = text.split('\x00')
+
+    return u''.join([ value.decode(ID3_ENCODINGS[encoding], 'replace')
+        for value in values if value ])
+
+def read_id3v2(fd, metadata):
+    """Reads an ID3v2 tag at the start of a file, leaving the file positioned
+    just after it"""
+    header = fd.read(10)
+    version, flags = ord(header[3]), ord(header[5])
+    size = syncsafe(header[6:10])
+    end = 10 + size + (10 if flags & 0x10 else 0)
+    if version not in ID3_FRAMES:
+        log.debug("Unsupported ID3v2 version 2.%i" % version)
+        fd.seek(end)
+        return
+    metadata.format = 'id3v2.%i' % version
+    frames = ID3_FRAMES[version]
+
+    # A v2.2/v2.3 tag unsynchronised as a whole has to be read in full to undo
+    # the unsynchronisation; this is rare
+    if flags & 0x80 and version < 4:
+        data = fd.read(size).replace('\xff\x00', '\xff')
+        stream = StringStream(data)
+        size = len(data)
+    else:
+        stream = FileStream(fd)
+
+    position = 0
+    if flags & 0x40 and version == 3:
+        extended = struct.unpack('>I', stream.read(4))[0]
+        stream.skip(extended)
+        position += 4 + extended
+    elif flags & 0x40 and version == 4:
+        extended = syncsafe(stream.read(4))
+        stream.skip(extended - 4)
+        position += extended
+
+    header_size = 6 if version == 2 else 10
+    while position + header_size <= size:
+        frame = stream.read(header_size)
+        position += header_size
+        if frame[0] == '\x00':
+            break # Padding
+
+        if version == 2:
+            frame_id, frame_size, frame_flags = frame[:3], struct.unpack('>I', '\x00' + frame[3:6])[0], 0
+        elif version == 3:
+            frame_id, frame_size, frame_flags = frame[:4], struct.unpack('>I', frame[4:8])[0], ord(frame[9])
+        else:
+            frame_id, frame_size, frame_flags = frame[:4], syncsafe(frame[4:8]), ord(frame[9])
+        position += frame_size
+
+        if frame_id not in frames:
+            stream.skip(frame_size)
+            continue
+
+        # Skip compressed and encrypted frames
+        if ( version == 3 and frame_flags & 0xc0 ) or ( version == 4 and frame_flags & 0x0c ):
+            stream.skip(frame_size)
+            continue
+
+        data = stream.read(frame_size)
+        if version == 3 and frame_flags & 0x20:
+            data = data[1:] # Grouping identity
+        if version == 4 and frame_flags & 0x40:
+            data = data[1:] # Grouping identity
+        if version == 4 and frame_flags & 0x01:
+            data = data[4:] # Data length indicator
+        if version == 4 and ( frame_flags & 0x02 or flags & 0x80 ):
+            data = data.replace('\xff\x00', '\xff')
+
+        value = decode_id3_text(data)
+        if frames[frame_id] == 'number':
+            metadata.number = parse_number(value)
+        else:
+            setattr(metadata, frames[frame_id], value)
+
+    fd.seek(end)
+
+def read_id3v1(fd, metadata):
+    """Fills in fields missing from metadata from an ID3v1 tag at the end of a
+    file, if there is one. Returns True if there was."""
+    fd.seek(0, 2)
+    if fd.tell() < 128:
+        return False
+    fd.seek(-128, 2)
+    tag = fd.read(128)
+    if not tag.startswith('TAG'):
+        return False
+
+    def field(start, end):
+        return tag[start:end].split('\x00')[0].rstrip(' ').decode('latin-1')
+
+    metadata.title = metadata.title or field(3, 33)
+    metadata.artist = metadata.artist or field(33, 63)
+    metadata.album = metadata.album or field(63, 93)
+    # ID3v1.1 keeps the track number in the last byte of the comment
+    if not metadata.number and tag[125] == '\x00' and tag[126] != '\x00':
+        metadata.number = ord(tag[126])
+    metadata.format = metadata.format or 'id3v1'
+    return True
+
+##### Vorbis comments (Ogg and FLAC) #####
+
+VORBIS_FIELDS = {
+    'ARTIST' : 'artist',
+    'ALBUM' : 'album',
+    'TITLE' : 'title',
+    'TRACKNUMBER' : 'number'
+}
+
+# Enough of a comment to see its field name; longer names aren't ones we want
+VORBIS_NAME_LENGTH = 16
+
+def read_vorbis_comment(stream, metadata):
+    """Reads a Vorbis comment block, skipping the comments we don't need"""
+    vendor_length = struct.unpack('<I', stream.read(4))[0]
+    stream.skip(vendor_length)
+    count = struct.unpack('<I', stream.read(4))[0]
+
+    values = dict()
+    for i in range(count):
+        length = struct.unpack('<I', stream.read(4))[0]
+        head = stream.read(min(length, VORBIS_NAME_LENGTH))
+        name, equals, value = head.partition('=')
+        field = VORBIS_FIELDS.get(name.upper()) if equals else None
+        if field is None:
+            stream.skip(length - len(head))
+            continue
+
+        value += stream.read(length - len(head))
+        values.setdefault(field, list()).append(value.decode('utf-8', 'replace'))
+
+    for field, texts in values.items():
+        if field == 'number':
+            metadata.number = parse_number(texts[0])
+        else:
+            setattr(metadata, field, u''.join(texts))
+
+def read_flac(fd, metadata):
+    """Reads the Vorbis comment block of a FLAC file, seeking past the others"""
+    fd.read(4) # fLaC
+    stream = FileStream(fd)
+    metadata.format = 'flac'
+    last = False
+    while not last:
+        header = stream.read(4)
+        last = bool(ord(header[0]) & 0x80)
+        block_type = ord(header[0]) & 0x7f
+        length = struct.unpack('>I', '\x00' + header[1:4])[0]
+        if block_type == 4:
+            read_vorbis_comment(stream, metadata)
+            return
+        stream.skip(length)
+
+# The first packet of each codec we read, and the prefix of its comment packet
+OGG_CODECS = [
+    ( '\x01vorbis', '\x03vorbis', 'vorbis' ),
+    ( 'OpusHead', 'OpusTags', 'opus' ),
+    ( '\x7fFLAC', None, 'flac' )
+]
+
+def read_ogg(fd, metadata):
+    """Reads the comment packet of an Ogg Vorbis, Opus or FLAC stream, which is
+    the stream's second packet"""
+    header = fd.read(27)
+    serial = struct.unpack('<I', header[14:18])[0]
+    lacing = fd.read(ord(header[26]))
+    first = fd.read(sum([ ord(byte) for byte in lacing ]))
+
+    for magic, prefix, codec in OGG_CODECS:
+        if first.startswith(magic):
+            break
+    else:
+        raise MetadataError("Unsupported Ogg codec")
+    metadata.format = 'ogg/%s' % codec
+
+    # The identification packet is alone on the first page, so the comment
+    # packet starts on the next page of the stream
+    stream = OggStream(fd, serial)
+    if prefix is None:
+        # Ogg FLAC wraps the Vorbis comment in a FLAC metadata block header
+        stream.skip(4)
+    elif stream.read(len(prefix)) != prefix:
+        raise MetadataError("Missing Ogg comment packet")
+    read_vorbis_comment(stream, metadata)
+
+##### MP4 #####
+
+MP4_FIELDS = {
+    '\xa9ART' : 'artist',
+    '\xa9alb' : 'album',
+    '\xa9nam' : 'title',
+    'trkn' : 'number'
+}
+
+def mp4_boxes(fd, start, end):
+    """Yields ( type, data start, box end ) for each box between two offsets,
+    leaving the file positioned at the next box each time"""
+    offset = start
+    while offset + 8 <= end:
+        fd.seek(offset)
+        header = fd.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        data_start = offset + 8
+        if size == 1:
+            size = struct.unpack('>Q', fd.read(8))[0]
+            data_start += 8
+        elif size == 0:
+            size = end - offset
+        if size < data_start - offset:
+            raise MetadataError("Damaged MP4 box")
+
+        yield box_type, data_start, offset + size
+        offset += size
+
+def mp4_child(fd, start, end, box_type):
+    """Finds a child box, returning its ( data start, end ), or None"""
+    for child_type, data_start, child_end in mp4_boxes(fd, start, end):
+        if child_type == box_type:
+            return data_start, child_end
+    return None
+
+def read_mp4(fd, metadata):
+    """Reads the iTunes-style item list at moov/udta/meta/ilst, seeking past the
+    media data and any items we don't need"""
+    fd.seek(0, 2)
+    size = fd.tell()
+    metadata.format = 'mp4'
+
+    box = ( 0, size )
+    for box_type in [ 'moov', 'udta', 'meta' ]:
+        box = mp4_child(fd, box[0], box[1], box_type)
+        if box is None:
+            return
+
+    # meta is usually a full box, with four bytes of version and flags first
+    fd.seek(box[0])
+    if fd.read(8)[4:8] != 'hdlr':
+        box = ( box[0] + 4, box[1] )
+    box = mp4_child(fd, box[0], box[1], 'ilst')
+    if box is None:
+        return
+
+    for item_type, item_start, item_end in mp4_boxes(fd, box[0], box[1]):
+        field = MP4_FIELDS.get(item_type)
+        if field is None:
+            continue
+
+        data = mp4_child(fd, item_start, item_end, 'data')
+        if data is None:
+            continue
+        # The data box holds a type indicator and a locale before the value
+        fd.seek(data[0] + 8)
+        value = fd.read(data[1] - data[0] - 8)
+        if field == 'number':
+            if len(value) >= 4:
+                metadata.number = struct.unpack('>H', value[2:4])[0]
+        else:
+            setattr(metadata, field, value.decode('utf-8', 'replace'))
+
+##### Dispatch #####
+
+def read_metadata(filename):
+    """Reads a media file's tags
+
+    :param filename: The file to read
+    :returns: A Metadata record
+    :raises MetadataError: If the format isn't recognized or no tags are found
+    :raises IOError: If the file can't be read
+    """
+    metadata = Metadata()
+    with open(filename, 'rb') as fd:
+        start = fd.read(12)
+        fd.seek(0)
+
+        if start.startswith('ID3'):
+            read_id3v2(fd, metadata)
+            # FLAC files sometimes carry an ID3v2 tag, despite the spec
+            offset = fd.tell()
+            if fd.read(4) == 'fLaC':
+                fd.seek(offset)
+                read_flac(fd, metadata)
+            elif metadata.missing():
+                read_id3v1(fd, metadata)
+        elif start.startswith('fLaC'):
+            read_flac(fd, metadata)
+        elif start.startswith('OggS'):
+            read_ogg(fd, metadata)
+        elif start[4:8] == 'ftyp':
+            read_mp4(fd, metadata)
+        elif not read_id3v1(fd, metadata):
+            raise MetadataError("No tags found")
+
+    return metadata
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Keyset (cursor) pagination for library listings"""
+
+import base64
+import flask
+import json
+import urllib
+
+from sqlalchemy import and_, or_
+
+from beamie.config import CONFIG
+
+# Request arguments the pager consumes, which handlers shouldn't treat as filters
+PAGING_ARGS = [ 'limit', 'after' ]
+
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_MAX_PAGE_SIZE = 5000
+
+
+def encode_cursor(values):
+    """Turns the sort key values of the last row on a page into an opaque cursor"""
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+def decode_cursor(cursor):
+    """Turns a cursor back into a list of sort key values; aborts with a 400 if
+    the client sent something that isn't one of our cursors"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        flask.abort(400)
+
+    if not isinstance(values, list):
+        flask.abort(400)
+
+    return values
+
+def page_limit(args):
+    """Gets the requested page size, falling back on the configured default and
+    never exceeding the configured maximum"""
+    max_size = CONFIG.get('max_page_size', DEFAULT_MAX_PAGE_SIZE)
+
+    try:
+        limit = int(args.get('limit', CONFIG.get('page_size', DEFAULT_PAGE_SIZE)))
+    except ValueError:
+        flask.abort(400)
+
+    if limit < 1:
+        flask.abort(400)
+
+    return min(limit, max_size)
+
+def after_clause(keys, values):
+    """Builds the row-value comparison (k1, k2, ...) > (v1, v2, ...) out of
+    ANDs and ORs, since not every database supports tuple comparisons"""
+    clauses = list()
+    for i, key in enumerate(keys):
+        equal = [ keys[j] == values[j] for j in range(i) ]
+        clauses.append(and_(*(equal + [ key > values[i] ])))
+    return or_(*clauses)
+
+def keyset_page(query, keys, args):
+    """Gets one page of a query, which must already be ordered by keys. The last
+    key must be unique so that every row has a distinct position. Rather than
+    skipping rows with OFFSET, the page starts right after the row described by
+    the 'after' cursor, so every page costs the same to fetch.
+
+    :param query: The ordered query to page through
+    :param keys: Mapped attributes the query is ordered by
+    :param args: The request arguments holding 'limit' and 'after'
+    :returns: A tuple of ( rows, next_cursor ); next_cursor is None on the last page
+    """
+    limit = page_limit(args)
+
+    if 'after' in args:
+        values = decode_cursor(args['after'])
+        if len(values) != len(keys):
+            flask.abort(400)
+        query = query.filter(after_clause(keys, values))
+
+    # Fetch one extra row to learn whether another page follows this one
+    rows = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([ getattr(rows[-1], key.key) for key in keys ])
+
+    return rows, next_cursor
+
+def paged_response(items, next_cursor):
+    """Builds a JSON response for one page of items. When there's another page,
+    its cursor goes in the X-Next-Cursor header and its URL in a Link header."""
+    resp = flask.make_response(json.dumps(items))
+    resp.headers['Content-Type'] = 'application/json'
+
+    if next_cursor is not None:
+        args = dict([ ( key, value.encode('utf-8') )
+            for key, value in flask.request.args.items() ])
+        args['after'] = next_cursor
+        resp.headers['X-Next-Cursor'] = next_cursor
+        resp.headers['Link'] = '<%s?%s>; rel="next"' % (
+            flask.request.base_url, urllib.urlencode(args))
+
+    return resp
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A write-behind buffer for player positions. Clients report where their
+players are every few seconds while they play, and writing each report to the
+database would have every listener contending for the write lock. Instead,
+reports are held in memory, each player's latest report replacing the one
+before, and written out in one batch every flush_interval seconds, and once
+more when the process exits. Reads of a player's position are answered from
+the buffer first, so clients of the same process see their reports at once.
+
+Each process has a buffer of its own, so another process serving the same
+player may see its position up to flush_interval seconds late."""
+
+# Normal Python modules
+import atexit
+import logging as log
+import threading
+
+from sqlalchemy import bindparam
+
+# Our private modules
+from beamie import data
+from beamie.config import CONFIG
+from beamie.data import chunks
+from beamie.lib.cache import TTLCache
+
+POSITION_DEFAULTS = {
+    'flush_interval' : 5,   # Seconds between writes of buffered positions
+    'max_pending' : 10000   # Write early once this many players have reports
+}
+
+# The IDs of players' owners, so that reports don't each need a DB check
+PLAYER_OWNERS = TTLCache(10000, 300, config_key='player_owner_cache')
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def position_option(key):
+    """Gets a 'player_positions' option from the config, falling back on its
+    default"""
+    return (CONFIG.get('player_positions') or {}).get(key, POSITION_DEFAULTS[key])
+
+class PositionBuffer(object):
+    """Holds the latest reported position of each player until it's flushed to
+    the database"""
+
+    def __init__(self, flush_interval, max_pending):
+        """Constructor
+
+        :param flush_interval: Seconds between flushes
+        :param max_pending: Flush early once this many players have reports
+        """
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = dict()           # Player ID -> ( queue_position, track_position )
+        self.inflight = dict()          # The same, for reports being written
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def report(self, player_id, queue_position, track_position):
+        """Buffers a player's position, replacing any report not yet written"""
+        with self.lock:
+            self.pending[player_id] = ( queue_position, track_position )
+            if len(self.pending) >= self.max_pending:
+                self.wake.set()
+
+    def position(self, player_id):
+        """Gets a player's buffered position as a tuple of ( queue_position,
+        track_position ), or None if it has no report waiting or being written.
+        Reports being written count until they've committed, since the row
+        read beside them may still be older."""
+        with self.lock:
+            position = self.pending.get(player_id)
+            if position is None:
+                position = self.inflight.get(player_id)
+            return position
+
+    def discard(self, player_id):
+        """Drops a player's waiting report, such as when it's deleted"""
+        with self.lock:
+            self.pending.pop(player_id, None)
+            self.inflight.pop(player_id, None)
+
+    def flush(self):
+        """Writes every waiting report to the database in one transaction.
+        Reports arriving meanwhile wait for the next flush, and the batch is
+        still read from until it commits. If the write fails, the reports go
+        back into the buffer unless newer ones have come in.
+
+        :returns: The number of players written
+        """
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, dict()
+                self.inflight = dict(batch)
+            if len(batch) == 0:
+                return 0
+
+            # One executemany UPDATE per chunk. Unlike the ORM's bulk updates,
+            # it doesn't mind players that have been deleted since they
+            # reported, which would otherwise fail the batch on every retry.
+            player = data.Player.__table__
+            update = player.update().where(player.c.id == bindparam('player_id')).values(
+                queue_position=bindparam('queue'), track_position=bindparam('track'))
+
+            session = data.session()
+            try:
+                for ids in chunks(batch.keys()):
+                    session.execute(update, [ {
+                        'player_id' : player_id,
+                        'queue' : batch[player_id][0],
+                        'track' : batch[player_id][1]
+                    } for player_id in ids ])
+                session.commit()
+            except Exception, e:
+                log.exception("Could not write %i player positions: %s" % (len(batch), e))
+                session.rollback()
+                with self.lock:
+                    for player_id, position in batch.items():
+                        self.pending.setdefault(player_id, position)
+                    self.inflight = dict()
+                return 0
+            finally:
+                data.remove_session()
+
+            with self.lock:
+                self.inflight = dict()
+            log.debug("Wrote %i player positions" % len(batch))
+            return len(batch)
+
+    def run(self):
+        """Flushes every flush_interval seconds, or sooner when the buffer
+        fills, until stop() is called"""
+        while not self.stopping.is_set():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def start(self):
+        """Runs the flusher in a background thread"""
+        self.thread = threading.Thread(target=self.run, name="beamie-positions")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops a running flusher, and writes what's left"""
+        self.stopping.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+
+def position_buffer():
+    """Gets the process's position buffer, starting its flusher on first use"""
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            buf = PositionBuffer(position_option('flush_interval'),
+                position_option('max_pending'))
+            buf.start()
+            # The flusher is a daemon thread, so write what's left on the way out
+            atexit.register(buf.stop)
+            _buffer = buf
+    return _buffer
+
+def player_owner(session, player_id):
+    """Gets the ID of the user owning a player, or None if there's no such
+    player"""
+    user_id = PLAYER_OWNERS.get(player_id)
+    if user_id is None:
+        user_id = session.query(data.Player.user_id).filter_by(id=player_id).scalar()
+        if user_id is not None:
+            PLAYER_OWNERS.set(player_id, user_id)
+    return user_id
+
+def report_position(player_id, queue_position, track_position):
+    """Buffers a player's position, to be written at the next flush"""
+    position_buffer().report(player_id, queue_position, track_position)
+
+def player_position(player):
+    """Gets a player's position as a tuple of ( queue_position,
+    track_position ), preferring a buffered report to what's in the database"""
+    if _buffer is not None:
+        position = _buffer.position(player.id)
+        if position is not None:
+            return position
+    return ( player.queue_position, player.track_position )
+
+def player_deleted(player_id):
+    """Forgets a deleted player's buffered position and owner"""
+    if _buffer is not None:
+        _buffer.discard(player_id)
+    PLAYER_OWNERS.pop(player_id)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Keeps playlist entries in order with sparse sequence numbers. Entries are
+numbered GAP apart, so entries inserted or moved between two others take
+numbers from the gap between them, and only those entries' rows are written.
+
+Once the numbers handed out get within LOW_GAP of each other, the playlist is
+renumbered GAP apart again by a background job, after the request that crowded
+it has committed. If a gap runs out before that job has run, the playlist is
+renumbered as part of the request instead. Either way, renumbering rewrites
+every entry's row, one bulk UPDATE over the whole playlist."""
+
+# Normal Python modules
+import logging as log
+
+from sqlalchemy import bindparam, func
+from sqlalchemy.orm import contains_eager
+
+# Our private modules
+from beamie import data
+from beamie.data import chunks
+
+# The distance between the sequence numbers of neighbouring entries, after
+# entries are appended or the playlist is renumbered
+GAP = 1024
+
+# Playlists are renumbered in the background once entries are placed closer
+# together than this
+LOW_GAP = 32
+
+# The key, in a session's info, of the playlists its changes left crowded
+CROWDED = 'crowded_playlists'
+
+class PlaylistError(Exception):
+    """Raised for entries that aren't in the playlist being changed"""
+    pass
+
+class PlaylistChanged(PlaylistError):
+    """Raised when entries move or go while their playlist is renumbered"""
+    pass
+
+def sequences_between(before, after, count):
+    """Picks count ascending sequence numbers strictly between two others,
+    spread evenly across the gap
+
+    :param before: The sequence number to follow, or None for the start
+    :param after: The sequence number to precede, or None for the end
+    :returns: A list of sequence numbers, or None if the gap is too small
+    """
+    if before is None and after is None:
+        before = 0
+    if after is None:
+        return [ before + GAP * (i + 1) for i in range(count) ]
+    if before is None:
+        return [ after - GAP * (count - i) for i in range(count) ]
+
+    step = (after - before) // (count + 1)
+    if step < 1:
+        return None
+    return [ before + step * (i + 1) for i in range(count) ]
+
+def entries(session, playlist_id):
+    """Gets a playlist's entries in order, with their tracks, albums and
+    artists, in one query on the ( playlist, sequence ) index"""
+    return session.query(data.PlaylistTrack).join(data.PlaylistTrack.track).join(
+        data.Track.album).join(data.Album.artist).options(
+            contains_eager(data.PlaylistTrack.track).contains_eager(
+                data.Track.album).contains_eager(data.Album.artist)).filter(
+        data.PlaylistTrack.playlist_id == playlist_id).order_by(
+        data.PlaylistTrack.sequence, data.PlaylistTrack.id)
+
+def lengths(session, playlist_ids):
+    """Counts the entries of each playlist, as a dict keyed by playlist ID"""
+    counts = dict([ ( playlist_id, 0 ) for playlist_id in playlist_ids ])
+    for ids in chunks(list(playlist_ids)):
+        counts.update(session.query(data.PlaylistTrack.playlist_id,
+            func.count(data.PlaylistTrack.id)).filter(
+            data.PlaylistTrack.playlist_id.in_(ids)).group_by(data.PlaylistTrack.playlist_id))
+    return counts
+
+def position(session, playlist_id, after_entry, moving=()):
+    """Finds the sequence numbers on either side of the spot right after an
+    entry, skipping entries that are being moved
+
+    :param after_entry: The ID of the entry to follow, or None for the start
+    :param moving: IDs of entries that will leave their places
+    :returns: A tuple of ( before, after ) sequence numbers, either of which
+              is None at the start or end of the playlist
+    :raises PlaylistError: If after_entry isn't in the playlist
+    """
+    before = None
+    if after_entry is not None:
+        before = session.query(data.PlaylistTrack.sequence).filter_by(
+            id=after_entry, playlist_id=playlist_id).scalar()
+        if before is None:
+            raise PlaylistError("Entry %s isn't in playlist %i" % (after_entry, playlist_id))
+
+    following = session.query(data.PlaylistTrack.id, data.PlaylistTrack.sequence).filter(
+        data.PlaylistTrack.playlist_id == playlist_id)
+    if before is not None:
+        following = following.filter(data.PlaylistTrack.sequence > before)
+
+    # Entries being moved don't hold their places, so skip past them
+    moving = set(moving)
+    for entry_id, sequence in following.order_by(data.PlaylistTrack.sequence).limit(
+            len(moving) + 1):
+        if entry_id not in moving:
+            return before, sequence
+    return before, None
+
+def renumber(session, playlist_id, before=None, room=0):
+    """Numbers a playlist's entries GAP apart, keeping their order
+
+    :param before: The sequence number of the entry to leave room after, or
+                   None to leave room at the start
+    :param room: How many entries to leave room for
+    :returns: The IDs of the entries renumbered, in order
+    :raises PlaylistChanged: If an entry was moved or removed after the
+                             entries were read, in which case the caller
+                             must roll back
+    """
+    rows = session.query(data.PlaylistTrack.id, data.PlaylistTrack.sequence).filter_by(
+        playlist_id=playlist_id).order_by(
+        data.PlaylistTrack.sequence, data.PlaylistTrack.id).all()
+    log.debug("Renumbering %i entries of playlist %i" % (len(rows), playlist_id))
+
+    renumbered = dict()
+    sequence = 0
+    for entry_id, old in rows:
+        sequence += GAP
+        if room > 0 and (before is None or old > before):
+            sequence += GAP * room
+            room = 0
+        renumbered[entry_id] = ( old, sequence )
+
+    # Each entry is only renumbered if it still has the number it was read
+    # with, so that an entry moved meanwhile isn't put back where it was
+    entry = data.PlaylistTrack.__table__
+    update = entry.update().where(entry.c.id == bindparam('entry_id')).where(
+        entry.c.sequence == bindparam('old')).values(sequence=bindparam('new'))
+    updated = 0
+    for ids in chunks(renumbered.keys()):
+        updated += session.execute(update, [ {
+            'entry_id' : entry_id,
+            'old' : renumbered[entry_id][0],
+            'new' : renumbered[entry_id][1]
+        } for entry_id in ids ]).rowcount
+    if updated != len(rows):
+        raise PlaylistChanged("Playlist %i changed while being renumbered" % playlist_id)
+
+    return [ entry_id for entry_id, old in rows ]
+
+def lock_playlist(session, playlist_id):
+    """Locks a playlist's row until the session commits, so that entries
+    aren't placed while it's renumbered. Databases without row locks, like
+    SQLite, ignore this."""
+    session.query(data.Playlist.id).filter_by(id=playlist_id).with_for_update().scalar()
+
+def place(session, playlist_id, after_entry, count, moving=()):
+    """Gets sequence numbers for count entries going right after an entry,
+    renumbering the playlist first if there's no room. If the numbers are
+    crowded, the playlist is noted in the session's info, for
+    jobs.renumber_crowded() to pick up once the session has committed."""
+    lock_playlist(session, playlist_id)
+    before, after = position(session, playlist_id, after_entry, moving)
+    sequences = sequences_between(before, after, count)
+    if sequences is None:
+        renumber(session, playlist_id, before, count)
+        before, after = position(session, playlist_id, after_entry, moving)
+        sequences = sequences_between(before, after, count)
+    elif before is not None and after is not None and sequences[0] - before < LOW_GAP:
+        session.info.setdefault(CROWDED, set()).add(playlist_id)
+    return sequences
+
+def last_entry(session, playlist_id):
+    """Gets the ID of a playlist's last entry, or None if it's empty"""
+    row = session.query(data.PlaylistTrack.id).filter_by(playlist_id=playlist_id).order_by(
+        data.PlaylistTrack.sequence.desc(), data.PlaylistTrack.id.desc()).first()
+    return row[0] if row is not None else None
+
+def add_tracks(session, playlist_id, track_ids, after_entry=None, append=True):
+    """Adds tracks to a playlist, writing only the new entries' rows unless
+    the playlist has to be renumbered
+
+    :param track_ids: The tracks to add, in order
+    :param after_entry: The ID of the entry to add them after
+    :param append: If True, after_entry is ignored and the tracks go at the
+                   end; otherwise an after_entry of None puts them first
+    :returns: The IDs of the new entries, in order
+    """
+    if len(track_ids) == 0:
+        return list()
+    if append:
+        after_entry = last_entry(session, playlist_id)
+
+    sequences = place(session, playlist_id, after_entry, len(track_ids))
+    entries = [ data.PlaylistTrack(playlist_id, sequence, track_id)
+        for sequence, track_id in zip(sequences, track_ids) ]
+    session.add_all(entries)
+    session.flush()
+    return [ entry.id for entry in entries ]
+
+def move_entries(session, playlist_id, entry_ids, after_entry=None):
+    """Moves entries, in the order given, to right after another entry (or to
+    the start, if after_entry is None). Only the moved entries' rows are
+    written unless the playlist has to be renumbered.
+
+    :raises PlaylistError: If any of the entries isn't in the playlist, or
+                           after_entry is one of them
+    """
+    entry_ids = list(entry_ids)
+    if len(entry_ids) == 0:
+        return
+    if after_entry in entry_ids:
+        raise PlaylistError("Can't move entry %s after itself" % after_entry)
+    if len(set(entry_ids)) != len(entry_ids):
+        raise PlaylistError("Entries to move are repeated")
+
+    found = 0
+    for ids in chunks(entry_ids):
+        found += session.query(data.PlaylistTrack).filter(
+            data.PlaylistTrack.playlist_id == playlist_id).filter(
+            data.PlaylistTrack.id.in_(ids)).count()
+    if found != len(entry_ids):
+        raise PlaylistError("Not every entry is in playlist %i" % playlist_id)
+
+    sequences = place(session, playlist_id, after_entry, len(entry_ids), moving=entry_ids)
+    session.bulk_update_mappings(data.PlaylistTrack, [
+        { 'id' : entry_id, 'sequence' : sequence }
+        for entry_id, sequence in zip(entry_ids, sequences) ])
+
+def remove_entries(session, playlist_id, entry_ids):
+    """Deletes entries from a playlist; the others keep their numbers"""
+    for ids in chunks(list(entry_ids)):
+        session.query(data.PlaylistTrack).filter(
+            data.PlaylistTrack.playlist_id == playlist_id).filter(
+            data.PlaylistTrack.id.in_(ids)).delete(synchronize_session=False)
+
+def delete_playlist(session, playlist_id):
+    """Deletes a playlist and its entries. These are bulk deletes, because
+    the ORM cascades a playlist's deletion to its owner."""
+    session.query(data.PlaylistTrack).filter_by(playlist_id=playlist_id).delete(
+        synchronize_session=False)
+    session.query(data.Playlist).filter_by(id=playlist_id).delete(synchronize_session=False)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Runs saved queries. A query's filters are compiled into a single SELECT of
+track IDs, joining the tracks to their albums and artists and looking tags up
+with correlated subqueries, so a query costs one round trip however many
+filters it has. Compiled statements are cached per query, and the IDs a query
+finds are cached until the query or the library changes."""
+
+# Normal Python modules
+import hashlib
+import json
+import logging as log
+import threading
+
+from sqlalchemy import and_, exists, not_, or_, select
+
+# Our private modules
+from beamie import data
+from beamie.lib.cache import TTLCache
+from beamie.lib.version import library_version
+
+# Track attributes a filter can compare, by key
+FIELDS = {
+    'id' : data.Track.id,
+    'name' : data.Track.name,
+    'number' : data.Track.number,
+    'album' : data.Album.name,
+    'album_id' : data.Album.id,
+    'artist' : data.Artist.name,
+    'artist_id' : data.Artist.id
+}
+
+# Tag tables a filter can look in, by key: ( tag model, its foreign key, the
+# column that key refers to ). 'tag' matches tags at any level.
+TAGS = {
+    'track_tag' : [ ( data.TrackTag, data.TrackTag.track_id, data.Track.id ) ],
+    'album_tag' : [ ( data.AlbumTag, data.AlbumTag.album_id, data.Album.id ) ],
+    'artist_tag' : [ ( data.ArtistTag, data.ArtistTag.artist_id, data.Artist.id ) ]
+}
+TAGS['tag'] = TAGS['track_tag'] + TAGS['album_tag'] + TAGS['artist_tag']
+
+COMPARISONS = {
+    'eq' : lambda column, value: column == value,
+    'lt' : lambda column, value: column < value,
+    'le' : lambda column, value: column <= value,
+    'gt' : lambda column, value: column > value,
+    'ge' : lambda column, value: column >= value,
+    'contains' : lambda column, value: column.contains(value, autoescape=True),
+    'starts_with' : lambda column, value: column.startswith(value, autoescape=True),
+    'ends_with' : lambda column, value: column.endswith(value, autoescape=True)
+}
+
+# Comparisons that match what another comparison doesn't. On a tag key they
+# match tracks having no such tag, rather than tracks having some other tag.
+NEGATIONS = {
+    'ne' : 'eq',
+    'not_contains' : 'contains'
+}
+
+# Comparisons that match text, and so can't be given a number
+TEXT_COMPARISONS = [ 'contains', 'not_contains', 'starts_with', 'ends_with' ]
+
+# Query results come in this order
+RESULT_ORDER = [ data.Artist.name, data.Album.name, data.Track.number, data.Track.id ]
+
+# ( dialect name, compiled statement ) tuples, keyed by query_key()
+PLAN_CACHE = TTLCache(1000, 3600, config_key='query_cache')
+
+# ( library version, list of ( track ID, artist ID ) tuples ), keyed by
+# query_key()
+RESULT_CACHE = TTLCache(1000, 3600, config_key='query_cache')
+
+# Bumped whenever the library or a query changes, so that results computed
+# while it was changing aren't cached
+_generation = 0
+_generation_lock = threading.Lock()
+
+class QueryError(Exception):
+    """Raised for filters that can't be compiled"""
+    pass
+
+def filter_value(query_filter):
+    """Gets a filter's value as the type it's compared as"""
+    if not query_filter.value_int:
+        return query_filter.value
+
+    try:
+        return int(query_filter.value)
+    except (TypeError, ValueError):
+        raise QueryError("Filter on '%s' needs a whole number, not '%s'" % (
+            query_filter.key, query_filter.value))
+
+def check_filter(query_filter):
+    """Makes sure a filter can be compiled, raising QueryError if it can't"""
+    if query_filter.key not in FIELDS and query_filter.key not in TAGS:
+        raise QueryError("Unknown filter key '%s'" % query_filter.key)
+    if query_filter.comparison not in COMPARISONS and query_filter.comparison not in NEGATIONS:
+        raise QueryError("Unknown comparison '%s'" % query_filter.comparison)
+    if query_filter.value_int and query_filter.comparison in TEXT_COMPARISONS:
+        raise QueryError("Comparison '%s' needs text, not the number %s" % (
+            query_filter.comparison, query_filter.value))
+    filter_value(query_filter)
+
+def compile_filter(query_filter, user_id):
+    """Turns a filter into a WHERE clause on tracks joined to their albums and
+    artists. Tag filters see global tags and the query owner's own tags.
+
+    :param query_filter: The QueryFilter to compile
+    :param user_id: The ID of the user who owns the query
+    """
+    check_filter(query_filter)
+    comparison = NEGATIONS.get(query_filter.comparison, query_filter.comparison)
+    compare = COMPARISONS[comparison]
+    value = filter_value(query_filter)
+
+    if query_filter.key in FIELDS:
+        clause = compare(FIELDS[query_filter.key], value)
+    else:
+        clause = or_(*[ exists().where(and_(
+            foreign_key == owner_id,
+            compare(model.tag, value),
+            or_(model.is_global == True, model.user_id == user_id)
+        )) for model, foreign_key, owner_id in TAGS[query_filter.key] ])
+
+    if query_filter.comparison in NEGATIONS:
+        clause = not_(clause)
+    return clause
+
+def compile_query(filters, user_id):
+    """Builds the statement selecting the IDs of the tracks a query finds, along
+    with the IDs of their artists.
+
+    Filters are applied in sequence, each joined to everything before it with
+    AND or OR according to its is_and flag (which the first filter ignores), so
+    "A or B and C" means "(A or B) and C". A query without filters finds every
+    track.
+
+    :param filters: The query's QueryFilters
+    :param user_id: The ID of the user who owns the query
+    """
+    clause = None
+    for query_filter in sorted(filters, key=lambda f: f.sequence):
+        compiled = compile_filter(query_filter, user_id)
+        if clause is None:
+            clause = compiled
+        elif query_filter.is_and:
+            clause = and_(clause, compiled)
+        else:
+            clause = or_(clause, compiled)
+
+    statement = select([ data.Track.id, data.Artist.id ]).select_from(
+        data.Track.__table__.join(data.Album.__table__).join(data.Artist.__table__))
+    if clause is not None:
+        statement = statement.where(clause)
+    return statement.order_by(*RESULT_ORDER)
+
+def query_key(query):
+    """Builds a cache key for a query out of its ID and a digest of its owner
+    and filters. A query changed or deleted by another process, or a new query
+    given a deleted one's ID, gets a new key, so no process serves plans or
+    results cached for what the query used to be."""
+    digest = hashlib.sha1(json.dumps([ query.user_id, [ [ f.sequence, f.key, f.comparison,
+        f.value, f.value_int, f.is_and ] for f in sorted(query.filters,
+        key=lambda f: f.sequence) ] ])).hexdigest()
+    return ( query.id, digest )
+
+def plan(query, conn):
+    """Gets a query's statement compiled for a connection's database, compiling
+    it only if it isn't cached"""
+    key = query_key(query)
+    dialect, compiled = PLAN_CACHE.get(key, ( None, None ))
+    if dialect != conn.dialect.name:
+        compiled = compile_query(query.filters, query.user_id).compile(dialect=conn.dialect)
+        log.debug("Compiled query %i: %s" % (query.id, compiled))
+        PLAN_CACHE.set(key, ( conn.dialect.name, compiled ))
+    return compiled
+
+def run_query(query, conn):
+    """Gets the tracks a saved query finds, in result order, as a list of
+    ( track ID, artist ID ) tuples
+
+    :param query: The Query to run
+    :param conn: A connection, such as a session's connection()
+    """
+    # Results found at an older library version are out of date, even if
+    # another process changed the library and this one hasn't heard
+    version = library_version(conn)
+    key = query_key(query)
+    cached = RESULT_CACHE.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    generation = _generation
+    rows = [ ( row[0], row[1] ) for row in conn.execute(plan(query, conn)) ]
+    with _generation_lock:
+        if generation == _generation:
+            RESULT_CACHE.set(key, ( version, rows ))
+    return rows
+
+def generation():
+    """Gets a number that changes whenever the library or a query changes, for
+    keying caches of anything derived from them"""
+    return _generation
+
+def invalidate_query(query_id):
+    """Call this when a query changes. Its plans and results are keyed by its
+    filters, so every process stops using the old ones by itself, and they age
+    out of the caches; this only stops results being cached that were found
+    while the query was changing."""
+    global _generation
+    with _generation_lock:
+        _generation += 1
+
+def invalidate_results():
+    """Forgets every query's results; call this when the library changes"""
+    global _generation
+    with _generation_lock:
+        _generation += 1
+        RESULT_CACHE.clear()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Reconciles the library in the database with the media found on disk"""
+
+# Normal Python modules
+import logging as log
+import os
+import sys
+import threading
+
+from sqlalchemy import or_
+
+# Our private modules
+from beamie import data
+from beamie.data import chunks, CHUNK_SIZE
+from beamie.lib import queries, search, tagindex
+from beamie.lib.version import bump_library_version, library_version
+
+# Held while reconciling, so that scan jobs and the watcher take turns instead
+# of both adding the same new artists and albums. It only covers this process.
+_reconcile_lock = threading.Lock()
+
+def unicode_filename(filename):
+    """Decodes a filename from the filesystem's encoding so it compares equal
+    to the filenames stored in the database"""
+    if isinstance(filename, unicode):
+        return filename
+    return filename.decode(sys.getfilesystemencoding() or 'utf-8')
+
+class LibraryReconciler(object):
+    """Brings the database in line with a set of scanned tracks. Rather than
+    querying per track, it loads the artists, albums and tracks already in the
+    database into dicts with a handful of queries, diffs the scanned tracks
+    against them in memory, and writes the differences with bulk statements."""
+
+    def __init__(self, session, scope=None):
+        """Constructor
+
+        :param session: The DB session to reconcile through
+        :param scope: Optional list of file and directory paths. When given,
+                      only tracks at or under these paths are reconciled, so a
+                      handful of changed files can be applied without loading
+                      the whole library.
+        """
+        self.session = session
+        self.scope = scope
+        self.known = None
+        self.known_version = None
+        # ( track ID, album ID, artist ID ) of tracks added or moved to another
+        # album, for the tag index
+        self.placed = list()
+        self.outcome = {
+            "orphans" : list(),
+            "discoveries" : {
+                "artists" : list(),
+                "albums" : list(),
+                "tracks" : list()
+            },
+            "updates" : list()
+        }
+
+    def known_tracks(self):
+        """Loads every track in the reconciler's scope, keyed by filename"""
+        if self.known is None:
+            self.known = dict()
+            self.known_version = library_version(self.session)
+            if self.scope is None:
+                scopes = [ None ]
+            else:
+                scopes = list(chunks(self.scope, CHUNK_SIZE / 2))
+
+            for paths in scopes:
+                for row in self.track_rows(paths):
+                    self.known[row.filename] = row
+
+        return self.known
+
+    def track_rows(self, paths=None):
+        """Queries tracks along with their album and artist names, optionally
+        limited to tracks at or under the given paths"""
+        rows = self.session.query(
+            data.Track.id,
+            data.Track.filename,
+            data.Track.name,
+            data.Track.number,
+            data.Track.size,
+            data.Track.mtime,
+            data.Track.inode,
+            data.Track.device,
+            data.Album.name.label('album'),
+            data.Album.artist_id,
+            data.Artist.name.label('artist')
+        ).outerjoin(data.Track.album).outerjoin(data.Album.artist)
+
+        if paths is not None:
+            rows = rows.filter(or_(*[ or_(
+                data.Track.filename == path,
+                data.Track.filename.startswith(path.rstrip('/') + '/', autoescape=True)
+            ) for path in paths ]))
+
+        return rows
+
+    def fingerprints(self):
+        """Gets the fingerprint each file had when it was last scanned, keyed by
+        filename, for MediaScanner.scan_files()"""
+        return dict([ ( filename, ( row.size, row.mtime, row.inode, row.device ) )
+            for filename, row in self.known_tracks().items() ])
+
+    def reconcile(self, tracks, unchanged=()):
+        """Reconciles the database with scanned tracks, one reconcile at a time
+        in each process
+
+        :param tracks: Scanned tracks, each having filename, artist, album,
+                       title, number and fingerprint attributes
+        :param unchanged: Filenames that were found but not read, because they
+                          haven't changed since the last scan
+        :returns: A dict describing the orphans removed, the artists, albums
+                  and tracks added, and the tracks whose tags changed
+        """
+        with _reconcile_lock:
+            # Tracks loaded before another reconcile changed the library, such
+            # as the watcher's during a long scan, are loaded again
+            if self.known is not None and library_version(self.session) != self.known_version:
+                self.known = None
+
+            scanned = dict([ ( unicode_filename(track.filename), track ) for track in tracks ])
+
+            known_files = self.remove_orphans(set(scanned.keys()).union(unchanged))
+            artist_ids = self.add_artists(scanned.values())
+            album_ids = self.add_albums(scanned.values(), artist_ids)
+            # New tracks go in in filename order, so that the tracks of an album
+            # get consecutive IDs
+            self.add_tracks(
+                [ ( filename, track ) for filename, track in sorted(scanned.items())
+                    if filename not in known_files ],
+                artist_ids, album_ids)
+            self.update_tracks(
+                [ ( filename, track ) for filename, track in scanned.items()
+                    if filename in known_files ],
+                artist_ids, album_ids)
+
+            # The version commits along with the changes, so other processes see
+            # both or neither
+            changed = self.changed()
+            if changed:
+                version = bump_library_version(self.session)
+
+            self.session.commit()
+            if changed:
+                queries.invalidate_results()
+                tagindex.tracks_removed([ orphan['id'] for orphan in self.outcome['orphans'] ])
+                tagindex.tracks_placed(self.placed)
+                tagindex.caught_up(version)
+            return self.outcome
+
+    def changed(self):
+        """Returns True if reconciling changed the library"""
+        discoveries = self.outcome['discoveries']
+        return len(self.outcome['orphans']) > 0 or len(self.outcome['updates']) > 0 or \
+            any([ len(discoveries[kind]) > 0 for kind in discoveries ])
+
+    def remove_orphans(self, found):
+        """Deletes tracks whose files no longer exist. Returns the set of files
+        that are still in the database.
+
+        :param found: The set of filenames the scan found
+        """
+        known_files = set()
+        orphans = list()
+        for filename, row in self.known_tracks().items():
+            # Only files the scan didn't find need to be checked on disk
+            if filename in found or os.path.exists(filename):
+                known_files.add(filename)
+                continue
+
+            log.debug("Found an orphaned reference to %s" % filename)
+            orphans.append(row.id)
+            self.outcome['orphans'].append({
+                "id" : row.id,
+                "number" : row.number,
+                "name" : row.name,
+                "album" : row.album,
+                "artist" : row.artist,
+                "filename" : filename
+            })
+
+        # Bulk deletes skip the ORM's cascades, so detach dependent rows the
+        # way deleting each Track object would have. Playlist entries of
+        # missing tracks are dropped, which leaves the other entries in order.
+        for ids in chunks(orphans):
+            for model in [ data.TrackTag, data.PlayerTrack ]:
+                self.session.query(model).filter(model.track_id.in_(ids)).update(
+                    { model.track_id : None }, synchronize_session=False)
+            self.session.query(data.PlaylistTrack).filter(
+                data.PlaylistTrack.track_id.in_(ids)).delete(synchronize_session=False)
+            self.session.query(data.Track).filter(data.Track.id.in_(ids)).delete(
+                synchronize_session=False)
+        search.remove_names(self.session.connection(), 'track', orphans)
+
+        return known_files
+
+    def add_artists(self, tracks):
+        """Creates any artists not yet in the database. Returns a dict mapping
+        every artist name to its ID."""
+        artist_ids = dict(self.session.query(data.Artist.name, data.Artist.id))
+
+        new_artists = list()
+        new_names = set()
+        for track in tracks:
+            if track.artist not in artist_ids and track.artist not in new_names:
+                log.debug("Found artist: %s" % track.artist)
+                new_names.add(track.artist)
+                new_artists.append(track.artist)
+
+        if len(new_artists) == 0:
+            log.debug("No new artists to add")
+            return artist_ids
+
+        self.session.bulk_insert_mappings(data.Artist,
+            [ { 'name' : name } for name in new_artists ])
+        for names in chunks(new_artists):
+            artist_ids.update(self.session.query(data.Artist.name, data.Artist.id).filter(
+                data.Artist.name.in_(names)))
+        search.index_names(self.session.connection(), 'artist',
+            [ ( artist_ids[name], name ) for name in new_artists ], replace=False)
+
+        self.outcome['discoveries']['artists'] = new_artists
+        return artist_ids
+
+    def add_albums(self, tracks, artist_ids):
+        """Creates any albums not yet in the database. Albums are told apart by
+        artist and name. Returns a dict mapping ( artist ID, album name ) to
+        album ID."""
+        album_ids = dict([ ( ( artist_id, name ), album_id ) for artist_id, name, album_id
+            in self.session.query(data.Album.artist_id, data.Album.name, data.Album.id) ])
+
+        new_albums = list()
+        new_keys = set()
+        for track in tracks:
+            key = ( artist_ids[track.artist], track.album )
+            if key not in album_ids and key not in new_keys:
+                log.debug("Found album: %s" % track.album)
+                new_keys.add(key)
+                new_albums.append({ 'name' : track.album, 'artist' : key[0] })
+
+        if len(new_albums) == 0:
+            log.debug("No new albums to add")
+            return album_ids
+
+        self.session.bulk_insert_mappings(data.Album, [ {
+            'artist_id' : album['artist'],
+            'name' : album['name']
+        } for album in new_albums ])
+        for artists in chunks(list(set([ album['artist'] for album in new_albums ]))):
+            album_ids.update([ ( ( artist_id, name ), album_id ) for artist_id, name, album_id
+                in self.session.query(data.Album.artist_id, data.Album.name, data.Album.id).filter(
+                    data.Album.artist_id.in_(artists)) ])
+        search.index_names(self.session.connection(), 'album',
+            [ ( album_ids[( album['artist'], album['name'] )], album['name'] )
+              for album in new_albums ], replace=False)
+
+        self.outcome['discoveries']['albums'] = new_albums
+        return album_ids
+
+    def add_tracks(self, tracks, artist_ids, album_ids):
+        """Creates tracks for newly found files
+
+        :param tracks: A list of ( filename, scanned track ) tuples
+        """
+        new_tracks = [ {
+            'filename' : filename,
+            'name' : track.title,
+            'album' : album_ids[( artist_ids[track.artist], track.album )],
+            'number' : track.number
+        } for filename, track in tracks ]
+
+        if len(new_tracks) == 0:
+            log.debug("No new tracks to add")
+            return
+
+        self.session.bulk_insert_mappings(data.Track, [
+            dict(self.fingerprint_fields(scanned), **{
+                'album_id' : track['album'],
+                'filename' : track['filename'],
+                'name' : track['name'],
+                'number' : track['number']
+            }) for track, ( _filename, scanned ) in zip(new_tracks, tracks) ])
+
+        names = dict([ ( track['filename'], track['name'] ) for track in new_tracks ])
+        artists = dict([ ( filename, artist_ids[scanned.artist] ) for filename, scanned in tracks ])
+        albums = dict([ ( track['filename'], track['album'] ) for track in new_tracks ])
+        for filenames in chunks(names.keys()):
+            ids = self.session.query(data.Track.id, data.Track.filename).filter(
+                data.Track.filename.in_(filenames)).all()
+            search.index_names(self.session.connection(), 'track', [
+                ( track_id, names[filename] ) for track_id, filename in ids ], replace=False)
+            self.placed.extend([ ( track_id, albums[filename], artists[filename] )
+                for track_id, filename in ids ])
+
+        self.outcome['discoveries']['tracks'] = new_tracks
+
+    def update_tracks(self, tracks, artist_ids, album_ids):
+        """Stores the new fingerprints of known files that were read again, and
+        any tags that changed along with them
+
+        :param tracks: A list of ( filename, scanned track ) tuples
+        """
+        updates = list()
+        for filename, track in tracks:
+            row = self.known_tracks()[filename]
+            album_id = album_ids[( artist_ids[track.artist], track.album )]
+            update = dict(self.fingerprint_fields(track), id=row.id)
+
+            if ( row.name, row.number, row.album, row.artist ) != \
+                    ( track.title, track.number, track.album, track.artist ):
+                log.debug("Tags changed: %s" % filename)
+                update.update({
+                    'album_id' : album_id,
+                    'name' : track.title,
+                    'number' : track.number
+                })
+                self.outcome['updates'].append({
+                    'id' : row.id,
+                    'filename' : filename,
+                    'name' : track.title,
+                    'album' : album_id,
+                    'number' : track.number
+                })
+                self.placed.append(( row.id, album_id, artist_ids[track.artist] ))
+
+            updates.append(update)
+
+        if len(updates) > 0:
+            self.session.bulk_update_mappings(data.Track, updates)
+        search.index_names(self.session.connection(), 'track',
+            [ ( update['id'], update['name'] ) for update in self.outcome['updates'] ])
+
+    def fingerprint_fields(self, track):
+        """Maps a scanned track's fingerprint onto Track attributes"""
+        if track.fingerprint is None:
+            return dict()
+
+        size, mtime, inode, device = track.fingerprint
+        return { 'size' : size, 'mtime' : mtime, 'inode' : inode, 'device' : device }
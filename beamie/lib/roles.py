@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Role resolution, backed by in-memory caches of the role table and of each
+user's role names"""
+
+import logging as log
+
+from beamie import data
+from beamie.lib.cache import TTLCache
+
+# The whole role table (there are only a handful of roles), under one key
+ROLE_TABLE_CACHE = TTLCache(1, 300, config_key='role_cache', sized=False)
+
+# Role names, keyed by user ID
+USER_ROLES_CACHE = TTLCache(10000, 300, config_key='role_cache')
+
+def all_roles():
+    """Gets every role as a list of dicts with 'id', 'name' and 'description'"""
+    roles = ROLE_TABLE_CACHE.get('roles')
+    if roles is None:
+        session = data.session()
+        roles = [ {
+            'id' : role.id,
+            'name' : role.name,
+            'description' : role.description
+        } for role in session.query(data.Role).order_by(data.Role.id) ]
+        ROLE_TABLE_CACHE.set('roles', roles)
+
+    return roles
+
+def role_ids(names):
+    """Maps role names to role IDs, skipping names that aren't roles"""
+    ids = dict([ ( role['name'], role['id'] ) for role in all_roles() ])
+    return [ ids[name] for name in names if name in ids ]
+
+def user_roles(user_id):
+    """Gets the names of the roles a user is enrolled in, with one joined query
+    when they aren't cached"""
+    roles = USER_ROLES_CACHE.get(user_id)
+    if roles is None:
+        session = data.session()
+        roles = [ name for ( name, ) in session.query(data.Role.name).join(
+            data.RoleMembership,
+            data.RoleMembership.role_id == data.Role.id
+        ).filter(data.RoleMembership.user_id == user_id) ]
+        log.debug("Roles for user %i: %s" % (user_id, roles))
+        USER_ROLES_CACHE.set(user_id, roles)
+
+    return list(roles)
+
+def invalidate_user_roles(user_id):
+    """Forgets a user's cached roles; call this when their memberships change"""
+    USER_ROLES_CACHE.pop(user_id)
+
+def invalidate_roles():
+    """Forgets all cached roles; call this when the role table changes"""
+    ROLE_TABLE_CACHE.clear()
+    USER_ROLES_CACHE.clear()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A search index over artist, album and track names. On SQLite with FTS5 (and
+its trigram tokenizer), names go into an FTS5 table. On other databases they're
+split into trigrams in the search_trigram table. Either way, a term matches any
+name containing it, as the LIKE filters on the listings do, but without scanning
+every row, and hits are scored the same way so results don't depend on the
+backend."""
+
+# Normal Python modules
+import logging as log
+
+from sqlalchemy import text
+
+# Our private modules
+from beamie import data
+from beamie.config import CONFIG
+from beamie.data import chunks
+
+# The searchable models, by the kind of hit they produce
+KINDS = [
+    ( 'artist', data.Artist ),
+    ( 'album', data.Album ),
+    ( 'track', data.Track )
+]
+
+SEARCH_DEFAULTS = {
+    'backend' : 'auto',         # 'fts5', 'trigram', or 'auto' to use FTS5 if we can
+    'max_results' : 1000,       # The most hits a search returns
+    'max_candidates' : 20000    # The most matching names a search scores
+}
+
+# Hits of equal score are ordered by kind, in this order, and then by ID
+KIND_ORDER = dict([ ( kind, i ) for i, ( kind, _model ) in enumerate(KINDS) ])
+
+# The backend chosen for each database, by connection string
+_backends = dict()
+
+def search_option(key):
+    """Gets a 'search' option from the config, falling back on its default"""
+    return (CONFIG.get('search') or {}).get(key, SEARCH_DEFAULTS[key])
+
+def fts5_available(conn):
+    """Returns True if the database is SQLite with FTS5's trigram tokenizer,
+    which arrived in SQLite 3.34"""
+    if conn.dialect.name != 'sqlite':
+        return False
+
+    options = [ row[0] for row in conn.execute(text("PRAGMA compile_options")) ]
+    version = conn.execute(text("SELECT sqlite_version()")).scalar()
+    return 'ENABLE_FTS5' in options and \
+        tuple([ int(part) for part in version.split('.')[:2] ]) >= ( 3, 34 )
+
+def backend(conn):
+    """Gets the name of the search backend to use for a database"""
+    url = str(conn.engine.url)
+    if url not in _backends:
+        choice = search_option('backend')
+        if choice == 'auto':
+            choice = 'fts5' if fts5_available(conn) else 'trigram'
+        if choice not in [ 'fts5', 'trigram' ]:
+            raise Exception("Unknown search backend: %s" % choice)
+        _backends[url] = choice
+        log.debug("Searching with %s" % choice)
+
+    return _backends[url]
+
+def normalize(name):
+    """Lowercases a name and collapses its whitespace"""
+    return u' '.join((name or u'').lower().split())
+
+def trigrams(name):
+    """Gets the set of three-character slices of a normalized name"""
+    name = normalize(name)
+    return set([ name[i:i + 3] for i in range(len(name) - 2) ])
+
+def terms(query):
+    """Splits a search query into lowercase words"""
+    return normalize(query).split()
+
+
+##### Building the index #####
+
+def create_search_index(conn):
+    """Creates the FTS5 table if that's the backend in use; the trigram table is
+    a regular model"""
+    if backend(conn) == 'fts5':
+        conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING "
+            "fts5(name, kind UNINDEXED, entity UNINDEXED, tokenize='trigram')"))
+
+def rebuild_index(conn):
+    """Empties the index and fills it with every artist, album and track"""
+    remove_all(conn)
+    for kind, model in KINDS:
+        rows = conn.execute(model.__table__.select().with_only_columns(
+            [ model.__table__.c.id, model.__table__.c.name ])).fetchall()
+        index_names(conn, kind, rows, replace=False)
+        log.info("Indexed %i %ss for search" % (len(rows), kind))
+
+def remove_all(conn):
+    if backend(conn) == 'fts5':
+        conn.execute(text("DELETE FROM search_fts"))
+    else:
+        conn.execute(data.SearchTrigram.__table__.delete())
+
+def index_names(conn, kind, entries, replace=True):
+    """Adds names to the index
+
+    :param conn: A connection, such as a session's connection()
+    :param kind: 'artist', 'album' or 'track'
+    :param entries: A list of ( id, name ) tuples
+    :param replace: Whether these entities might already be indexed, in which
+                    case their old names are removed first
+    """
+    if len(entries) == 0:
+        return
+    if replace:
+        remove_names(conn, kind, [ entity_id for entity_id, _name in entries ])
+
+    if backend(conn) == 'fts5':
+        conn.execute(text("INSERT INTO search_fts (name, kind, entity) VALUES (:name, :kind, :entity)"),
+            [ { 'name' : name or u'', 'kind' : kind, 'entity' : entity_id }
+              for entity_id, name in entries ])
+    else:
+        rows = [ { 'trigram' : trigram, 'kind' : kind, 'entity' : entity_id }
+            for entity_id, name in entries for trigram in trigrams(name) ]
+        if len(rows) > 0:
+            conn.execute(data.SearchTrigram.__table__.insert(), rows)
+
+def remove_names(conn, kind, ids):
+    """Removes entities from the index"""
+    for chunk in chunks(list(ids)):
+        if backend(conn) == 'fts5':
+            conn.execute(text("DELETE FROM search_fts WHERE kind = :kind AND entity IN (%s)" %
+                ", ".join([ str(int(entity_id)) for entity_id in chunk ])), kind=kind)
+        else:
+            table = data.SearchTrigram.__table__
+            conn.execute(table.delete().where(table.c.kind == kind).where(table.c.entity.in_(chunk)))
+
+
+##### Searching #####
+
+def search(conn, query):
+    """Finds the artists, albums and tracks whose names contain every word of a
+    query, best matches first
+
+    :returns: A list of ( score, kind, id, name ) tuples, highest score first
+    """
+    words = terms(query)
+    if len(words) == 0:
+        return list()
+
+    # Every backend finds all of the matching names, up to max_candidates of
+    # them taken in order of kind and ID, so they score and rank the same hits.
+    # Only then are the hits cut down to max_results. One more than the cap is
+    # fetched to tell whether any were left out.
+    limit = search_option('max_results')
+    cap = search_option('max_candidates')
+    indexed = [ word for word in words if len(word) >= 3 ]
+    if len(indexed) == 0:
+        # Too short for trigrams, so only look for names that start this way
+        candidates = search_prefix(conn, u' '.join(words), cap + 1)
+    elif backend(conn) == 'fts5':
+        candidates = search_fts5(conn, indexed, cap + 1)
+    else:
+        candidates = search_trigrams(conn, indexed, cap + 1)
+
+    if len(candidates) > cap:
+        log.warning("Search for '%s' matched more than %i names; only the first %i were ranked" % (
+            query, cap, cap))
+        candidates = candidates[:cap]
+
+    # Words too short to be indexed still have to appear in the name
+    query = u' '.join(words)
+    hits = [ ( score(query, name), kind, entity_id, name )
+        for kind, entity_id, name in candidates
+        if all([ word in normalize(name) for word in words ]) ]
+
+    hits.sort(key=hit_key)
+    return hits[:limit]
+
+def hit_key(hit):
+    """Sorts hits, or ( score, kind, id ) cursors, best first"""
+    return ( -hit[0], KIND_ORDER[hit[1]], hit[2] )
+
+def score(query, name):
+    """Scores a matching name from 0 to 2: the share of the name the query
+    covers, plus 1 if the name starts with the query"""
+    name = normalize(name)
+    coverage = float(len(query)) / max(len(name), 1)
+    return round(coverage + (1 if name.startswith(query) else 0), 6)
+
+def search_fts5(conn, words, cap):
+    """Finds up to cap names containing every word with FTS5, in order of kind
+    and ID"""
+    match = u' AND '.join([ u'"%s"' % word.replace(u'"', u'""') for word in words ])
+    return conn.execute(text("SELECT kind, entity, name FROM search_fts "
+        "WHERE search_fts MATCH :match ORDER BY kind, entity LIMIT :limit"),
+        match=match, limit=cap).fetchall()
+
+def search_trigrams(conn, words, cap):
+    """Finds up to cap entities having every trigram of the words, in order of
+    kind and ID. Their names don't necessarily contain the words, since the
+    trigrams might be scattered, so search() checks them."""
+    wanted = set()
+    for word in words:
+        wanted.update(trigrams(word))
+
+    matches = conn.execute(text(
+        "SELECT kind, entity FROM search_trigram WHERE trigram IN (%s) "
+        "GROUP BY kind, entity HAVING COUNT(*) = :count ORDER BY kind, entity LIMIT :limit" %
+            ", ".join([ ":t%i" % i for i in range(len(wanted)) ])),
+        count=len(wanted), limit=cap,
+        **dict([ ( "t%i" % i, trigram ) for i, trigram in enumerate(wanted) ])).fetchall()
+
+    candidates = list()
+    for kind, model in KINDS:
+        ids = [ entity for match_kind, entity in matches if match_kind == kind ]
+        for chunk in chunks(ids):
+            candidates.extend([ ( kind, entity_id, name ) for entity_id, name in
+                conn.execute(model.__table__.select().with_only_columns(
+                    [ model.__table__.c.id, model.__table__.c.name ]).where(
+                    model.__table__.c.id.in_(chunk))) ])
+    return candidates
+
+def search_prefix(conn, query, cap):
+    """Finds up to cap names starting with a short query, in order of kind and
+    ID"""
+    candidates = list()
+    for kind, model in sorted(KINDS):
+        column = model.__table__.c.name
+        candidates.extend([ ( kind, entity_id, name ) for entity_id, name in
+            conn.execute(model.__table__.select().with_only_columns(
+                [ model.__table__.c.id, column ]).where(
+                column.startswith(query, autoescape=True)).order_by(
+                model.__table__.c.id).limit(cap - len(candidates))) ])
+        if len(candidates) >= cap:
+            break
+    return candidates
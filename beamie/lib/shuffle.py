@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Seeded shuffles of track listings. Rather than sorting the matching tracks
+with ORDER BY RANDOM() on every request, the IDs are fetched once and permuted
+in O(n) with a seeded shuffle. The same seed over the same tracks always gives
+the same order, so the order can be paged through with a cursor, and it's
+cached so that later pages cost no more than slicing a list."""
+
+import flask
+import logging as log
+import random
+
+from beamie import data
+from beamie.lib import queries
+from beamie.lib.cache import TTLCache
+from beamie.lib.paging import decode_cursor, encode_cursor, page_limit
+from beamie.lib.version import library_version
+
+# Request arguments the shuffler consumes, which handlers shouldn't treat as filters
+SHUFFLE_ARGS = [ 'shuffle', 'spread' ]
+
+# Shuffled lists of track IDs, keyed by ( source, seed, spread, generation,
+# library version )
+SHUFFLE_CACHE = TTLCache(100, 3600, config_key='shuffle_cache')
+
+MAX_SEED = 2 ** 31 - 1
+
+def shuffle_ids(ids, seed):
+    """Returns a Fisher-Yates shuffle of a list of IDs, determined by the seed"""
+    ids = list(ids)
+    random.Random(seed).shuffle(ids)
+    return ids
+
+def spread_ids(rows, seed):
+    """Shuffles tracks so that each artist's tracks are spread evenly through
+    the order instead of bunching up, in O(n).
+
+    An artist with k of the n tracks has them placed k steps of n/k apart,
+    starting at a random offset within the first step, and each place is moved
+    up to a quarter step either way so that artists with as many tracks as each
+    other don't fall into a fixed rotation. The tracks are laid out in order of
+    their places. Rather than sorting the places, each track goes into one of n
+    buckets by the whole part of its place, and only the rare bucket with more
+    than one track is sorted.
+
+    :param rows: ( track ID, artist ID ) tuples
+    :param seed: The seed that determines the order
+    """
+    rng = random.Random(seed)
+
+    artists = dict()
+    for track_id, artist_id in rows:
+        artists.setdefault(artist_id, list()).append(track_id)
+
+    count = len(rows)
+    buckets = [ None ] * count
+    # Artists are visited in a fixed order so that the seed alone decides the
+    # shuffle
+    for artist_id in sorted(artists.keys()):
+        ids = artists[artist_id]
+        rng.shuffle(ids)
+        step = float(count) / len(ids)
+        offset = rng.random() * step
+        for i, track_id in enumerate(ids):
+            place = offset + (i + rng.uniform(-0.25, 0.25)) * step
+            bucket = max(0, min(int(place), count - 1))
+            if buckets[bucket] is None:
+                buckets[bucket] = list()
+            buckets[bucket].append(( place, track_id ))
+
+    order = list()
+    for bucket in buckets:
+        if bucket is None:
+            continue
+        if len(bucket) > 1:
+            bucket.sort()
+        order.extend([ track_id for _place, track_id in bucket ])
+    return order
+
+def shuffle_seed(args):
+    """Gets the seed a request asks for with ?shuffle=<seed>, or picks one if
+    it leaves the seed blank; aborts with a 400 if the seed isn't a number from
+    0 to MAX_SEED"""
+    if args.get('shuffle', '') == '':
+        return random.randint(0, MAX_SEED)
+
+    try:
+        seed = int(args['shuffle'])
+    except ValueError:
+        flask.abort(400)
+
+    if seed < 0 or seed > MAX_SEED:
+        flask.abort(400)
+    return seed
+
+def shuffle_page(source, load_rows, args):
+    """Gets one page of a shuffled listing. The shuffled order is cached, and
+    only worked out again when it isn't cached or the library has changed
+    since, in this process or any other, so load_rows() usually isn't called
+    for pages after the first.
+
+    :param source: A hashable description of what's being shuffled, such as
+                   the listing's filters
+    :param load_rows: A function returning the ( track ID, artist ID ) tuples
+                      to shuffle, in a fixed order
+    :param args: The request arguments holding 'shuffle', 'spread', 'limit'
+                 and 'after'
+    :returns: A tuple of ( ids, next_cursor, seed ); next_cursor is None on
+              the last page
+    """
+    spread = args.get('spread', '')
+    if spread not in [ '', 'artist' ]:
+        flask.abort(400)
+
+    # The cursor carries the seed, so that pages after the first keep to the
+    # same order even when the server picked the seed
+    if 'after' in args:
+        after = decode_cursor(args['after'])
+        if len(after) != 2 or not all([ isinstance(value, int) and value >= 0 for value in after ]):
+            flask.abort(400)
+        seed, start = after
+    else:
+        seed, start = shuffle_seed(args), 0
+
+    key = ( source, seed, spread, queries.generation(), library_version(data.session()) )
+    order = SHUFFLE_CACHE.get(key)
+    if order is None:
+        rows = load_rows()
+        if spread == 'artist':
+            order = spread_ids(rows, seed)
+        else:
+            order = shuffle_ids([ track_id for track_id, _artist_id in rows ], seed)
+        log.debug("Shuffled %i tracks with seed %i" % (len(order), seed))
+        SHUFFLE_CACHE.set(key, order)
+
+    limit = page_limit(args)
+    next_cursor = None
+    if start + limit < len(order):
+        next_cursor = encode_cursor([ seed, start + limit ])
+
+    return order[start:start + limit], next_cursor, seed
@@ -3,9 +3,13 @@
 """A library for interpreting ID3v2 tags"""
 import logging as log
 
+from collections import namedtuple
+
 import mutagen
 from mutagen.easyid3 import EasyID3
 
+from beamie.lib.metadata import read_metadata
+
 FRAMES = {
     "AENC" : "Audio encryption",
     "APIC" : "Attached picture",
@@ -106,6 +110,33 @@ class Tag(object):
             self.frames = None
 
     
+    def text(self, key):
+        """Gets a text tag by its EasyID3 key, joining multiple values; returns
+        an empty string for a missing tag"""
+        if self.tag is None or key not in self.tag:
+            return u''
+        return u''.join(self.tag[key])
+
+    @property
+    def artist(self):
+        return self.text('artist')
+
+    @property
+    def album(self):
+        return self.text('album')
+
+    @property
+    def title(self):
+        return self.text('title')
+
+    @property
+    def number(self):
+        """The track number, ignoring any total, as in '3/12'; 0 if unknown"""
+        try:
+            return int(self.text('tracknumber').split('/')[0])
+        except ValueError:
+            return 0
+
     def open_file(self, filename):
         """Tries to open the given file and interpret its tags"""
         log.debug("Parsing {} for ID3v2 tag".format(filename))
@@ -113,3 +144,25 @@ class Tag(object):
         self.tag = EasyID3(filename)
         log.debug(self.tag)
 
+
+# A small, picklable record of the tags the library is built from, along with
+# the fingerprint of the file they were read from
+TrackInfo = namedtuple('TrackInfo', [
+    'filename', 'artist', 'album', 'title', 'number', 'fingerprint' ])
+
+def read_track_info(filename):
+    """Reads a file's tags into a TrackInfo, with the fast, format-aware reader
+    in beamie.lib.metadata rather than a full Tag. Safe to run in a worker
+    process or thread: rather than raising, it reports a file it can't read.
+
+    :param filename: The file to read
+    :returns: A tuple of ( TrackInfo, None ), or ( filename, error message )
+              if the file couldn't be read
+    """
+    try:
+        metadata = read_metadata(filename)
+        return TrackInfo(filename, metadata.artist, metadata.album, metadata.title,
+            metadata.number, None), None
+    except Exception, e:
+        log.warning("Could not read tags from %s: %s" % (filename, e))
+        return filename, "%s: %s" % (type(e).__name__, e)
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""An in-memory index of which tracks carry which tags. Each tag's tracks are
+held as a bitmap, a Python int with the bit of each track ID set, so boolean
+tag expressions come down to a handful of ANDs, ORs and NOTs on ints instead of
+joins across the tag tables. Tags on albums and artists count for all of their
+tracks.
+
+The index is built from the database once per process and kept up to date by
+the reconciler, and by whatever changes tags, through the functions at the
+bottom of this module. It notes the library version it reflects, and is built
+again when the library has been changed by another process."""
+
+# Normal Python modules
+import logging as log
+import threading
+
+from binascii import hexlify
+from sqlalchemy import and_, false, literal_column, not_, or_
+
+# Our private modules
+from beamie import data
+from beamie.lib.version import library_version
+
+# The tag tables, by the level of the library they tag: ( model, the column
+# holding the ID of the tagged artist, album or track )
+LEVELS = {
+    'artist' : ( data.ArtistTag, data.ArtistTag.artist_id ),
+    'album' : ( data.AlbumTag, data.AlbumTag.album_id ),
+    'track' : ( data.TrackTag, data.TrackTag.track_id )
+}
+
+# The most runs of consecutive track IDs written into a clause as BETWEENs.
+# SQLite nests each OR inside the next and refuses expressions more than 1000
+# deep, so the IDs of any further runs go into a single IN list instead. A
+# match with more runs than this is filtered by its complement instead, if
+# that has fewer.
+MAX_RUNS = 500
+
+_index = None
+_index_lock = threading.Lock()
+
+
+##### Bitmaps #####
+
+def bitmap(ids):
+    """Builds a bitmap with the bit of each ID set"""
+    ids = list(ids)
+    if len(ids) == 0:
+        return 0
+
+    buf = bytearray((max(ids) >> 3) + 1)
+    for i in ids:
+        buf[i >> 3] |= 1 << (i & 7)
+    buf.reverse()
+    return int(hexlify(buf), 16)
+
+def members(bits):
+    """Lists the IDs whose bits are set in a bitmap, lowest first"""
+    # bin() puts the highest bit first, so reverse it to index bits by ID
+    digits = bin(bits)[:1:-1]
+    ids = list()
+    i = digits.find('1')
+    while i != -1:
+        ids.append(i)
+        i = digits.find('1', i + 1)
+    return ids
+
+def runs(ids):
+    """Groups ascending IDs into ( first, last ) runs of consecutive IDs"""
+    grouped = list()
+    for i in ids:
+        if len(grouped) > 0 and grouped[-1][1] == i - 1:
+            grouped[-1][1] = i
+        else:
+            grouped.append([ i, i ])
+    return [ tuple(run) for run in grouped ]
+
+def runs_clause(column, id_runs):
+    """Matches a column against runs of IDs. The IDs are written into the SQL
+    rather than bound, so there's no limit on how many there are beyond the
+    length of the statement. The MAX_RUNS longest runs become BETWEENs, and
+    every other ID goes into one IN list, which doesn't deepen the clause."""
+    longest = sorted([ run for run in id_runs if run[0] != run[1] ],
+        key=lambda run: run[1] - run[0], reverse=True)[:MAX_RUNS]
+    between = set(longest)
+    singles = list()
+    for first, last in id_runs:
+        if ( first, last ) not in between:
+            singles.extend([ literal_column(str(i)) for i in xrange(first, last + 1) ])
+
+    clauses = [ column.between(literal_column(str(first)), literal_column(str(last)))
+        for first, last in sorted(longest) ]
+    if len(singles) > 0:
+        clauses.append(column.in_(singles))
+    return or_(*clauses)
+
+
+##### Tag expressions #####
+
+def parse_expression(expression):
+    """Parses a tag expression, in which commas separate terms that must all
+    match, a term of tags separated by '|' matches any of them, and a '-' in
+    front of a term negates it. "summer|beach,-rainy" finds tracks tagged
+    summer or beach that aren't tagged rainy.
+
+    :returns: A list of ( negated, [ tags ] ) terms
+    :raises ValueError: If the expression has an empty term or tag
+    """
+    terms = list()
+    for term in expression.split(','):
+        term = term.strip()
+        negated = term.startswith('-')
+        if negated:
+            term = term[1:]
+
+        tags = [ tag.strip() for tag in term.split('|') ]
+        if len([ tag for tag in tags if tag == '' ]) > 0:
+            raise ValueError("Empty tag in tag expression '%s'" % expression)
+        terms.append(( negated, tags ))
+
+    return terms
+
+
+class TagIndex(object):
+    """Bitmaps of tagged tracks, keyed by ( tag, user ID ), where the user ID
+    is None for global tags. The index keeps the IDs of the tagged artists,
+    albums and tracks, and works out the bitmap of a tag's tracks the first
+    time it's needed, keeping it until the tag or the tracks change."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self.version = None            # The library version the index reflects
+        self.tracks = 0                # Bitmap of every track
+        self.track_albums = dict()     # Track ID -> album ID
+        self.album_tracks = dict()     # Album ID -> bitmap of its tracks
+        self.album_artists = dict()    # Album ID -> artist ID
+        self.artist_albums = dict()    # Artist ID -> set of its album IDs
+        self.tagged = dict([ ( level, dict() ) for level in LEVELS ])
+        self.bitmaps = dict()
+
+    def build(self, session):
+        """Loads every track, album and tag from the database"""
+        with self.lock:
+            self.clear()
+            # Read first, so that changes made while loading leave the index
+            # behind the version rather than ahead of it
+            self.version = library_version(session)
+            for album_id, artist_id in session.query(data.Album.id, data.Album.artist_id):
+                self.place_album(album_id, artist_id)
+
+            tracks = dict()
+            for track_id, album_id in session.query(data.Track.id, data.Track.album_id):
+                self.track_albums[track_id] = album_id
+                tracks.setdefault(album_id, list()).append(track_id)
+            for album_id, ids in tracks.items():
+                self.album_tracks[album_id] = bitmap(ids)
+            self.tracks = bitmap(self.track_albums.keys())
+
+            count = 0
+            for level, ( model, column ) in LEVELS.items():
+                for entity_id, tag, is_global, user_id in session.query(
+                        column, model.tag, model.is_global, model.user_id).filter(
+                        column != None):
+                    self.tagged[level].setdefault(( tag, None if is_global else user_id ),
+                        set()).add(entity_id)
+                    count += 1
+
+            log.info("Indexed %i tags on %i tracks" % (count, len(self.track_albums)))
+
+    def catch_up(self, version):
+        """Notes that the changes the index has just been told about bring it
+        up to a library version. If the index had missed an earlier version,
+        it stays behind, to be built again."""
+        with self.lock:
+            if self.version == version - 1:
+                self.version = version
+
+    def place_album(self, album_id, artist_id):
+        previous = self.album_artists.get(album_id)
+        if previous is not None:
+            self.artist_albums[previous].discard(album_id)
+        self.album_artists[album_id] = artist_id
+        self.artist_albums.setdefault(artist_id, set()).add(album_id)
+
+    def place_tracks(self, tracks):
+        """Adds tracks to the index, or moves them to another album
+
+        :param tracks: ( track ID, album ID, artist ID ) tuples
+        """
+        with self.lock:
+            self.remove_tracks([ track_id for track_id, _album_id, _artist_id in tracks ],
+                untag=False)
+
+            albums = dict()
+            for track_id, album_id, artist_id in tracks:
+                if self.album_artists.get(album_id) != artist_id:
+                    self.place_album(album_id, artist_id)
+                self.track_albums[track_id] = album_id
+                albums.setdefault(album_id, list()).append(track_id)
+
+            for album_id, ids in albums.items():
+                self.album_tracks[album_id] = self.album_tracks.get(album_id, 0) | bitmap(ids)
+            self.tracks |= bitmap([ track_id for track_id, _album_id, _artist_id in tracks ])
+            self.bitmaps.clear()
+
+    def remove_tracks(self, ids, untag=True):
+        """Removes deleted tracks from the index, along with their own tags
+        unless untag is False"""
+        with self.lock:
+            mask = ~bitmap(ids)
+            albums = set([ self.track_albums.pop(track_id, None) for track_id in ids ])
+            for album_id in albums:
+                if album_id in self.album_tracks:
+                    self.album_tracks[album_id] &= mask
+            self.tracks &= mask
+
+            if untag:
+                ids = set(ids)
+                for entities in self.tagged['track'].values():
+                    entities.difference_update(ids)
+            self.bitmaps.clear()
+
+    def add_tag(self, level, entity_id, tag, user_id=None):
+        """Notes that an artist, album or track has been tagged
+
+        :param level: 'artist', 'album' or 'track'
+        :param user_id: The ID of the tag's user, or None for a global tag
+        """
+        with self.lock:
+            self.tagged[level].setdefault(( tag, user_id ), set()).add(entity_id)
+            self.bitmaps.pop(( tag, user_id ), None)
+
+    def remove_tag(self, level, entity_id, tag, user_id=None):
+        """Notes that an artist, album or track has lost a tag"""
+        with self.lock:
+            self.tagged[level].get(( tag, user_id ), set()).discard(entity_id)
+            self.bitmaps.pop(( tag, user_id ), None)
+
+    def tag_bitmap(self, key):
+        """Gets the bitmap of the tracks carrying a tag, at any level"""
+        with self.lock:
+            if key not in self.bitmaps:
+                bits = bitmap(self.tagged['track'].get(key, ()))
+                albums = set(self.tagged['album'].get(key, ()))
+                for artist_id in self.tagged['artist'].get(key, ()):
+                    albums.update(self.artist_albums.get(artist_id, ()))
+                for album_id in albums:
+                    bits |= self.album_tracks.get(album_id, 0)
+                self.bitmaps[key] = bits & self.tracks
+            return self.bitmaps[key]
+
+    def tags_bitmap(self, tag, user_id=None):
+        """Gets the bitmap of the tracks carrying a global tag, or the same tag
+        belonging to a user"""
+        bits = self.tag_bitmap(( tag, None ))
+        if user_id is not None:
+            bits |= self.tag_bitmap(( tag, user_id ))
+        return bits
+
+    def match(self, expression, user_id=None):
+        """Gets the bitmap of the tracks matching a tag expression (see
+        parse_expression()), counting global tags and the user's own
+
+        :raises ValueError: If the expression can't be parsed
+        """
+        with self.lock:
+            bits = self.tracks
+            for negated, tags in parse_expression(expression):
+                term = 0
+                for tag in tags:
+                    term |= self.tags_bitmap(tag, user_id)
+                bits = bits & ~term if negated else bits & term
+            return bits
+
+    def clause(self, column, bits):
+        """Builds a WHERE clause matching a column of track IDs against a
+        bitmap. IDs are grouped into runs of consecutive IDs, which tracks
+        tagged through their album or artist tend to form, and if the match has
+        many runs but its complement has fewer, the clause excludes the
+        complement instead. Either way, the clause stays within SQLite's limit
+        on the depth of expressions (see runs_clause())."""
+        with self.lock:
+            ids = members(bits)
+            if len(ids) == 0:
+                return false()
+
+            matched = runs(ids)
+            if len(matched) <= MAX_RUNS:
+                return runs_clause(column, matched)
+
+            # Tracks added since the index was last updated have higher IDs
+            # than any it knows of, so they're left out too
+            excluded = runs(members(self.tracks & ~bits))
+            if len(excluded) >= len(matched):
+                return runs_clause(column, matched)
+            return and_(column <= literal_column(str(ids[-1])),
+                not_(runs_clause(column, excluded)))
+
+
+def tag_index(version=None):
+    """Gets the process's tag index, building it on first use
+
+    :param version: The current library version; if given, and the index
+                    reflects another, it's built again
+    """
+    global _index
+    with _index_lock:
+        if _index is None or (version is not None and _index.version != version):
+            index = TagIndex()
+            index.build(data.session())
+            _index = index
+    return _index
+
+def build_tag_index():
+    """Builds the process's tag index ahead of its first use, outside of any
+    request"""
+    tag_index()
+    data.remove_session()
+
+def tracks_placed(tracks):
+    """Tells the tag index about added and moved tracks, if it's been built
+
+    :param tracks: ( track ID, album ID, artist ID ) tuples
+    """
+    if _index is not None:
+        _index.place_tracks(tracks)
+
+def tracks_removed(ids):
+    """Tells the tag index about deleted tracks, if it's been built"""
+    if _index is not None:
+        _index.remove_tracks(ids)
+
+def caught_up(version):
+    """Tells the tag index, if it's been built, that the changes since it last
+    caught up bring it to a new library version"""
+    if _index is not None:
+        _index.catch_up(version)
+
+def tag_added(level, entity_id, tag, user_id=None):
+    """Tells the tag index about a new tag, if it's been built. Pass the user
+    ID of a user's own tag, or None for a global tag."""
+    if _index is not None:
+        _index.add_tag(level, entity_id, tag, user_id)
+
+def tag_removed(level, entity_id, tag, user_id=None):
+    """Tells the tag index about a removed tag, if it's been built"""
+    if _index is not None:
+        _index.remove_tag(level, entity_id, tag, user_id)
+
+def tag_clause(column, expression, user_id=None):
+    """Builds a WHERE clause matching a column of track IDs against a tag
+    expression (see parse_expression())
+
+    :raises ValueError: If the expression can't be parsed
+    """
+    index = tag_index(library_version(data.session()))
+    return index.clause(column, index.match(expression, user_id))
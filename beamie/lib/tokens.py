@@ -1,12 +1,136 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import base64
+import hashlib
+import hmac
 import json
 import logging as log
 from time import time
 
+from copy import deepcopy
+
 from beamie import data
 from beamie.config import CONFIG
+from beamie.lib.cache import TTLCache
+from beamie.lib.roles import user_roles
+
+# Validated token data, keyed by token ID. Entries never outlive their token.
+# Each process has its own cache, so a token revoked through one process can
+# be honored by the others for up to 'ttl' seconds.
+TOKEN_CACHE = TTLCache(10000, 60, config_key='token_cache')
+
+# The revocation deny-list for signed tokens, reloaded from the database at most
+# every 'ttl' seconds. Holds a single entry: ( revoked token IDs, purge time ).
+DENY_LIST_CACHE = TTLCache(1, 60, config_key='token_cache', sized=False)
+
+# The TokenRevocation ID that revokes every signed token issued before it
+ALL_TOKENS = '*'
+
+def invalidate_user_tokens(user_id):
+    """Drops any cached token data for a user, such as when their roles change"""
+    return TOKEN_CACHE.pop_matching(
+        lambda token_data: token_data['user']['id'] == user_id)
+
+def signed_tokens_enabled():
+    """Returns True if Beamie is configured to issue signed tokens"""
+    return CONFIG.get('token_format', 'opaque') == 'signed'
+
+def token_secret():
+    secret = CONFIG.get('token_secret')
+    if not secret:
+        raise Exception("Signed tokens require a token_secret in the config file")
+    return str(secret)
+
+def encode_segment(value):
+    return base64.urlsafe_b64encode(value).rstrip('=')
+
+def decode_segment(segment):
+    return base64.urlsafe_b64decode(str(segment) + '=' * (-len(segment) % 4))
+
+def sign_token(claims):
+    """Serializes a dict of claims into a signed token string of the form
+    <base64 JSON claims>.<base64 HMAC-SHA256 of the claims segment>"""
+    body = encode_segment(json.dumps(claims, separators=(',', ':'), sort_keys=True))
+    signature = hmac.new(token_secret(), body, hashlib.sha256).digest()
+    return "%s.%s" % (body, encode_segment(signature))
+
+def read_signed_token(token):
+    """Returns the claims of a signed token if its signature is good, else None.
+    This doesn't check expiry or revocation."""
+    try:
+        body, _separator, signature = str(token).partition('.')
+    except UnicodeError:
+        # The tokens we sign are ASCII, so this one isn't ours
+        return None
+    if not body or not signature:
+        return None
+
+    expected = hmac.new(token_secret(), body, hashlib.sha256).digest()
+    try:
+        if not hmac.compare_digest(expected, decode_segment(signature)):
+            return None
+        claims = json.loads(decode_segment(body))
+    except (TypeError, ValueError):
+        return None
+
+    if not isinstance(claims, dict):
+        return None
+    return claims
+
+def deny_list():
+    """Gets the signed token deny-list as a tuple of the set of revoked token
+    IDs and the time of the last purge"""
+    cached = DENY_LIST_CACHE.get('deny')
+    if cached is not None:
+        return cached
+
+    session = data.session()
+    revoked = set()
+    purged = 0
+    for revocation in session.query(data.TokenRevocation).filter(
+            data.TokenRevocation.expiry >= int(time())):
+        if revocation.id == ALL_TOKENS:
+            purged = revocation.revoked
+        else:
+            revoked.add(revocation.id)
+
+    DENY_LIST_CACHE.set('deny', ( revoked, purged ))
+    return revoked, purged
+
+def revoke_signed_token(claims, session):
+    """Adds a signed token to the deny-list"""
+    session.merge(data.TokenRevocation(claims['jti'], int(time()), claims['exp']))
+    DENY_LIST_CACHE.clear()
+
+def validate_signed_token(token):
+    """Validates a signed token without a database lookup, save for the rare
+    deny-list reload. Returns values as do_validate_token() does."""
+    claims = read_signed_token(token)
+    if claims is None:
+        log.debug("Token has a bad signature or is not a signed token")
+        return None
+
+    if claims['exp'] <= int(time()):
+        log.debug("Signed token is expired: %s" % claims['jti'])
+        return False
+
+    revoked, purged = deny_list()
+    # Purge times are in whole seconds, like iat, so a token issued in the
+    # same second as a purge outlives it
+    if claims['jti'] in revoked or claims['iat'] < purged:
+        log.debug("Signed token has been revoked: %s" % claims['jti'])
+        return None
+
+    return {
+        'id' : token,
+        'expiry' : claims['exp'],
+        'user' : {
+            'id' : claims['uid'],
+            'username' : claims['usr'],
+            'roles' : claims['roles']
+        }
+    }
 
 def do_tidy_tokens():
     session = data.session()
@@ -17,8 +141,14 @@ def do_tidy_tokens():
     count = expired_tokens.count()
     expired_tokens.delete()
 
+    now = int(time())
+    session.query(data.TokenRevocation).filter(
+        data.TokenRevocation.expiry < now).delete()
+
     session.commit()
 
+    TOKEN_CACHE.pop_matching(lambda token_data: token_data['expiry'] < now)
+
     return count
 
 
@@ -29,17 +159,33 @@ def do_purge_tokens():
     count = to_delete.count()
     to_delete.delete()
 
+    # Signed tokens can't be deleted, so deny every one issued until now
+    if signed_tokens_enabled():
+        now = int(time())
+        session.merge(data.TokenRevocation(ALL_TOKENS, now,
+            now + CONFIG['token_expiry']))
+
     session.commit()
+    TOKEN_CACHE.clear()
+    DENY_LIST_CACHE.clear()
     return count
 
 def do_revoke_token(token_id):
+    TOKEN_CACHE.pop(token_id)
     session = data.session()
 
-    tokens = session.query(data.Token).filter_by(id=token_id)
-    if tokens.count() >= 1:
-        token = tokens.first()
-        log.debug("Found token: %s" % token)
-        session.delete(token)
+    if signed_tokens_enabled():
+        claims = read_signed_token(token_id)
+        if claims is not None:
+            log.debug("Revoking signed token: %s" % claims['jti'])
+            revoke_signed_token(claims, session)
+            session.commit()
+            return True
+
+    # Delete with a query rather than session.delete(), which would cascade to
+    # the token's user through the Token.user backref
+    if session.query(data.Token).filter_by(id=token_id).delete() >= 1:
+        log.debug("Revoked token: %s" % token_id)
         session.commit()
         return True
     else:
@@ -54,13 +200,27 @@ def do_validate_token(token_id):
         - The token is valid       - A JSON object describing the token
         - The token is expired     - False
         - The token doesn't exist  - None
+
+        Valid tokens are cached, so repeat validations skip the database.
+        Signed tokens are checked without the database at all.
     '''
+    if signed_tokens_enabled() and '.' in token_id:
+        return validate_signed_token(token_id)
+
+    cached = TOKEN_CACHE.get(token_id)
+    if cached is not None and cached['expiry'] > int(time()):
+        return deepcopy(cached)
+
     token_data = dict()
     session = data.session()
 
-    tokens = session.query(data.Token).filter_by(id=token_id)
-    if tokens.count() >= 1:
-        token = tokens.first()
+    # Fetch the token and its user's name together
+    row = session.query(data.Token, data.User.username).join(
+        data.User, data.Token.user_id == data.User.id
+    ).filter(data.Token.id == token_id).first()
+
+    if row is not None:
+        token, username = row
 
         log.debug("Token: %s" % token)
         log.debug("Current time: %i" % time())
@@ -69,16 +229,14 @@ def do_validate_token(token_id):
             token_data['id'] = token.id
             token_data['expiry'] = token.expiry
             token_data['user']  = {
-                'username' : token.user.username
+                'id' : token.user_id,
+                'username' : username,
+                'roles' : user_roles(token.user_id)
             }
 
-            memberships = session.query(data.RoleMembership).filter_by(
-                user_id=token.user.id)
-            token_data['user']['roles'] = [
-                role.role.name for role in memberships
-            ]
-
             log.debug("Token validated: %s" % token_id)
+            TOKEN_CACHE.set(token_id, deepcopy(token_data),
+                token.expiry - int(time()))
             return token_data
         else:
             log.debug("Token is expired; deleting: %s" % token_id)
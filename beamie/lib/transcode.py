@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Transcodes tracks with external encoders, streaming the output to the client
+while keeping a copy in an on-disk cache"""
+
+# Normal Python modules
+import hashlib
+import json
+import logging as log
+import os
+import subprocess
+import sys
+import tempfile
+
+from collections import namedtuple
+
+# Our private modules
+from beamie.config import CONFIG
+
+# An external encoder. The command is a list of arguments in which '{input}' is
+# replaced by the source file and '{bitrate}' by the bitrate in kbps; the
+# encoder must write its output to stdout.
+Encoder = namedtuple('Encoder', [ 'name', 'command', 'mimetype', 'default_bitrate', 'bitrates' ])
+
+# Encoders registered in code, which take precedence over configured ones
+ENCODERS = dict()
+
+TRANSCODE_DEFAULTS = {
+    'cache_dir' : './data/transcodes',
+    'cache_size' : 1073741824,   # Bytes of finished transcodes to keep
+    'chunk_size' : 65536         # Bytes read from the encoder at a time
+}
+
+def transcode_option(key):
+    """Gets a 'transcode' option from the config, falling back on its default"""
+    return (CONFIG.get('transcode') or {}).get(key, TRANSCODE_DEFAULTS[key])
+
+def register_encoder(name, command, mimetype, default_bitrate=None, bitrates=None):
+    """Makes an encoder available as a download format, replacing any encoder
+    of the same name from the config file
+
+    :param name: The format name clients ask for
+    :param command: The encoder's argument list
+    :param mimetype: The content type of the encoder's output
+    :param default_bitrate: The bitrate used when the client doesn't ask for one
+    :param bitrates: The bitrates clients may ask for; any bitrate if None
+    """
+    ENCODERS[name] = Encoder(name, list(command), mimetype, default_bitrate, bitrates)
+
+def get_encoder(name):
+    """Gets the named encoder, or None if there's no such encoder"""
+    if name in ENCODERS:
+        return ENCODERS[name]
+
+    encoders = (CONFIG.get('transcode') or {}).get('encoders') or {}
+    if name not in encoders:
+        return None
+
+    settings = encoders[name]
+    return Encoder(name, settings['command'], settings.get('mimetype', 'application/octet-stream'),
+        settings.get('default_bitrate'), settings.get('bitrates'))
+
+def cache_key(filename, encoder, bitrate):
+    """Names the cached output of encoding a file. The key covers the source
+    file's identity and state and everything about the encoding, so a changed
+    file or encoder never hits a stale entry."""
+    stat = os.stat(filename)
+    source = [ filename, stat.st_size, stat.st_mtime, stat.st_ino, stat.st_dev ]
+    settings = [ encoder.command, encoder.mimetype, bitrate ]
+    return hashlib.sha1(json.dumps([ source, settings ])).hexdigest()
+
+class TranscodeCache(object):
+    """A directory of finished transcodes, named by cache key, kept under a
+    size budget. Using a file bumps its mtime, and the files with the oldest
+    mtimes are evicted first."""
+
+    def __init__(self, path=None, max_size=None):
+        """Constructor
+
+        :param path: The cache directory
+        :param max_size: The most bytes of transcodes to keep
+        """
+        self.path = path or transcode_option('cache_dir')
+        self.max_size = max_size if max_size is not None else transcode_option('cache_size')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def lookup(self, key):
+        """Gets the path of a cached transcode, or None if it isn't cached"""
+        path = os.path.join(self.path, key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def writer(self):
+        """Opens a temporary file in the cache directory for a transcode in
+        progress; store() moves it into place once it's complete"""
+        fd, path = tempfile.mkstemp(dir=self.path, prefix='.partial-')
+        return os.fdopen(fd, 'wb'), path
+
+    def store(self, key, partial):
+        """Moves a complete transcode into the cache, then evicts old entries"""
+        os.rename(partial, os.path.join(self.path, key))
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used transcodes until the cache fits its
+        budget"""
+        entries = list()
+        total = 0
+        for name in os.listdir(self.path):
+            if name.startswith('.partial-'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append(( stat.st_mtime, stat.st_size, name ))
+            total += stat.st_size
+
+        entries.sort()
+        while total > self.max_size and len(entries) > 0:
+            _mtime, size, name = entries.pop(0)
+            log.debug("Evicting transcode %s" % name)
+            try:
+                os.remove(os.path.join(self.path, name))
+                total -= size
+            except OSError:
+                pass
+
+def encode(filename, encoder, bitrate, cache, key):
+    """Starts an encoder on a file, returning a generator of its output, which
+    yields chunks as the encoder produces them. The output is also written to
+    the cache, and kept once the encoder finishes successfully. If the client
+    goes away first, the encoder is stopped and the partial output thrown away.
+
+    :raises OSError: If the encoder can't be started
+    :raises IOError: If the encoder writes nothing, whether or not it fails
+    """
+    if isinstance(filename, unicode):
+        filename = filename.encode(sys.getfilesystemencoding() or 'utf-8')
+    command = [ str(arg).replace('{input}', filename).replace('{bitrate}', str(bitrate))
+        for arg in encoder.command ]
+    log.debug("Transcoding with: %s" % command)
+
+    chunk_size = transcode_option('chunk_size')
+    out, partial = cache.writer()
+    try:
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+        # Wait for the first chunk here, so an encoder that fails outright
+        # fails the request instead of sending an empty body. An encoder that
+        # writes nothing has failed too, even if it exits cleanly, and its
+        # empty output mustn't be cached.
+        first = proc.stdout.read(chunk_size)
+        if not first:
+            raise IOError("Encoder %s wrote nothing and exited with status %i" % (
+                encoder.name, proc.wait()))
+    except (IOError, OSError):
+        out.close()
+        os.remove(partial)
+        raise
+
+    def stream():
+        complete = False
+        try:
+            chunk = first
+            while chunk:
+                out.write(chunk)
+                yield chunk
+                chunk = proc.stdout.read(chunk_size)
+
+            complete = proc.wait() == 0
+            if not complete:
+                log.warning("Encoder %s failed on %s with status %i" % (
+                    encoder.name, filename, proc.returncode))
+        finally:
+            out.close()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+            if complete:
+                cache.store(key, partial)
+            else:
+                os.remove(partial)
+
+    return stream()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""The library version, a number kept in the database that goes up whenever
+the catalog of artists, albums and tracks changes. Anything derived from the
+catalog can be labelled with the version it was derived at, and is out of date
+once the version has moved on, whichever process moved it. That makes it the
+basis of the catalog listings' ETags, and of the query, shuffle and tag index
+caches noticing changes made by other processes."""
+
+# Normal Python modules
+import hashlib
+import json
+
+# Our private modules
+from beamie import data
+
+# The ID of the library version's row
+VERSION_ROW = 1
+
+def library_version(conn):
+    """Gets the library version, or 0 if the catalog has never changed
+
+    :param conn: A session or connection
+    """
+    version = conn.execute(data.LibraryVersion.__table__.select().where(
+        data.LibraryVersion.id == VERSION_ROW)).first()
+    if version is None:
+        return 0
+    return version['version']
+
+def bump_library_version(conn):
+    """Moves the library version on by one, in the caller's transaction, so
+    that it commits along with the changes to the catalog. Everything that
+    changes the catalog should call this.
+
+    :param conn: A session or connection
+    :returns: The new version
+    """
+    table = data.LibraryVersion.__table__
+    bumped = conn.execute(table.update().where(table.c.id == VERSION_ROW).values(
+        version=table.c.version + 1))
+    if bumped.rowcount == 0:
+        conn.execute(table.insert(), { 'id' : VERSION_ROW, 'version' : 1 })
+    return library_version(conn)
+
+def catalog_etag(version, *parts):
+    """Builds a strong ETag for a response derived from the catalog at a given
+    version, along with whatever else the response depends on, such as the
+    request's path and arguments"""
+    return hashlib.sha1(json.dumps([ version ] + list(parts), sort_keys=True)).hexdigest()
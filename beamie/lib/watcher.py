@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Watches the media paths and applies changes to the library as they happen,
+without waiting for a full scan"""
+
+# Normal Python modules
+import logging as log
+import os
+import threading
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# Our private modules
+from beamie import data
+from beamie.config import CONFIG
+from beamie.lib.mediascanner import MediaScanner, fingerprint
+from beamie.lib.reconciler import LibraryReconciler, unicode_filename
+
+WATCH_DEFAULTS = {
+    'backend' : 'auto',     # 'inotify', 'poll', or 'auto' to use inotify if we can
+    'debounce' : 2,         # Seconds without changes before a batch is applied
+    'max_batch' : 1000,     # Apply a batch once this many paths have changed
+    'poll_interval' : 30    # Seconds between polls when inotify isn't used
+}
+
+def watch_option(key):
+    """Gets a 'watch' option from the config, falling back on its default"""
+    return (CONFIG.get('watch') or {}).get(key, WATCH_DEFAULTS[key])
+
+def collapse(paths):
+    """Drops every path that lies under another path in the list"""
+    kept = list()
+    for path in sorted(set(paths)):
+        if len(kept) > 0 and path.startswith(kept[-1].rstrip('/') + '/'):
+            continue
+        kept.append(path)
+    return kept
+
+class LibraryWatcher(object):
+    """Collects the paths that change under the media paths, and once they've
+    been quiet for a moment, rescans and reconciles just those paths. Changes
+    are seen through inotify when pyinotify is installed, or else by polling
+    file fingerprints."""
+
+    def __init__(self, paths):
+        """Constructor
+
+        :param paths: The media paths to watch
+        """
+        self.paths = [ unicode_filename(os.path.abspath(p)) for p in paths ]
+        self.debounce = watch_option('debounce')
+        self.max_batch = watch_option('max_batch')
+        self.poll_interval = watch_option('poll_interval')
+        self.pending = dict()
+        self.stopping = threading.Event()
+
+        self.backend = watch_option('backend')
+        if self.backend == 'auto':
+            self.backend = 'poll' if pyinotify is None else 'inotify'
+        if self.backend not in [ 'inotify', 'poll' ]:
+            raise Exception("Unknown watch backend: %s" % self.backend)
+        if self.backend == 'inotify' and pyinotify is None:
+            raise Exception("The inotify watch backend requires pyinotify")
+
+    def run(self):
+        """Watches until stop() is called"""
+        log.info("Watching %s for changes with %s" % (", ".join(self.paths), self.backend))
+        if self.backend == 'inotify':
+            self.run_inotify()
+        else:
+            self.run_poll()
+
+    def stop(self):
+        """Asks a running watcher to stop"""
+        self.stopping.set()
+
+    def queue(self, path):
+        """Notes that a path has changed"""
+        log.debug("Changed: %s" % path)
+        self.pending[unicode_filename(path)] = time.time()
+
+    def flush(self, force=False):
+        """Applies the pending changes once none have arrived for the debounce
+        period, or straight away if there are enough of them or force is set"""
+        if len(self.pending) == 0:
+            return
+
+        quiet = time.time() - max(self.pending.values()) >= self.debounce
+        if force or quiet or len(self.pending) >= self.max_batch:
+            paths = collapse(self.pending.keys())
+            self.pending = dict()
+            self.apply(paths)
+
+    def apply(self, paths):
+        """Rescans the given paths and reconciles them with the database. Paths
+        that no longer exist have their tracks removed. If that fails, the
+        paths are queued again."""
+        log.info("Applying changes to %i paths" % len(paths))
+        try:
+            reconciler = LibraryReconciler(data.session(), scope=paths)
+            scanner = MediaScanner(paths)
+            scanner.scan_files(reconciler.fingerprints())
+            outcome = reconciler.reconcile(scanner.tags, scanner.unchanged)
+
+            log.info("Watch found %i new tracks, %i changed and %i removed" % (
+                len(outcome['discoveries']['tracks']),
+                len(outcome['updates']),
+                len(outcome['orphans'])))
+            for error in scanner.errors:
+                log.warning("Could not read %s: %s" % (error['filename'], error['error']))
+        except Exception, e:
+            # One bad batch shouldn't stop the watcher, or lose its changes
+            # until the next full scan, so its paths are tried again
+            log.exception("Could not apply changes to %i paths, will retry: %s" % (
+                len(paths), e))
+            for path in paths:
+                self.pending.setdefault(path, time.time())
+        finally:
+            data.remove_session()
+
+    def run_inotify(self):
+        """Queues paths as inotify reports changes to them. New directories are
+        watched as they appear, and queued themselves in case files landed in
+        them before their watch was added."""
+        mask = pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_DELETE | \
+            pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+        watcher = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                # A file's creation is followed by its close_write
+                if event.mask & pyinotify.IN_CREATE and not event.dir:
+                    return
+                watcher.queue(event.pathname)
+
+        manager = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(manager, Handler())
+        for path in self.paths:
+            manager.add_watch(path, mask, rec=True, auto_add=True)
+
+        try:
+            while not self.stopping.is_set():
+                # Wake up at least once per debounce period to flush batches
+                if notifier.check_events(int(self.debounce * 1000)):
+                    notifier.read_events()
+                    notifier.process_events()
+                self.flush()
+        finally:
+            notifier.stop()
+
+    def run_poll(self):
+        """Queues paths whose fingerprints changed, appeared or disappeared
+        between walks of the media paths"""
+        snapshot = self.snapshot()
+        while not self.stopping.wait(self.poll_interval):
+            current = self.snapshot()
+            for path in set(snapshot.keys()).symmetric_difference(current.keys()):
+                self.queue(path)
+            for path, stamp in current.items():
+                if path in snapshot and snapshot[path] != stamp:
+                    self.queue(path)
+            snapshot = current
+
+            # A poll already spans the debounce period
+            self.flush(force=True)
+
+    def snapshot(self):
+        """Fingerprints every allowed file under the media paths"""
+        fingerprints = dict()
+        for f in MediaScanner(self.paths).find_files(self.paths):
+            try:
+                fingerprints[unicode_filename(f)] = fingerprint(os.stat(f))
+            except (OSError, UnicodeDecodeError), e:
+                log.debug("Could not stat %s: %s" % (f, e))
+        return fingerprints
+
+def start_watcher(paths):
+    """Starts a watcher in a background thread, returning it"""
+    watcher = LibraryWatcher(paths)
+    thread = threading.Thread(target=watcher.run, name="beamie-watcher")
+    thread.daemon = True
+    thread.start()
+    return watcher
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Versioned schema migrations for Beamie databases
+
+Each migration brings a live database from the previous schema version to its
+own without touching existing data. Migrations must be safe to run against a
+database that already has their changes, since a freshly constructed database
+gets the current models' full schema and then has every migration run when it
+is stamped.
+"""
+
+# Imports
+import logging as log
+
+from time import time
+
+from sqlalchemy import inspect, Index, MetaData, Table
+from sqlalchemy.schema import CreateColumn
+
+import data
+
+from beamie.lib import search, version
+
+
+# Helpers for writing migrations
+def create_table(conn, model):
+    """Creates the table for a mapped class, along with its indexes, unless it
+    already exists"""
+    if conn.dialect.has_table(conn, model.__tablename__):
+        log.debug("Table %s already exists" % model.__tablename__)
+        return False
+
+    model.__table__.create(conn)
+    log.info("Created table %s" % model.__tablename__)
+    return True
+
+def add_column(conn, model, column_name):
+    """Adds a mapped class's column to its existing table unless it's already
+    there. The column must be nullable, since existing rows get no value."""
+    table_name = model.__tablename__
+    existing = [ column['name'] for column in inspect(conn).get_columns(table_name) ]
+    if column_name in existing:
+        log.debug("Column %s.%s already exists" % (table_name, column_name))
+        return False
+
+    column = model.__table__.c[column_name]
+    conn.execute("ALTER TABLE %s ADD COLUMN %s" % (
+        conn.dialect.identifier_preparer.format_table(model.__table__),
+        CreateColumn(column).compile(dialect=conn.dialect)
+    ))
+    log.info("Added column %s.%s" % (table_name, column_name))
+    return True
+
+def create_index(conn, table_name, columns, name=None):
+    """Creates an index on the given columns unless it already exists. Index
+    names follow SQLAlchemy's default 'ix_<table>_<column>' convention, so they
+    match the ones create_all() makes for columns declared with index=True."""
+    if name is None:
+        name = "ix_%s_%s" % (table_name, "_".join(columns))
+
+    existing = [ index['name'] for index in inspect(conn).get_indexes(table_name) ]
+    if name in existing:
+        log.debug("Index %s already exists" % name)
+        return False
+
+    table = Table(table_name, MetaData(), autoload=True, autoload_with=conn)
+    Index(name, *[ table.c[column] for column in columns ]).create(conn)
+    log.info("Created index %s" % name)
+    return True
+
+
+# Migrations
+SECONDARY_INDEXES = [
+    ( 'album', 'artist' ),
+    ( 'album', 'name' ),
+    ( 'album_tag', 'album' ),
+    ( 'album_tag', 'tag' ),
+    ( 'album_tag', 'user' ),
+    ( 'artist_tag', 'artist' ),
+    ( 'artist_tag', 'tag' ),
+    ( 'artist_tag', 'user' ),
+    ( 'role_membership', 'user' ),
+    ( 'token', 'expiry' ),
+    ( 'token', 'user' ),
+    ( 'track', 'album' ),
+    ( 'track_tag', 'tag' ),
+    ( 'track_tag', 'track' ),
+    ( 'track_tag', 'user' )
+]
+
+def add_secondary_indexes(conn):
+    """Indexes the columns that scans, token checks and library filters use"""
+    for table_name, column in SECONDARY_INDEXES:
+        create_index(conn, table_name, [ column ])
+
+
+def add_token_revocations(conn):
+    """Adds the deny-list for revoked signed tokens"""
+    create_table(conn, data.TokenRevocation)
+
+def add_track_fingerprints(conn):
+    """Adds the file fingerprints that let rescans skip unchanged files"""
+    for column_name in [ 'size', 'mtime', 'inode', 'device' ]:
+        add_column(conn, data.Track, column_name)
+
+def add_search_index(conn):
+    """Adds the name search index and fills it from the existing library"""
+    create_table(conn, data.SearchTrigram)
+    search.create_search_index(conn)
+    search.rebuild_index(conn)
+
+def add_playlist_indexes(conn):
+    """Indexes playlists by owner, and their entries by position"""
+    create_index(conn, 'playlist', [ 'user' ])
+    create_index(conn, 'playlist_track', [ 'playlist', 'sequence' ])
+
+def add_library_version(conn):
+    """Adds the library version that scans bump and catalog ETags are built on"""
+    create_table(conn, data.LibraryVersion)
+    if conn.execute(data.LibraryVersion.__table__.select()).first() is None:
+        conn.execute(data.LibraryVersion.__table__.insert(), {
+            'id' : version.VERSION_ROW,
+            'version' : 0
+        })
+
+
+# Every migration, in order: ( version, description, function )
+MIGRATIONS = [
+    ( 1, "Add secondary indexes", add_secondary_indexes ),
+    ( 2, "Add signed token revocations", add_token_revocations ),
+    ( 3, "Add track file fingerprints", add_track_fingerprints ),
+    ( 4, "Add search index", add_search_index ),
+    ( 5, "Add playlist indexes", add_playlist_indexes ),
+    ( 6, "Add library version", add_library_version )
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    """Gets the schema version of a database; 0 if it has never been stamped"""
+    if not conn.dialect.has_table(conn, data.SchemaVersion.__tablename__):
+        return 0
+
+    version = conn.execute(
+        data.SchemaVersion.__table__.select().order_by(
+            data.SchemaVersion.version.desc()).limit(1)
+    ).first()
+
+    if version is None:
+        return 0
+    return version['version']
+
+def record_version(conn, version):
+    """Notes in the database that a migration has been applied"""
+    conn.execute(data.SchemaVersion.__table__.insert(), {
+        'version' : version,
+        'applied' : int(time())
+    })
+
+def stamp(db_string=None):
+    """Marks a freshly constructed database as being at the latest version.
+    Every migration is run first, for the sake of anything the models don't
+    describe, such as the SQLite search index."""
+    with data.engine(db_string).begin() as conn:
+        data.SchemaVersion.__table__.create(conn, checkfirst=True)
+        for version, _description, migration in MIGRATIONS:
+            if version > current_version(conn):
+                migration(conn)
+                record_version(conn, version)
+
+def upgrade(db_string=None):
+    """Applies every migration newer than the database's schema version, each in
+    its own transaction. Returns the list of versions applied."""
+    eng = data.engine(db_string)
+    applied = list()
+
+    with eng.begin() as conn:
+        data.SchemaVersion.__table__.create(conn, checkfirst=True)
+
+    for version, description, migration in MIGRATIONS:
+        with eng.begin() as conn:
+            if version <= current_version(conn):
+                continue
+
+            log.info("Applying migration %i: %s" % (version, description))
+            migration(conn)
+            record_version(conn, version)
+            applied.append(version)
+
+    return applied
@@ -5,13 +5,76 @@
 import flask
 import json
 import logging as log
+import mimetypes
 import os
 
+from sqlalchemy.orm import contains_eager
+
 # Local imports
 from beamie import app, data, shared
 from beamie.config import CONFIG
+from beamie.lib import jobs, search, shuffle, tagindex, transcode
 from beamie.lib.auth import Authenticated
-from beamie.lib.mediascanner import MediaScanner
+from beamie.lib.paging import decode_cursor, encode_cursor, keyset_page, page_limit, \
+    paged_response, PAGING_ARGS
+from beamie.lib.version import catalog_etag, library_version
+
+# Listings are ordered by these keys; the trailing id makes each position unique
+# so the listings can be paged through with a cursor
+ARTIST_ORDER = [ data.Artist.name, data.Artist.id ]
+ALBUM_ORDER = [ data.Album.name, data.Album.id ]
+TRACK_ORDER = [ data.Track.number, data.Track.id ]
+
+# Content types of the media formats Beamie knows how to serve
+MEDIA_TYPES = {
+    'flac' : 'audio/flac',
+    'm4a' : 'audio/mp4',
+    'mp3' : 'audio/mpeg',
+    'mp4' : 'audio/mp4',
+    'oga' : 'audio/ogg',
+    'ogg' : 'audio/ogg',
+    'opus' : 'audio/ogg',
+    'wav' : 'audio/wav'
+}
+
+def media_type(filename):
+    """Gets the content type of a media file from its extension"""
+    extension = os.path.splitext(filename)[1].lstrip('.').lower()
+    if extension in MEDIA_TYPES:
+        return MEDIA_TYPES[extension]
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+def track_info(track):
+    """Describes a track, whose album and artist are loaded, as a dict"""
+    return {
+        "id" : track.id,
+        "album_id" : track.album.id,
+        "album" : track.album.name,
+        "artist_id" : track.album.artist.id,
+        "artist" : track.album.artist.name,
+        "name" : track.name,
+        "number" : track.number,
+        "filename" : track.filename
+    }
+
+def tracks_by_id(ids):
+    """Describes the tracks with the given IDs as dicts, in the order given,
+    skipping any that no longer exist"""
+    session = data.session()
+    tracks = dict()
+    for chunk in data.chunks(ids):
+        tracks.update([ ( track.id, track ) for track in
+            session.query(data.Track).join(data.Track.album).join(data.Album.artist).options(
+                contains_eager(data.Track.album).contains_eager(data.Album.artist)).filter(
+                data.Track.id.in_(chunk)) ])
+
+    return [ track_info(tracks[track_id]) for track_id in ids if track_id in tracks ]
+
+def not_modified(etag):
+    """Builds a 304 response telling the client its copy is still current"""
+    resp = flask.make_response('', 304)
+    resp.set_etag(etag)
+    return resp
 
 ##### ROUTE DEFINITIONS #####
 
@@ -20,25 +83,35 @@ from beamie.lib.mediascanner import MediaScanner
 def scan():
     return scan()
 
+# GET /scan/<job_id> -- Check on a scan job
+@app.route('/scan/<job_id>', methods=[ 'GET' ])
+def get_scan(job_id):
+    return get_scan(job_id)
+
+# GET /search?q=<terms> -- Find artists, albums and tracks by name
+@app.route('/search', methods=[ 'GET' ])
+def search_library():
+    return search_library()
+
 # GET /tracks
 @app.route('/tracks', methods=[ 'GET' ])
 def tracks():
     req = flask.request
+    if 'shuffle' in req.args:
+        return shuffle_tracks(req.args)
 
-    tracks = [ { "id" : item.id,
-                 "album_id" : item.album.id,
-                 "album" : item.album.name,
-                 "artist_id" : item.album.artist.id,
-                 "artist" : item.album.artist.name,
-                 "name" : item.name,
-                 "number" : item.number,
-                 "filename" : item.filename
-               } for item in get_tracks(req.args) ]
+    etag = listing_etag(req)
+    if req.if_none_match.contains_weak(etag):
+        return not_modified(etag)
 
-    log.debug("Tracks: %s; Type: %s" % ( tracks, type(tracks)))
+    page, next_cursor = keyset_page(get_tracks(req.args), TRACK_ORDER, req.args)
 
-    resp = flask.make_response(json.dumps(tracks))
-    resp.headers['Content-Type'] = 'application/json'
+    tracks = [ track_info(item) for item in page ]
+
+    log.debug("Found %i tracks", len(tracks))
+
+    resp = paged_response(tracks, next_cursor)
+    resp.set_etag(etag)
     return resp
 
 # GET /tracks/<track_id>
@@ -46,54 +119,63 @@ def tracks():
 def get_track(track_id):
     track = get_tracks({ "id" : track_id }).first()
     log.debug("Track: %s" % track)
-    resp = flask.make_response(json.dumps({
-        "id" : track.id,
-        "album_id" : track.album.id,
-        "album" : track.album.name,
-        "artist_id" : track.album.artist.id,
-        "artist" : track.album.artist.name,
-        "name" : track.name,
-        "number" : track.number,
-        "filename" : track.filename
-    }))
+
+    if track is None:
+        log.debug("No tracks with ID %i" % track_id)
+        flask.abort(404)
+
+    resp = flask.make_response(json.dumps(track_info(track)))
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
 # GET /tracks/<track_id>/download
 @app.route('/tracks/<int:track_id>/download', methods=[ 'GET' ])
 def download_track(track_id):
-    tracks = get_tracks({ "id" : track_id })
+    track = get_tracks({ "id" : track_id }).first()
 
-    if tracks.count() == 0:
+    if track is None:
         log.debug("No tracks with ID %i" % track_id)
         flask.abort(404)
     else:
-        filename = tracks.first().filename
+        filename = track.filename
+
+        if 'format' in flask.request.args:
+            return transcoded_download(filename, flask.request.args)
 
         try:
-            resp = flask.make_response(open(filename, 'r').read())
-            if filename.endswith('.mp3'):
-                resp.headers['Content-Type'] = 'audio/mpeg3'
-            else:
-                resp.headers['Content-Type'] = 'application/octet-stream'
-            return resp
-        except IOError:
+            # send_file streams the file (zero-copy when the WSGI server offers
+            # a file wrapper), and with conditional set, answers Range,
+            # If-None-Match and If-Modified-Since requests itself
+            resp = flask.send_file(filename, mimetype=media_type(filename),
+                conditional=True)
+        except (IOError, OSError):
             log.warning("Could not read file %s" % filename)
             flask.abort(500)
 
+        # Downloads need a token, so keep them out of shared caches
+        resp.cache_control.public = False
+        resp.cache_control.private = True
+        resp.headers.setdefault('Accept-Ranges', 'bytes')
+        return resp
+
 # GET /albums
 @app.route('/albums', methods=[ 'GET' ])
 def albums():
     req = flask.request
+    etag = listing_etag(req)
+    if req.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    page, next_cursor = keyset_page(get_albums(req.args), ALBUM_ORDER, req.args)
 
     albums = [ { "id" : album.id,
                  "artist" : album.artist.name,
                  "artist_id" : album.artist.id,
                  "name" : album.name
-               } for album in get_albums(req.args) ]
+               } for album in page ]
 
-    resp = flask.make_response(json.dumps(albums))
-    resp.headers['Content-Type'] = 'application/json'
+    resp = paged_response(albums, next_cursor)
+    resp.set_etag(etag)
     return resp
 
 # GET /albums/<album_id>
@@ -106,7 +188,7 @@ def get_album(album_id):
                } for album in get_albums({ "id" : album_id }) ]
 
     if len(albums) == 0:
-        log.debug("No albums with ID %i" % track_id)
+        log.debug("No albums with ID %i" % album_id)
         flask.abort(404)
     else:
         resp = flask.make_response(json.dumps(albums[0]))
@@ -117,24 +199,27 @@ def get_album(album_id):
 @app.route('/artists', methods=[ 'GET' ])
 def artists():
     req = flask.request
+    etag = listing_etag(req)
+    if req.if_none_match.contains_weak(etag):
+        return not_modified(etag)
 
-    artists = [ { "id" : artist.id, "name" : artist.name }
-        for artist in get_artists(req.args) ]
+    page, next_cursor = keyset_page(get_artists(req.args), ARTIST_ORDER, req.args)
 
-    resp = flask.make_response(json.dumps(artists))
-    resp.headers['Content-Type'] = 'application/json'
+    artists = [ { "id" : artist.id, "name" : artist.name } for artist in page ]
+
+    resp = paged_response(artists, next_cursor)
+    resp.set_etag(etag)
     return resp
 
 # GET /artists/<artist_id>
 @app.route('/artists/<int:artist_id>', methods=[ 'GET' ])
 def get_artist(artist_id):
-    artists = get_artists({ "id" : artist_id })
+    artist = get_artists({ "id" : artist_id }).first()
 
-    if artists.count() == 0:
-        log.debug("No artists with ID %i" % track_id)
+    if artist is None:
+        log.debug("No artists with ID %i" % artist_id)
         flask.abort(404)
     else:
-        artist = artists.first()
         artist_obj = { "id" : artist.id, "name" : artist.name }
         resp = flask.make_response(json.dumps(artist_obj))
         resp.headers['Content-Type'] = 'application/json'
@@ -146,152 +231,117 @@ def get_artist(artist_id):
 
 @Authenticated(['contributor', 'administrator'])
 def scan():
-    outcome = {
-        "orphans" : list(),
-        "discoveries" : {
-            "artists" : list(),
-            "albums" : list(),
-            "tracks" : list()
-        }
-    }
+    job = jobs.start_scan(CONFIG['media_paths'])
 
-    scanner = MediaScanner(CONFIG['media_paths'])
-    scanner.files = scanner.find_files(CONFIG['media_paths'])
-    scanner.scan_files()
+    resp = flask.make_response(json.dumps(job.status()), 202)
+    resp.headers['Content-Type'] = 'application/json'
+    resp.headers['Location'] = flask.url_for('get_scan', job_id=job.id)
+    return resp
 
-    # Connect to the database
-    session = data.session(CONFIG['sqlite_db'])
+@Authenticated(['contributor', 'administrator'])
+def get_scan(job_id):
+    job = jobs.get_scan(job_id)
 
-    # Are there any entries in the database that don't exist on disk anymore?
-    tracks = session.query(data.Track)
+    if job is None:
+        log.debug("No scan job with ID %s" % job_id)
+        flask.abort(404)
 
-    for track in tracks:
-        try:
-            os.stat(track.filename)
-        except OSError, e:
-            session.delete(track)
-            outcome['orphans'].append({
-                "id" : track.id,
-                "number" : track.number,
-                "name" : track.name,
-                "album" : track.album.name,
-                "artist" : track.album.artist.name,
-                "filename" : track.filename
-            })
-            log.debug("Found an orphaned reference to %s" % track.filename)
-
-    session.commit()
-
-    # Init
-    artists_to_add = list()
-    albums_to_add = list()
-    tracks_to_add = list()
-
-    # Scan for uncreated artists and create them
-    for tag in scanner.tags:
-        artist = u''.join(tag.tag['artist'])
-        artists = session.query(data.Artist).filter_by(
-            name=artist
-            )
-        if artists.count() == 0:
-            if artist not in artists_to_add:
-                log.debug("Found artist: %s" % artist)
-                artists_to_add.append(artist)
-            else:
-                log.debug("Artist %s already found" % artist)
-        else:
-            log.debug('Artist exists: %s' % artist)
+    resp = flask.make_response(json.dumps(job.status()))
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
 
-    if len(artists_to_add) > 0:
-        log.debug('Adding artists:')
-        for artist in artists_to_add:
-            log.debug('  - %s' % artist)
-        outcome['discoveries']['artists'] = artists_to_add
-    else:
-        log.debug("No new artists to add")
-
-    session.add_all([ data.Artist(name=artist) for artist in artists_to_add if artist is not None ])
-    session.commit()
-
-    # Scan for uncreated albums and create them
-    for tag in scanner.tags:
-        album = u''.join(tag.tag['album'])
-        artist = u''.join(tag.tag['artist'])
-        albums = session.query(data.Album).filter_by(name=album)
-        if albums.count() == 0:
-            if album not in [ a['name'] for a in albums_to_add ]:
-                log.debug("Found album: %s" % album)
-                artists = session.query(data.Artist).filter_by(name=artist)
-                if artists.count() == 0:
-                    log.debug("This should never happen, but an Album, '%s', exists for Artist '%s', that doesn't" % (
-                        album, artist))
-                else:
-                    albums_to_add.append({
-                        'name': album,
-                        'artist': artists.first().id
-                        })
-            else:
-                log.debug("Album %s already found" % album)
+def transcoded_download(filename, args):
+    """Sends a track in another format, from the transcode cache if it's been
+    transcoded this way before, or else streamed from the encoder as it runs"""
+    encoder = transcode.get_encoder(args['format'])
+    if encoder is None:
+        log.debug("No encoder for format %s" % args['format'])
+        flask.abort(400)
+
+    try:
+        bitrate = int(args.get('bitrate', encoder.default_bitrate or 0))
+    except ValueError:
+        flask.abort(400)
+    if encoder.bitrates is not None and bitrate not in encoder.bitrates:
+        log.debug("Encoder %s doesn't offer bitrate %i" % (encoder.name, bitrate))
+        flask.abort(400)
+
+    try:
+        cache = transcode.TranscodeCache()
+        key = transcode.cache_key(filename, encoder, bitrate)
+        cached = cache.lookup(key)
+        if cached is not None:
+            resp = flask.send_file(cached, mimetype=encoder.mimetype, conditional=True)
+            resp.headers['X-Transcode-Cache'] = 'hit'
+            resp.headers.setdefault('Accept-Ranges', 'bytes')
         else:
-            log.debug('Album exists: %s' % album)
-    if len(albums_to_add) > 0:
-        log.debug('Adding albums:')
-        for album in albums_to_add:
-            log.debug('  - %s' % album['name'])
-        outcome['discoveries']['albums'] = albums_to_add
-    else:
-        log.debug("No new albums to add")
-
-    session.add_all([ data.Album(
-        name=album['name'], artist_id=album['artist']
-        ) for album in albums_to_add if album is not None ])
-    session.commit()
-
-    # Scan for track info to add or update
-    for tag in scanner.tags:
-        title = u''.join(tag.tag['title'])
-        album = u''.join(tag.tag['album'])
-        number = int(u''.join(tag.tag['tracknumber']))
-        filename = u''.join(tag.filename)
-
-        result = session.query(data.Track).filter_by(
-            filename=filename
-        )
-        if result.count() == 0:
-            result = session.query(data.Album).filter_by(
-                name=album
-            )
-            if result.count() > 0:
-                tracks_to_add.append({
-                    'filename': filename,
-                    'name': title,
-                    'album': result.first().id,
-                    'number': number
-                })
-            else:
-                log.debug("A track exists for an album that doesn't: %s"
-                    % album)
-        else:
-            log.debug("Track exists: %s" % title)
+            resp = flask.Response(transcode.encode(filename, encoder, bitrate, cache, key),
+                mimetype=encoder.mimetype)
+            resp.headers['X-Transcode-Cache'] = 'miss'
+    except (IOError, OSError), e:
+        log.warning("Could not transcode file %s: %s" % (filename, e))
+        flask.abort(500)
+
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    return resp
 
-    if len(tracks_to_add) > 0:
-        log.debug('Adding tracks:')
-        for track in tracks_to_add:
-            log.debug('  - %s' % track['name'])
-        outcome['discoveries']['tracks'] = tracks_to_add
-    else:
-        log.debug("No new tracks to add")
+@Authenticated(['listener'])
+def search_library():
+    req = flask.request
+    if not req.args.get('q'):
+        flask.abort(400)
+
+    hits = search.search(data.session().connection(), req.args['q'])
+    limit = page_limit(req.args)
+
+    # Hits are ranked afresh for each page, so a cursor holds the sort key of
+    # the last hit on the previous page
+    if 'after' in req.args:
+        after = decode_cursor(req.args['after'])
+        if len(after) != 3 or after[1] not in search.KIND_ORDER:
+            flask.abort(400)
+        position = search.hit_key(after)
+        hits = [ hit for hit in hits if search.hit_key(hit) > position ]
+
+    next_cursor = None
+    if len(hits) > limit:
+        hits = hits[:limit]
+        next_cursor = encode_cursor(list(hits[-1][:3]))
+
+    return paged_response([ {
+        "type" : kind,
+        "id" : entity_id,
+        "name" : name,
+        "score" : score
+    } for score, kind, entity_id, name in hits ], next_cursor)
 
-    session.add_all([ data.Track(
-        filename=track['filename'],
-        name=track['name'],
-        album_id=track['album'],
-        number=track['number']
-        ) for track in tracks_to_add if track is not None ])
-    session.commit()
-    session.close()
+@Authenticated(['listener'])
+def listing_etag(req):
+    """Builds the ETag of a catalog listing out of the library version and
+    everything else the listing depends on: its path and arguments, its page
+    size, and the user, whose own tags the 'tags' filter sees. The version is
+    read before the listing, so a scan finishing in between can only make the
+    ETag older than the listing, never newer."""
+    return catalog_etag(library_version(data.session()), req.path,
+        sorted(req.args.items()), page_limit(req.args), shared.request_user_id(req))
 
-    return json.dumps(outcome)
+@Authenticated(['listener'])
+def shuffle_tracks(args):
+    # The filters are what's being shuffled, so they identify the cached order,
+    # along with the user, whose own tags the 'tags' filter sees
+    source = ( 'tracks', shared.request_user_id(flask.request),
+        tuple(sorted([ ( key, value ) for key, value in args.items()
+            if key not in PAGING_ARGS and key not in shuffle.SHUFFLE_ARGS ])) )
+
+    def load_rows():
+        return get_tracks(args).with_entities(data.Track.id, data.Artist.id).all()
+
+    ids, next_cursor, seed = shuffle.shuffle_page(source, load_rows, args)
+
+    resp = paged_response(tracks_by_id(ids), next_cursor)
+    resp.headers['X-Shuffle-Seed'] = str(seed)
+    return resp
 
 @Authenticated(['listener'])
 def get_artists(filters={}):
@@ -303,12 +353,12 @@ def get_artists(filters={}):
             artists = artists.filter_by(id=filters[f])
         elif f == "name":
             artists = artists.filter(data.Artist.name.like("%%%s%%" % filters[f]))
+        elif f in PAGING_ARGS or f in shuffle.SHUFFLE_ARGS:
+            continue
         else:
             log.debug("Unknown filter: %s" % f)
 
-    artists = artists.order_by(data.Artist.name)
-
-    session.close()
+    artists = artists.order_by(*ARTIST_ORDER)
 
     return artists
 
@@ -316,7 +366,9 @@ def get_artists(filters={}):
 @Authenticated(['listener'])
 def get_albums(filters={}):
     session = data.session()
-    albums = session.query(data.Album).join(data.Album.artist)
+    # Load each album's artist from the same join the filters use
+    albums = session.query(data.Album).join(data.Album.artist).options(
+        contains_eager(data.Album.artist))
 
     for f in filters:
         if f == "id":
@@ -325,19 +377,22 @@ def get_albums(filters={}):
             albums = albums.filter(data.Album.name.like("%%%s%%" % filters[f]))
         elif f == "artist":
             albums = albums.filter(data.Artist.name.like("%%%s%%" % filters[f]))
+        elif f in PAGING_ARGS or f in shuffle.SHUFFLE_ARGS:
+            continue
         else:
             log.debug("Unknown filter: %s" % f)
 
-    albums = albums.order_by(data.Album.name)
-
-    session.close()
+    albums = albums.order_by(*ALBUM_ORDER)
 
     return albums
 
 @Authenticated(['listener'])
 def get_tracks(filters={}):
     session = data.session()
-    tracks = session.query(data.Track).join(data.Track.album).join(data.Album.artist)
+    # Load each track's album and artist from the same joins the filters use
+    tracks = session.query(data.Track).join(data.Track.album).join(
+        data.Album.artist).options(
+            contains_eager(data.Track.album).contains_eager(data.Album.artist))
 
     for f in filters:
         if f == "id":
@@ -354,12 +409,18 @@ def get_tracks(filters={}):
             tracks = tracks.filter(data.Track.number == filters[f])
         elif f == "name":
             tracks = tracks.filter(data.Track.name.like("%%%s%%" % filters[f]))
+        elif f == "tags":
+            try:
+                tracks = tracks.filter(tagindex.tag_clause(data.Track.id, filters[f],
+                    shared.request_user_id(flask.request)))
+            except ValueError:
+                flask.abort(400)
+        elif f in PAGING_ARGS or f in shuffle.SHUFFLE_ARGS:
+            continue
         else:
             log.debug("Unknown filter: %s" % f)
 
-    tracks = tracks.order_by(data.Track.number)
-
-    session.close()
+    tracks = tracks.order_by(*TRACK_ORDER)
 
     return tracks
 
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Module imports
+import flask
+import logging as log
+
+# Local imports
+from beamie import app, data, shared
+from beamie.lib import players
+from beamie.lib.auth import Authenticated
+
+##### ROUTES #####
+
+# GET /players -- List your players
+@app.route('/players', methods=[ 'GET' ])
+def list_players():
+    return list_players()
+
+# POST /players -- Register a player
+@app.route('/players', methods=[ 'POST' ])
+def create_player():
+    return create_player()
+
+# GET /players/<player_id>
+@app.route('/players/<int:player_id>', methods=[ 'GET' ])
+def get_player(player_id):
+    return get_player(player_id)
+
+# DELETE /players/<player_id>
+@app.route('/players/<int:player_id>', methods=[ 'DELETE' ])
+def delete_player(player_id):
+    return delete_player(player_id)
+
+# PUT /players/<player_id>/position -- Report where a player is
+@app.route('/players/<int:player_id>/position', methods=[ 'PUT' ])
+def report_position(player_id):
+    return report_position(player_id)
+
+
+##### HELPERS #####
+
+def player_info(player):
+    queue_position, track_position = players.player_position(player)
+    return {
+        "id" : player.id,
+        "name" : player.name,
+        "queue_position" : queue_position,
+        "track_position" : track_position
+    }
+
+def whole_number(req_data, key):
+    """Gets a whole number from a request body; aborts with a 400 if it's
+    missing, negative or not a number"""
+    value = req_data.get(key)
+    if not isinstance(value, ( int, long )) or isinstance(value, bool) or value < 0:
+        flask.abort(400)
+    return value
+
+def owned_player(session, player_id):
+    """Gets one of the requesting user's players; aborts with a 404 if they
+    have no such player"""
+    player = session.query(data.Player).filter_by(
+        id=player_id, user_id=shared.request_user_id(flask.request)).first()
+    if player is None:
+        log.debug("No players with ID %i" % player_id)
+        flask.abort(404)
+    return player
+
+
+##### HANDLERS #####
+
+@Authenticated(['listener'])
+def list_players():
+    session = data.session()
+    owned = session.query(data.Player).filter_by(
+        user_id=shared.request_user_id(flask.request)).order_by(data.Player.id)
+    return shared.json_response([ player_info(player) for player in owned ])
+
+@Authenticated(['listener'])
+def create_player():
+    req_data = shared.request_body()
+    if not req_data.get('name'):
+        flask.abort(400)
+
+    session = data.session()
+    player = data.Player(req_data['name'], 0, 0, shared.request_user_id(flask.request))
+    session.add(player)
+    session.commit()
+
+    return shared.json_response(player_info(player), 201)
+
+@Authenticated(['listener'])
+def get_player(player_id):
+    return shared.json_response(player_info(owned_player(data.session(), player_id)))
+
+@Authenticated(['listener'])
+def delete_player(player_id):
+    session = data.session()
+    player_id = owned_player(session, player_id).id
+
+    # Bulk deletes, because the ORM cascades a player's deletion to its owner
+    session.query(data.PlayerTrack).filter_by(player_id=player_id).delete(
+        synchronize_session=False)
+    session.query(data.Player).filter_by(id=player_id).delete(synchronize_session=False)
+    session.commit()
+    players.player_deleted(player_id)
+
+    return ''
+
+@Authenticated(['listener'])
+def report_position(player_id):
+    # Clients send these every few seconds while they play, so the position is
+    # buffered rather than written, and the owner comes from a cache
+    req_data = shared.request_body()
+    queue_position = whole_number(req_data, 'queue_position')
+    track_position = whole_number(req_data, 'track_position')
+
+    owner = players.player_owner(data.session(), player_id)
+    if owner is None or owner != shared.request_user_id(flask.request):
+        log.debug("No players with ID %i" % player_id)
+        flask.abort(404)
+
+    players.report_position(player_id, queue_position, track_position)
+    return ''
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Module imports
+import flask
+import logging as log
+
+# Local imports
+from beamie import app, data, shared
+from beamie.data import chunks
+from beamie.lib import jobs, playlists
+from beamie.lib.auth import Authenticated
+from beamie.routes.library import track_info, tracks_by_id
+
+##### ROUTES #####
+
+# GET /playlists -- List your playlists
+@app.route('/playlists', methods=[ 'GET' ])
+def list_playlists():
+    return list_playlists()
+
+# POST /playlists -- Create a playlist
+@app.route('/playlists', methods=[ 'POST' ])
+def create_playlist():
+    return create_playlist()
+
+# GET /playlists/<playlist_id> -- Get a playlist and all of its entries
+@app.route('/playlists/<int:playlist_id>', methods=[ 'GET' ])
+def get_playlist(playlist_id):
+    return get_playlist(playlist_id)
+
+# PUT /playlists/<playlist_id> -- Rename a playlist
+@app.route('/playlists/<int:playlist_id>', methods=[ 'PUT' ])
+def update_playlist(playlist_id):
+    return update_playlist(playlist_id)
+
+# DELETE /playlists/<playlist_id>
+@app.route('/playlists/<int:playlist_id>', methods=[ 'DELETE' ])
+def delete_playlist(playlist_id):
+    return delete_playlist(playlist_id)
+
+# POST /playlists/<playlist_id>/entries -- Add tracks
+@app.route('/playlists/<int:playlist_id>/entries', methods=[ 'POST' ])
+def add_entries(playlist_id):
+    return add_entries(playlist_id)
+
+# POST /playlists/<playlist_id>/entries/move -- Reorder entries
+@app.route('/playlists/<int:playlist_id>/entries/move', methods=[ 'POST' ])
+def move_entries(playlist_id):
+    return move_entries(playlist_id)
+
+# DELETE /playlists/<playlist_id>/entries -- Remove entries
+@app.route('/playlists/<int:playlist_id>/entries', methods=[ 'DELETE' ])
+def remove_entries(playlist_id):
+    return remove_entries(playlist_id)
+
+
+##### HELPERS #####
+
+def playlist_info(playlist, length):
+    return {
+        "id" : playlist.id,
+        "name" : playlist.name,
+        "length" : length
+    }
+
+def id_list(req_data, key):
+    """Gets a list of IDs from a request body; aborts with a 400 if it's
+    missing or isn't a list of whole numbers"""
+    ids = req_data.get(key)
+    if not isinstance(ids, list) or \
+            not all([ isinstance(i, ( int, long )) and not isinstance(i, bool) for i in ids ]):
+        flask.abort(400)
+    return ids
+
+def after_entry(req_data):
+    """Gets the entry a request wants entries put after, from its 'after'
+    field, which is null for the start; aborts with a 400 if it's invalid"""
+    after = req_data.get('after')
+    if after is not None and (not isinstance(after, ( int, long )) or isinstance(after, bool)):
+        flask.abort(400)
+    return after
+
+def check_tracks(session, track_ids):
+    """Aborts with a 400 unless every track exists"""
+    wanted = set(track_ids)
+    found = set()
+    for ids in chunks(list(wanted)):
+        found.update([ track_id for ( track_id, ) in
+            session.query(data.Track.id).filter(data.Track.id.in_(ids)) ])
+    if found != wanted:
+        log.debug("No tracks with IDs %s" % sorted(wanted - found))
+        flask.abort(400)
+
+def owned_playlist(session, playlist_id):
+    """Gets one of the requesting user's playlists; aborts with a 404 if they
+    have no such playlist"""
+    playlist = session.query(data.Playlist).filter_by(
+        id=playlist_id, user_id=shared.request_user_id(flask.request)).first()
+    if playlist is None:
+        log.debug("No playlists with ID %i" % playlist_id)
+        flask.abort(404)
+    return playlist
+
+
+##### HANDLERS #####
+
+@Authenticated(['listener'])
+def list_playlists():
+    session = data.session()
+    owned = session.query(data.Playlist).filter_by(
+        user_id=shared.request_user_id(flask.request)).order_by(data.Playlist.id).all()
+    lengths = playlists.lengths(session, [ playlist.id for playlist in owned ])
+
+    return shared.json_response([ playlist_info(playlist, lengths[playlist.id])
+        for playlist in owned ])
+
+@Authenticated(['listener'])
+def create_playlist():
+    req_data = shared.request_body()
+    if not req_data.get('name'):
+        flask.abort(400)
+    track_ids = id_list(req_data, 'tracks') if 'tracks' in req_data else []
+
+    session = data.session()
+    check_tracks(session, track_ids)
+    playlist = data.Playlist(req_data['name'], shared.request_user_id(flask.request))
+    session.add(playlist)
+    session.flush()
+
+    playlists.add_tracks(session, playlist.id, track_ids)
+    session.commit()
+
+    return shared.json_response(playlist_info(playlist, len(track_ids)), 201)
+
+@Authenticated(['listener'])
+def get_playlist(playlist_id):
+    session = data.session()
+    playlist = owned_playlist(session, playlist_id)
+    entries = [ { "id" : entry.id, "track" : track_info(entry.track) }
+        for entry in playlists.entries(session, playlist.id) ]
+
+    info = playlist_info(playlist, len(entries))
+    info['entries'] = entries
+    return shared.json_response(info)
+
+@Authenticated(['listener'])
+def update_playlist(playlist_id):
+    req_data = shared.request_body()
+    if not req_data.get('name'):
+        flask.abort(400)
+
+    session = data.session()
+    playlist = owned_playlist(session, playlist_id)
+    playlist.name = req_data['name']
+    session.commit()
+
+    return shared.json_response(playlist_info(playlist,
+        playlists.lengths(session, [ playlist.id ])[playlist.id]))
+
+@Authenticated(['listener'])
+def delete_playlist(playlist_id):
+    session = data.session()
+    playlists.delete_playlist(session, owned_playlist(session, playlist_id).id)
+    session.commit()
+    return ''
+
+@Authenticated(['listener'])
+def add_entries(playlist_id):
+    req_data = shared.request_body()
+    track_ids = id_list(req_data, 'tracks')
+
+    session = data.session()
+    playlist = owned_playlist(session, playlist_id)
+    check_tracks(session, track_ids)
+
+    try:
+        entry_ids = playlists.add_tracks(session, playlist.id, track_ids,
+            after_entry(req_data), append='after' not in req_data)
+    except playlists.PlaylistChanged, e:
+        # Some entries may have been renumbered already
+        log.debug("Can't add to playlist: %s" % e)
+        session.rollback()
+        flask.abort(409)
+    except playlists.PlaylistError, e:
+        log.debug("Can't add to playlist: %s" % e)
+        flask.abort(400)
+    session.commit()
+    jobs.renumber_crowded(session)
+
+    tracks = dict([ ( track['id'], track ) for track in tracks_by_id(list(set(track_ids))) ])
+    return shared.json_response([ { "id" : entry_id, "track" : tracks[track_id] }
+        for entry_id, track_id in zip(entry_ids, track_ids) ], 201)
+
+@Authenticated(['listener'])
+def move_entries(playlist_id):
+    req_data = shared.request_body()
+    entry_ids = id_list(req_data, 'entries')
+
+    session = data.session()
+    playlist = owned_playlist(session, playlist_id)
+
+    try:
+        playlists.move_entries(session, playlist.id, entry_ids, after_entry(req_data))
+    except playlists.PlaylistChanged, e:
+        # Some entries may have been renumbered already
+        log.debug("Can't move playlist entries: %s" % e)
+        session.rollback()
+        flask.abort(409)
+    except playlists.PlaylistError, e:
+        log.debug("Can't move playlist entries: %s" % e)
+        flask.abort(400)
+    session.commit()
+    jobs.renumber_crowded(session)
+
+    return ''
+
+@Authenticated(['listener'])
+def remove_entries(playlist_id):
+    req_data = shared.request_body()
+    entry_ids = id_list(req_data, 'entries')
+
+    session = data.session()
+    playlists.remove_entries(session, owned_playlist(session, playlist_id).id, entry_ids)
+    session.commit()
+
+    return ''
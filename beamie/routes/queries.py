@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Module imports
+import flask
+import logging as log
+
+# Local imports
+from beamie import app, data, shared
+from beamie.lib import queries, shuffle
+from beamie.lib.auth import Authenticated
+from beamie.lib.paging import decode_cursor, encode_cursor, page_limit, paged_response
+from beamie.routes.library import tracks_by_id
+
+##### ROUTES #####
+
+# GET /queries -- List your saved queries
+@app.route('/queries', methods=[ 'GET' ])
+def list_queries():
+    return list_queries()
+
+# POST /queries -- Save a query
+@app.route('/queries', methods=[ 'POST' ])
+def create_query():
+    return create_query()
+
+# GET /queries/<query_id>
+@app.route('/queries/<int:query_id>', methods=[ 'GET' ])
+def get_query(query_id):
+    return get_query(query_id)
+
+# PUT /queries/<query_id> -- Rename a query or replace its filters
+@app.route('/queries/<int:query_id>', methods=[ 'PUT' ])
+def update_query(query_id):
+    return update_query(query_id)
+
+# DELETE /queries/<query_id>
+@app.route('/queries/<int:query_id>', methods=[ 'DELETE' ])
+def delete_query(query_id):
+    return delete_query(query_id)
+
+# GET /queries/<query_id>/tracks -- Run a query
+@app.route('/queries/<int:query_id>/tracks', methods=[ 'GET' ])
+def run_query(query_id):
+    return run_query(query_id)
+
+
+##### HELPERS #####
+
+def query_info(query):
+    """Describes a saved query as a dict"""
+    return {
+        "id" : query.id,
+        "name" : query.name,
+        "filters" : [ {
+            "key" : query_filter.key,
+            "comparison" : query_filter.comparison,
+            "value" : queries.filter_value(query_filter),
+            "and" : query_filter.is_and
+        } for query_filter in sorted(query.filters, key=lambda f: f.sequence) ]
+    }
+
+def parse_filters(filters):
+    """Turns the filters in a request body into unsaved QueryFilters, numbered
+    in the order given; aborts with a 400 if any of them are invalid"""
+    if not isinstance(filters, list):
+        flask.abort(400)
+
+    parsed = list()
+    for sequence, item in enumerate(filters):
+        if not isinstance(item, dict) or 'key' not in item or 'comparison' not in item \
+                or 'value' not in item:
+            flask.abort(400)
+
+        # Values are text or numbers, and 'and' a boolean, if it's given
+        value = item['value']
+        is_and = item.get('and', True)
+        if isinstance(value, bool) or not isinstance(value, ( basestring, int, long, float )) \
+                or not isinstance(is_and, bool):
+            flask.abort(400)
+
+        value_int = isinstance(value, ( int, long ))
+        query_filter = data.QueryFilter(is_and, item['comparison'],
+            item['key'], None, sequence, unicode(value), value_int)
+
+        try:
+            queries.check_filter(query_filter)
+        except queries.QueryError, e:
+            log.debug("Invalid filter: %s" % e)
+            flask.abort(400)
+
+        parsed.append(query_filter)
+
+    return parsed
+
+def owned_query(session, query_id):
+    """Gets one of the requesting user's queries; aborts with a 404 if they
+    have no such query"""
+    query = session.query(data.Query).filter_by(
+        id=query_id, user_id=shared.request_user_id(flask.request)).first()
+    if query is None:
+        log.debug("No queries with ID %i" % query_id)
+        flask.abort(404)
+    return query
+
+def replace_filters(session, query, filters):
+    session.query(data.QueryFilter).filter_by(query_id=query.id).delete(
+        synchronize_session=False)
+    session.expire(query, [ 'filters' ])
+    for query_filter in filters:
+        query_filter.query_id = query.id
+    session.add_all(filters)
+
+
+##### HANDLERS #####
+
+@Authenticated(['listener'])
+def list_queries():
+    session = data.session()
+    saved = session.query(data.Query).filter_by(
+        user_id=shared.request_user_id(flask.request)).order_by(data.Query.id)
+
+    return shared.json_response([ query_info(query) for query in saved ])
+
+@Authenticated(['listener'])
+def create_query():
+    req_data = shared.request_body()
+    if not req_data.get('name'):
+        flask.abort(400)
+    filters = parse_filters(req_data.get('filters', []))
+
+    session = data.session()
+    query = data.Query(req_data['name'], shared.request_user_id(flask.request))
+    session.add(query)
+    session.flush()
+
+    replace_filters(session, query, filters)
+    session.commit()
+
+    return shared.json_response(query_info(query), 201)
+
+@Authenticated(['listener'])
+def get_query(query_id):
+    return shared.json_response(query_info(owned_query(data.session(), query_id)))
+
+@Authenticated(['listener'])
+def update_query(query_id):
+    req_data = shared.request_body()
+    session = data.session()
+    query = owned_query(session, query_id)
+
+    if 'name' in req_data:
+        if not req_data['name']:
+            flask.abort(400)
+        query.name = req_data['name']
+
+    if 'filters' in req_data:
+        replace_filters(session, query, parse_filters(req_data['filters']))
+
+    session.commit()
+    queries.invalidate_query(query_id)
+
+    return shared.json_response(query_info(query))
+
+@Authenticated(['listener'])
+def delete_query(query_id):
+    session = data.session()
+    query = owned_query(session, query_id)
+
+    # Bulk deletes, because the ORM cascades a query's deletion to its owner
+    session.query(data.QueryFilter).filter_by(query_id=query.id).delete(
+        synchronize_session=False)
+    session.query(data.Query).filter_by(id=query.id).delete(synchronize_session=False)
+    session.commit()
+    queries.invalidate_query(query_id)
+
+    return ''
+
+@Authenticated(['listener'])
+def run_query(query_id):
+    req = flask.request
+    session = data.session()
+    query = owned_query(session, query_id)
+
+    try:
+        rows = queries.run_query(query, session.connection())
+    except queries.QueryError, e:
+        log.warning("Query %i can't be run: %s" % (query_id, e))
+        flask.abort(400)
+
+    if 'shuffle' in req.args:
+        ids, next_cursor, seed = shuffle.shuffle_page(( 'query', queries.query_key(query) ),
+            lambda: rows, req.args)
+        resp = paged_response(tracks_by_id(ids), next_cursor)
+        resp.headers['X-Shuffle-Seed'] = str(seed)
+        return resp
+
+    # Results are cached as a list, so a cursor is a position in it
+    start = 0
+    if 'after' in req.args:
+        after = decode_cursor(req.args['after'])
+        if len(after) != 1 or not isinstance(after[0], int) or after[0] < 0:
+            flask.abort(400)
+        start = after[0]
+
+    limit = page_limit(req.args)
+    next_cursor = None
+    if start + limit < len(rows):
+        next_cursor = encode_cursor([ start + limit ])
+
+    return paged_response(tracks_by_id([ track_id for track_id, _artist_id in
+        rows[start:start + limit] ]), next_cursor)
@@ -3,13 +3,15 @@
 
 # Module imports
 import flask
+import hashlib
 import json
 import logging as log
 
 # Local imports
-from beamie import app, shared
+from beamie import app, data, shared
 from beamie.lib.auth import Authenticated
-from beamie.lib.tokens import do_validate_token
+from beamie.lib.roles import all_roles, invalidate_user_roles, role_ids
+from beamie.lib.tokens import do_validate_token, invalidate_user_tokens
 
 ##### ROUTES #####
 
@@ -44,18 +46,12 @@ def get_user(username):
 
 @Authenticated(["listener", "contributor", "administrator"])
 def get_roles():
-    session = data.session()
-    roles = [ {
-        'id' : role.id,
-        'name' : role.name,
-        'description' : role.description
-    } for role in session.query(data.Role) ]
-    return roles
+    return all_roles()
 
 @Authenticated(['administrator'])
 def create_user():
     req = flask.request
-    # req_data = {}   # Marked for deletion
+    req_data = {}
 
     try:
         req_data = json.loads(req.data)
@@ -66,77 +62,26 @@ def create_user():
 
     session = data.session()
 
-    user = data.User()
-    user.username = req_data['user']
-    user.salt = shared.generate_salt()
-    user.pwhash = hashlib.sha512("".join([req_data['password'], user.salt])).hexdigest()
+    salt = shared.generate_salt()
+    user = data.User(
+        pwhash=hashlib.sha512("".join([req_data['password'], salt])).hexdigest(),
+        salt=salt,
+        username=req_data['user']
+    )
 
     session.add(user)
-    session.commit()
-
-    new_user = get_user(req_data['user'])
-    if new_user:
-        all_roles = get_roles()
-        log.debug("All roles: %s" % all_roles)
-        objects_to_create = []
-        for role_to_enroll in req_data['roles']:
-            for role in all_roles:
-                if role['name'] == role_to_enroll:
-                    rm = data.RoleMembership()
-                    rm.user_id = new_user['id']
-                    rm.role_id = role['id']
-                    objects_to_create.append(rm)
-
-        log.debug("Object to create: %s" % objects_to_create)
-        session.add_all( objects_to_create )
-        session.commit()
-        return ''
-    else:
-        print "Could not find the specified username: %s" % req_data['user']
-        flask.abort(500)
-
-@Authenticated(['administrator'])
-def create_user():
-    req = flask.request
-    req_data = {}
-
-    try:
-        req_data = json.loads(req.data)
-        if 'user' not in req_data or 'password' not in req_data:
-            flask.abort(400)
-    except ValueError:
-        flask.abort(400)
+    session.flush()
 
-    session = data.session()
-
-    user = data.User()
-    user.username = req_data['user']
-    user.salt = shared.generate_salt()
-    user.pwhash = hashlib.sha512("".join([req_data['password'], user.salt])).hexdigest()
+    # Role names are resolved from the cached role table
+    objects_to_create = [ data.RoleMembership(role_id=role_id, user_id=user.id)
+        for role_id in role_ids(req_data.get('roles', [])) ]
 
-    session.add(user)
+    log.debug("Object to create: %s" % objects_to_create)
+    session.add_all( objects_to_create )
     session.commit()
-
-    new_user = get_user(req_data['user'])
-    if new_user:
-        all_roles = get_roles()
-        log.debug("All roles: %s" % all_roles)
-        objects_to_create = []
-        for role_to_enroll in req_data['roles']:
-            for role in all_roles:
-                if role['name'] == role_to_enroll:
-                    rm = data.RoleMembership()
-                    rm.user_id = new_user['id']
-                    rm.role_id = role['id']
-                    objects_to_create.append(rm)
-
-        log.debug("Object to create: %s" % objects_to_create)
-        session.add_all( objects_to_create )
-        session.commit()
-        return ''
-    else:
-        print "Could not find the specified username: %s" % req_data['user']
-        flask.abort(500)
+    invalidate_user_roles(user.id)
+    invalidate_user_tokens(user.id)
+    return ''
 
 def update_password(username):
     # Because we need to verify that either the user making the request is
@@ -4,6 +4,7 @@
 # Global modules
 import flask
 import hashlib
+import json
 import logging as log
 import math
 import random
@@ -14,7 +15,8 @@ from time import time
 # Our modules
 import data
 
-from beamie.lib.tokens import do_validate_token
+from beamie.lib.roles import user_roles
+from beamie.lib.tokens import do_validate_token, sign_token, signed_tokens_enabled
 
 # Our config
 from config import CONFIG
@@ -49,14 +51,30 @@ def generate_random_string(length=None, alphabet=None):
 def generate_salt():
     return generate_random_string(random.randint(12,32))
 
-def generate_token(user):
+def generate_token(user, roles):
+    """Issues a token for a user who has just authenticated. Signed tokens
+    carry the user's roles and expiry; opaque tokens are stored in the DB."""
+    token_expiry = int(time()) + CONFIG['token_expiry']
+
+    if signed_tokens_enabled():
+        return sign_token({
+            'jti' : generate_random_string(20, "".join([
+                "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ",
+                "0123456789"
+            ])),
+            'iat' : int(time()),
+            'exp' : token_expiry,
+            'uid' : user.id,
+            'usr' : user.username,
+            'roles' : roles
+        })
+
     session = data.session()
 
     token_id = generate_random_string(40, "".join([
         "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ",
         "0123456789"
     ]))
-    token_expiry = int(time()) + CONFIG['token_expiry']
 
     token = data.Token(token_id, token_expiry, user.id)
 
@@ -75,16 +93,15 @@ def authenticate(user, passwd):
     session = data.session()
 
     # Get user by name. No user match? return None
-    users = session.query(data.User).filter_by(username=user)
-    if users.count() >= 1:
-        user = users.first()
-        memberships = session.query(data.RoleMembership).filter_by(user_id=user.id)
-        if 'disabled' in [ membership.role.name for membership in memberships ]:
+    user = session.query(data.User).filter_by(username=user).first()
+    if user is not None:
+        roles = user_roles(user.id)
+        if 'disabled' in roles:
             return False
         else:
             inputhash = hashlib.sha512("".join([passwd, user.salt])).hexdigest()
             if inputhash == user.pwhash:
-                return generate_token(user)
+                return generate_token(user, roles)
             else:
                 return False
     else:
@@ -101,10 +118,41 @@ def token_in_req_contains_role(req, role):
     except KeyError:
         return None
 
-    print "Roles: %s" % token_data['user']['roles']
-    if roles:
-        if role in roles:
+    if token_data:
+        log.debug("Roles: %s" % token_data['user']['roles'])
+        if role in token_data['user']['roles']:
             return True
 
     return False
 
+
+def request_user_id(req):
+    """Gets the ID of the user whose token authenticated a request, or None if
+    there's no valid token"""
+    try:
+        token_data = do_validate_token(req.headers['x-auth-token'])
+    except KeyError:
+        return None
+
+    if token_data:
+        return token_data['user']['id']
+
+    return None
+
+def json_response(body, status=200):
+    """Makes a response with a JSON body"""
+    resp = flask.make_response(json.dumps(body), status)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+def request_body():
+    """Gets the request's JSON body as a dict; aborts with a 400 if it isn't one"""
+    try:
+        req_data = json.loads(flask.request.data)
+    except ValueError:
+        flask.abort(400)
+
+    if not isinstance(req_data, dict):
+        flask.abort(400)
+
+    return req_data
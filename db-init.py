@@ -3,11 +3,19 @@
 
 import argparse
 
-from beamie import data
+from beamie import data, migrations
 
 def create_parser():
-    parser = argparse.ArgumentParser(description="Initialize a default Beamie database")
+    parser = argparse.ArgumentParser(description="Initialize or upgrade a Beamie database")
 
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=[ "init", "upgrade" ],
+        default="init",
+        help="'init' builds a new, empty database, destroying any existing data. " +
+             "'upgrade' applies pending schema migrations to an existing database."
+    )
     parser.add_argument(
         "dbstring",
         type=str,
@@ -16,15 +24,20 @@ def create_parser():
 
     return parser
 
-def main():
-    # Read input
-    opts = create_parser().parse_args()
+def upgrade(dbstring):
+    applied = migrations.upgrade(dbstring)
+    if len(applied) > 0:
+        print "Applied migrations: %s" % ", ".join([ str(v) for v in applied ])
+    else:
+        print "Database is already at schema version %i" % migrations.LATEST_VERSION
 
+def init(dbstring):
     # Construct the basic DB framework
-    data.construct(opts.dbstring)
+    data.construct(dbstring)
+    migrations.stamp(dbstring)
 
     # Get a session
-    sesh = data.session(opts.dbstring)
+    sesh = data.session(dbstring)
     
     # Create default roles
     roles = [
@@ -55,5 +68,14 @@ def main():
 
     sesh.commit()
 
+def main():
+    # Read input
+    opts = create_parser().parse_args()
+
+    if opts.command == "upgrade":
+        upgrade(opts.dbstring)
+    else:
+        init(opts.dbstring)
+
 
 if __name__ == "__main__": main()
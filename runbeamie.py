@@ -11,6 +11,9 @@ import os
 # Local imports
 from beamie import app
 from beamie.config import CONFIG
+from beamie.lib.metacache import open_metadata_cache
+from beamie.lib.tagindex import build_tag_index
+from beamie.lib.watcher import LibraryWatcher, start_watcher
 from multiprocessing import Process
 from test import test
 
@@ -34,6 +37,31 @@ def create_parser():
         help="Run full tests and quit",
         dest="test"
     )
+    parser.add_argument(
+        '-w',
+        '--watch',
+        action='store_true',
+        help="Watch the media paths and apply changes while serving",
+        dest="watch"
+    )
+    parser.add_argument(
+        '--watch-only',
+        action='store_true',
+        help="Watch the media paths and apply changes without serving",
+        dest="watch_only"
+    )
+    parser.add_argument(
+        '--export-metadata',
+        metavar='FILE',
+        help="Copy the metadata cache to FILE and quit",
+        dest="export_metadata"
+    )
+    parser.add_argument(
+        '--import-metadata',
+        metavar='FILE',
+        help="Merge the metadata cache in FILE into ours and quit",
+        dest="import_metadata"
+    )
     return parser
 
 
@@ -47,6 +75,7 @@ def configure_application():
 
 
 def run_server():
+    build_tag_index()
     app.run(host=CONFIG['bind_address'], port=CONFIG['bind_port'])
 
 def main():
@@ -57,13 +86,26 @@ def main():
     log.info("Beamie initializing...")
     log.info("Logging started at log level: %s", CONFIG['logging']['level'])
 
-    if opts.test:
+    if opts.export_metadata or opts.import_metadata:
+        cache = open_metadata_cache()
+        if cache is None:
+            raise Exception("No metadata_cache is configured")
+        if opts.export_metadata:
+            cache.export_to(opts.export_metadata)
+        else:
+            cache.import_from(opts.import_metadata)
+        cache.close()
+    elif opts.test:
         server = Process(target=run_server)
         server.start()
         test.run_all()
         server.terminate()
         server.join()
+    elif opts.watch_only:
+        LibraryWatcher(CONFIG['media_paths']).run()
     else:
+        if opts.watch:
+            start_watcher(CONFIG['media_paths'])
         run_server()
 
 if __name__ == "__main__":
@@ -7,6 +7,7 @@ import json
 import os
 import requests as r
 import sys
+import time
 
 # Point these settings at a running Beamie instance
 protocol = 'http'
@@ -208,6 +209,83 @@ def download_track():
     finally:
         os.remove('test/output.mp3')
 
+def download_track_range():
+    log.debug("")
+    if not outcome['token']:
+        auth_with_good_credentials()
+
+    headers = base_headers
+    headers['x-auth-token'] = outcome['token']
+    filename = r.get(url_base + "tracks/4", headers=headers).json()['filename']
+
+    fd = open(filename, 'rb')
+    fd.seek(100)
+    expected = fd.read(50)
+    fd.close()
+
+    range_headers = dict(headers)
+    range_headers['Range'] = 'bytes=100-149'
+    resp = r.get(url_base + "tracks/4/download", headers=range_headers)
+
+    try:
+        assert resp.status_code == 206
+        assert resp.content == expected
+        assert resp.headers['Content-Type'] == 'audio/mpeg'
+    except AssertionError:
+        outcome['failures'].append("download_track_range: Expected status code %i, got %i" % (
+                                   206, resp.status_code))
+        return
+
+    cond_headers = dict(headers)
+    cond_headers['If-None-Match'] = resp.headers['ETag']
+    resp = r.get(url_base + "tracks/4/download", headers=cond_headers)
+
+    try:
+        assert resp.status_code == 304
+        outcome['successes'].append("download_track_range")
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("download_track_range: Expected status code %i, got %i" % (
+                                   304, resp.status_code))
+
+
+def download_transcoded_track():
+    """Relies on the 'copy' encoder in test/beamie.yml, which passes the file
+    through unchanged"""
+    log.debug("")
+    if not outcome['token']:
+        auth_with_good_credentials()
+
+    headers = base_headers
+    headers['x-auth-token'] = outcome['token']
+    filename = r.get(url_base + "tracks/4", headers=headers).json()['filename']
+
+    fd = open(filename, 'rb')
+    original = fd.read()
+    fd.close()
+
+    for expected_cache in [ None, 'hit' ]:
+        resp = r.get(url_base + "tracks/4/download?format=copy", headers=headers)
+
+        try:
+            assert resp.status_code == 200
+            assert resp.content == original
+            if expected_cache is not None:
+                assert resp.headers['X-Transcode-Cache'] == expected_cache
+        except AssertionError:
+            outcome['failures'].append("download_transcoded_track: Expected status code %i, got %i" % (
+                                       200, resp.status_code))
+            return
+
+    resp = r.get(url_base + "tracks/4/download?format=nonexistent", headers=headers)
+
+    try:
+        assert resp.status_code == 400
+        outcome['successes'].append("download_transcoded_track")
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("download_transcoded_track: Expected status code %i, got %i" % (
+                                   400, resp.status_code))
 
 def get_tracks():
     log.debug("")
@@ -283,6 +361,272 @@ def get_tracks():
         outcome['failures'].append(failure)
 
 
+def page_tracks():
+    log.debug("")
+    if not outcome['token']:
+        auth_with_good_credentials()
+
+    headers = base_headers
+    headers['x-auth-token'] = outcome['token']
+
+    # Walk all tracks in pages of 10, following the cursors
+    pages = []
+    url = url_base + "tracks?limit=10"
+    while url is not None:
+        resp = r.get(url, headers=headers)
+        if resp.status_code != 200:
+            break
+        pages.append(resp.json())
+        if 'x-next-cursor' in resp.headers:
+            url = url_base + "tracks?limit=10&after=" + resp.headers['x-next-cursor']
+        else:
+            url = None
+
+    try:
+        assert resp.status_code == 200
+        assert [ len(page) for page in pages ] == [ 10, 10, 3 ]
+        ids = [ track['id'] for page in pages for track in page ]
+        assert len(set(ids)) == 23
+        outcome['successes'].append("page_tracks")
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("page_tracks: Expected pages of 10, 10 and 3 distinct tracks, got %s; Status code: %i" % (
+                                   [ len(page) for page in pages ], resp.status_code ))
+
+
+def shuffle_tracks():
+    log.debug("")
+    if not outcome['token']:
+        auth_with_good_credentials()
+
+    headers = base_headers
+    headers['x-auth-token'] = outcome['token']
+
+    # Shuffle all tracks in pages of 10 with a server-picked seed
+    pages = []
+    url = url_base + "tracks?shuffle=&limit=10"
+    while url is not None:
+        resp = r.get(url, headers=headers)
+        if resp.status_code != 200:
+            break
+        pages.append(resp.json())
+        if 'x-next-cursor' in resp.headers:
+            url = url_base + "tracks?shuffle=&limit=10&after=" + resp.headers['x-next-cursor']
+        else:
+            url = None
+
+    # The same seed gives the same order
+    again = r.get(url_base + "tracks?limit=10&shuffle=" + resp.headers.get('x-shuffle-seed', ''),
+        headers=headers)
+
+    try:
+        assert resp.status_code == 200
+        ids = [ track['id'] for page in pages for track in page ]
+        assert len(ids) == 23
+        assert len(set(ids)) == 23
+        assert again.status_code == 200
+        assert [ track['id'] for track in again.json() ] == ids[:10]
+        outcome['successes'].append("shuffle_tracks")
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("shuffle_tracks: Expected 23 distinct tracks in a repeatable order, got %s; Status code: %i" % (
+                                   [ len(page) for page in pages ], resp.status_code ))
+
+
+def filter_tracks_by_tag():
+    log.debug("")
+    if not outcome['token']:
+        auth_with_good_credentials()
+
+    headers = base_headers
+    headers['x-auth-token'] = outcome['token']
+
+    # The test media carries no tags, so excluding one leaves every track
+    tagged = r.get(url_base + "tracks?tags=no-such-tag", headers=headers)
+    untagged = r.get(url_base + "tracks?tags=-no-such-tag", headers=headers)
+    empty = r.get(url_base + "tracks?tags=", headers=headers)
+
+    try:
+        assert tagged.status_code == 200
+        assert len(tagged.json()) == 0
+        assert untagged.status_code == 200
+        assert len(untagged.json()) == 23
+        assert empty.status_code == 400
+        outcome['successes'].append("filter_tracks_by_tag")
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("filter_tracks_by_tag: Expected 0 and 23 tracks and a 400, got status codes %i, %i and %i" % (
+                                   tagged.status_code, untagged.status_code, empty.status_code ))
+
+
+def search_library():
+    log.debug("")
+    if not outcome['token']:
+        auth_with_good_credentials()
+
+    headers = base_headers
+    headers['x-auth-token'] = outcome['token']
+
+    # "silly boy" names one track, which should come first
+    resp = r.get(url_base + "search?q=silly%20boy", headers=headers)
+
+    try:
+        assert resp.status_code == 200
+        j = resp.json()
+        assert j[0]['type'] == 'track'
+        assert j[0]['id'] == 4
+        assert j[0]['name'] == u'Silly Boy'
+        outcome['successes'].append("search_library")
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("search_library: Expected status code %i, got %i; Body: %s" % (
+                                   200, resp.status_code, resp.text ))
+
+    # A search needs terms
+    resp = r.get(url_base + "search", headers=headers)
+
+    try:
+        assert resp.status_code == 400
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("search_library (no terms): Expected status code %i, got %i" % (
+                                   400, resp.status_code ))
+
+
+def run_saved_query():
+    log.debug("")
+    if not outcome['token']:
+        auth_with_good_credentials()
+
+    headers = base_headers
+    headers['x-auth-token'] = outcome['token']
+
+    # Save a query for the 4th track on albums like 'night' by artists like 'ell'
+    resp = r.post(url_base + "queries", headers=headers, data=json.dumps({
+        "name" : "Fourth tracks",
+        "filters" : [
+            { "key" : "artist", "comparison" : "contains", "value" : "ell" },
+            { "key" : "album", "comparison" : "contains", "value" : "night" },
+            { "key" : "number", "comparison" : "eq", "value" : 4 }
+        ]
+    }))
+
+    try:
+        assert resp.status_code == 201
+        query_id = resp.json()['id']
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("run_saved_query (create): Expected status code %i, got %i; Body: %s" % (
+                                   201, resp.status_code, resp.text ))
+        return
+
+    # Run it, then delete it
+    resp = r.get(url_base + "queries/%i/tracks" % query_id, headers=headers)
+    deleted = r.delete(url_base + "queries/%i" % query_id, headers=headers)
+
+    try:
+        assert resp.status_code == 200
+        j = resp.json()
+        assert len(j) == 1
+        assert j[0]['name'] == "Artificial Joy"
+        assert deleted.status_code == 200
+        outcome['successes'].append("run_saved_query")
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("run_saved_query (run): Expected status code %i, got %i; Body: %s" % (
+                                   200, resp.status_code, resp.text ))
+
+
+def edit_playlist():
+    log.debug("")
+    if not outcome['token']:
+        auth_with_good_credentials()
+
+    headers = base_headers
+    headers['x-auth-token'] = outcome['token']
+
+    # Make a playlist of three tracks, then move the last one to the start
+    resp = r.post(url_base + "playlists", headers=headers, data=json.dumps({
+        "name" : "Reordered",
+        "tracks" : [ 1, 2, 3 ]
+    }))
+
+    try:
+        assert resp.status_code == 201
+        playlist_id = resp.json()['id']
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("edit_playlist (create): Expected status code %i, got %i; Body: %s" % (
+                                   201, resp.status_code, resp.text ))
+        return
+
+    url = url_base + "playlists/%i" % playlist_id
+    entries = [ entry['id'] for entry in r.get(url, headers=headers).json()['entries'] ]
+    moved = r.post(url + "/entries/move", headers=headers, data=json.dumps({
+        "entries" : [ entries[2] ],
+        "after" : None
+    }))
+    resp = r.get(url, headers=headers)
+    deleted = r.delete(url, headers=headers)
+
+    try:
+        assert moved.status_code == 200
+        assert resp.status_code == 200
+        j = resp.json()
+        assert j['length'] == 3
+        assert [ entry['track']['id'] for entry in j['entries'] ] == [ 3, 1, 2 ]
+        assert deleted.status_code == 200
+        outcome['successes'].append("edit_playlist")
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("edit_playlist (move): Expected status code %i, got %i; Body: %s" % (
+                                   200, resp.status_code, resp.text ))
+
+
+def report_player_position():
+    log.debug("")
+    if not outcome['token']:
+        auth_with_good_credentials()
+
+    headers = base_headers
+    headers['x-auth-token'] = outcome['token']
+
+    resp = r.post(url_base + "players", headers=headers, data=json.dumps({
+        "name" : "Test player"
+    }))
+
+    try:
+        assert resp.status_code == 201
+        player_id = resp.json()['id']
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("report_player_position (create): Expected status code %i, got %i; Body: %s" % (
+                                   201, resp.status_code, resp.text ))
+        return
+
+    # The report is buffered, but reading the player should see it at once
+    url = url_base + "players/%i" % player_id
+    reported = r.put(url + "/position", headers=headers, data=json.dumps({
+        "queue_position" : 2,
+        "track_position" : 95
+    }))
+    resp = r.get(url, headers=headers)
+    deleted = r.delete(url, headers=headers)
+
+    try:
+        assert reported.status_code == 200
+        assert resp.status_code == 200
+        j = resp.json()
+        assert j['queue_position'] == 2
+        assert j['track_position'] == 95
+        assert deleted.status_code == 200
+        outcome['successes'].append("report_player_position")
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("report_player_position (report): Expected status code %i, got %i; Body: %s" % (
+                                   200, resp.status_code, resp.text ))
+
+
 def get_albums():
     log.debug("")
     if not outcome['token']:
@@ -376,6 +720,33 @@ def get_artists():
                                    200, resp.status_code, resp.text ))
         
 
+def get_unchanged_artists():
+    log.debug("")
+    if not outcome['token']:
+        auth_with_good_credentials()
+
+    headers = base_headers
+    headers['x-auth-token'] = outcome['token']
+
+    # Nothing changes the library between these, so the second is a 304
+    resp = r.get(url_base + "artists", headers=headers)
+    etag = resp.headers.get('etag')
+    conditional = dict(headers)
+    conditional['if-none-match'] = etag
+    unchanged = r.get(url_base + "artists", headers=conditional)
+
+    try:
+        assert resp.status_code == 200
+        assert etag is not None
+        assert unchanged.status_code == 304
+        assert unchanged.text == ''
+        outcome['successes'].append("get_unchanged_artists")
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("get_unchanged_artists: Expected status code %i, got %i; Body: %s" % (
+                                   304, unchanged.status_code, unchanged.text ))
+
+
 def scan_with_valid_auth():
     log.debug("")
     auth_with_good_credentials()
@@ -386,13 +757,29 @@ def scan_with_valid_auth():
     resp = r.post(url_base + "scan", headers=headers)
 
     try:
-        assert resp.status_code == 200
+        assert resp.status_code == 202
         log.debug(resp.text)
         outcome['successes'].append('scan_with_valid_auth')
         log.debug('OK')
     except AssertionError:
         outcome['failures'].append("scan_with_valid_auth: Expected status code %i, got %i" % (
-                  200, resp.status_code ))
+                  202, resp.status_code ))
+        return
+
+    # The scan runs in the background; wait for it so later tests see its results
+    job = resp.json()
+    deadline = time.time() + 60
+    while job['phase'] not in [ 'done', 'failed' ] and time.time() < deadline:
+        time.sleep(0.5)
+        job = r.get(url_base + "scan/" + job['id'], headers=headers).json()
+
+    try:
+        assert job['phase'] == 'done'
+        assert job['outcome'] is not None
+        outcome['successes'].append('scan_job_status')
+        log.debug('OK')
+    except AssertionError:
+        outcome['failures'].append("scan_job_status: Expected a finished scan, got %s" % job)
 
 def validate_good_token_with_good_x_auth_token():
     log.debug("")
@@ -498,9 +885,19 @@ def print_outcome():
 # Test groups
 def run_data_tests():
     get_tracks()
+    page_tracks()
+    shuffle_tracks()
+    filter_tracks_by_tag()
+    search_library()
+    run_saved_query()
+    edit_playlist()
+    report_player_position()
     get_albums()
     get_artists()
+    get_unchanged_artists()
     download_track()
+    download_track_range()
+    download_transcoded_track()
 
 def run_scan_tests():
     scan_with_valid_auth()